@@ -4,4 +4,6 @@ from .models import *
 
 admin.site.register(Trade)
 admin.site.register(Portfolio)
+admin.site.register(PortfolioGroup)
 admin.site.register(Position)
+admin.site.register(QueuedTrade)
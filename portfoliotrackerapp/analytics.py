@@ -0,0 +1,173 @@
+import datetime
+
+import numpy as np
+
+from .models import *
+
+""" Portfolio analytics over the full trade history, computed on NumPy arrays rather than per trade loops """
+
+FREQUENCIES = ('D', 'W', 'M')
+
+
+class TradeArrays:
+    """
+    The trades of a portfolio as columns, sorted by (security, trade_time, id), with the position
+    state after every trade. Cost basis follows the moving average method used for positions:
+    buys add their cost, sells release cost at the average price.
+    """
+
+    def __init__(self, rows):
+        securities, trade_types, counts, prices, times = zip(*rows) if rows else ((), (), (), (), ())
+        names, security = np.unique(np.array(securities, dtype=object), return_inverse=True)
+        is_buy = np.array(trade_types, dtype=object) == Trade.BUY
+        count = np.array(counts, dtype=np.int64)
+        price = np.array(prices, dtype=np.float64)
+        time = np.array([t.replace(tzinfo=None) for t in times], dtype='datetime64[us]')
+
+        # Stable sort keeps the time order of the query within each security
+        order = np.argsort(security, kind='stable')
+        self.names = names
+        self.security = security[order].astype(np.int64)
+        self.is_buy = is_buy[order]
+        self.count = count[order]
+        self.price = price[order]
+        self.time = time[order]
+        self._compute()
+
+    def __len__(self):
+        return len(self.security)
+
+    def _compute(self):
+        n = len(self)
+        signed = np.where(self.is_buy, self.count, -self.count)
+        group_start = np.ones(n, dtype=bool)
+        group_start[1:] = self.security[1:] != self.security[:-1]
+        start_index = np.maximum.accumulate(np.where(group_start, np.arange(n), 0))
+
+        # Position after each trade, a cumulative sum restarted at every security
+        cumulative = np.cumsum(signed)
+        self.position = cumulative - (cumulative[start_index] - signed[start_index])
+        position_before = self.position - signed
+
+        # Cost basis follows cost = m * previous cost + a. Buys have m = 1, a = price * count and sells have
+        # m = position / position before, a = 0, so a sell that closes the position zeroes the cost. Each pass of
+        # the prefix scan below composes every step with the span of steps before it, doubling the span, until
+        # spans reach back to a close or to the first trade of their security. Products of m stay within [0, 1]
+        # however many sells there are.
+        held = position_before > 0
+        m = np.where(self.is_buy | ~held, 1.0, self.position / np.where(held, position_before, 1))
+        m[group_start] = 0.0
+        cost = np.where(self.is_buy, self.price * self.count, 0.0)
+        shift = 1
+        while shift < n and m[shift:].any():
+            cost[shift:] = m[shift:] * cost[:-shift] + cost[shift:]
+            m[shift:] = m[shift:] * m[:-shift]
+            shift *= 2
+        self.cost = cost
+
+        cost_before = np.where(group_start, 0.0, np.roll(self.cost, 1))
+        self.average_before = np.where(held, cost_before / np.where(held, position_before, 1), 0.0)
+        self.realized = np.where(self.is_buy, 0.0, (self.price - self.average_before) * self.count)
+        self.flow = np.where(self.is_buy, 1.0, -1.0) * self.price * self.count
+
+    def at(self, moments):
+        """
+        Per security state at each of the given moments. Returns (position, cost, last price)
+        arrays shaped (securities, moments).
+        """
+        shape = (len(self.names), len(moments))
+        position, cost, last_price = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+        for index in range(len(self.names)):
+            rows = np.flatnonzero(self.security == index)
+            found = np.searchsorted(self.time[rows], moments, side='right') - 1
+            valid = found >= 0
+            picked = rows[np.where(valid, found, 0)]
+            position[index] = np.where(valid, self.position[picked], 0)
+            cost[index] = np.where(valid, self.cost[picked], 0.0)
+            last_price[index] = np.where(valid, self.price[picked], 0.0)
+        return position, cost, last_price
+
+    def cumulative_until(self, values, moments):
+        """Sum of a per trade column over trades up to each moment"""
+        order = np.argsort(self.time, kind='stable')
+        cumulative = np.concatenate(([0.0], np.cumsum(values[order])))
+        return cumulative[np.searchsorted(self.time[order], moments, side='right')]
+
+
+def load_trades(portfolio, until=None):
+    trades = Trade.objects.filter(portfolio=portfolio)
+    if until is not None:
+        trades = trades.filter(trade_time__lt=until)
+    rows = list(trades.order_by('trade_time', 'id')
+                .values_list('security', 'trade_type', 'count', 'trade_price', 'trade_time'))
+    return TradeArrays(rows)
+
+
+def period_ends(start, end, freq):
+    days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1)
+    if freq == 'D' or len(days) == 0:
+        return days
+    if freq == 'W':
+        # 1970-01-01 was a Thursday, so Sundays are 3 days off a multiple of 7
+        last = (days.astype(np.int64) + 3) % 7 == 6
+    else:
+        last = days.astype('datetime64[M]') != (days + 1).astype('datetime64[M]')
+    last[-1] = True
+    return days[last]
+
+
+def portfolio_analytics(portfolio, start=None, end=None, freq='D', prices=None):
+    """
+    Equity curve, time-weighted return and realized / unrealized P&L of a portfolio between two dates.
+
+    Positions on the curve are marked at their last traded price as there is no price history. The closing
+    unrealized P&L uses `prices`, the current market prices, where given. The time-weighted return chains
+    period returns with trade cash flows assumed at the end of each period.
+    """
+    end = end or datetime.date.today()
+    arrays = load_trades(portfolio, until=datetime.datetime.combine(end + datetime.timedelta(days=1),
+                                                                    datetime.time(), tzinfo=datetime.timezone.utc))
+    if start is None:
+        start = arrays.time.min().astype(datetime.datetime).date() if len(arrays) else end
+
+    dates = period_ends(start, end, freq)
+    # Moments are the end of each period, with an extra anchor at the start of the window for returns
+    anchor = np.datetime64(start, 'D').astype('datetime64[us]') - np.timedelta64(1, 'us')
+    moments = np.concatenate(([anchor], (dates + 1).astype('datetime64[us]') - np.timedelta64(1, 'us')))
+
+    position, cost, last_price = arrays.at(moments)
+    market_value = (position * last_price).sum(axis=0)
+    cost_basis = cost.sum(axis=0)
+    realized = arrays.cumulative_until(arrays.realized, moments)
+    flows = np.diff(arrays.cumulative_until(arrays.flow, moments))
+
+    previous_value = market_value[:-1]
+    period_returns = np.where(previous_value > 0,
+                              (market_value[1:] - flows) / np.where(previous_value > 0, previous_value, 1) - 1, 0.0)
+    time_weighted_return = float(np.prod(1 + period_returns) - 1)
+
+    closing_prices = last_price[:, -1].copy()
+    if prices:
+        for index, name in enumerate(arrays.names):
+            if name in prices:
+                closing_prices[index] = prices[name]
+    unrealized = float((position[:, -1] * closing_prices).sum() - cost_basis[-1])
+
+    return {
+        'from': start,
+        'to': end,
+        'freq': freq,
+        'time_weighted_return': time_weighted_return,
+        'realized_pnl': float(realized[-1] - realized[0]),
+        'unrealized_pnl': unrealized,
+        'equity_curve': [
+            {
+                'date': date.item(),
+                'market_value': float(value),
+                'cost_basis': float(basis),
+                'realized_pnl': float(pnl - realized[0]),
+                'unrealized_pnl': float(value - basis),
+            }
+            for date, value, basis, pnl in zip(dates, market_value[1:], cost_basis[1:], realized[1:])
+        ],
+    }
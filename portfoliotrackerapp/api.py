@@ -1,6 +1,24 @@
+from django.urls import path
 from rest_framework import routers
-from .views import TradeViewset, PortfolioViewset
+from . import async_views
+from .views import MetricsView, TradeViewset, PortfolioViewset, PortfolioGroupViewset, PositionViewset, \
+    QueuedTradeViewset
 
 router = routers.DefaultRouter()
 router.register(r'trade', TradeViewset)
 router.register(r'portfolio', PortfolioViewset)
+router.register(r'portfolio-group', PortfolioGroupViewset)
+router.register(r'position', PositionViewset)
+router.register(r'trade-queue', QueuedTradeViewset)
+
+urlpatterns = [
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    *router.urls,
+]
+
+# Read endpoints for ASGI deployments, see async_views
+async_urlpatterns = [
+    path('portfolio/<int:pk>/', async_views.portfolio_detail, name='async-portfolio-detail'),
+    path('portfolio/<int:pk>/positions/', async_views.position_list, name='async-portfolio-positions'),
+    path('trade/', async_views.trade_list, name='async-trade-list'),
+]
@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class PortfoliotrackerappConfig(AppConfig):
     name = 'portfoliotrackerapp'
+
+    def ready(self):
+        # Connects the signal receivers and registers the system checks
+        from . import caching, position_book, trade_queue  # noqa: F401
+        from .database import configure_sqlite
+        connection_created.connect(configure_sqlite, dispatch_uid='configure_sqlite')
@@ -0,0 +1,172 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+from django.http import JsonResponse
+
+from .caching import sync_version
+from .signals import positions_changed
+from .views import PortfolioViewset, TradeViewset
+
+"""
+Async read endpoints for ASGI servers. The ORM of this Django version is synchronous, so each request runs the
+regular view on a bounded pool of database threads, and only holds a thread while it actually queries. Long-polls
+wait on the event loop and take no thread while the portfolio is unchanged.
+"""
+
+DEFAULT_ASYNC_API = {
+    'DB_WORKERS': 16,
+    'LONG_POLL_TIMEOUT': 60,
+    'LONG_POLL_INTERVAL': 5,
+    'STREAM_HEARTBEAT': 15,
+    'STREAM_QUEUE_SIZE': 100,
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_config():
+    return {**DEFAULT_ASYNC_API, **getattr(settings, 'ASYNC_API', {})}
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_config()['DB_WORKERS'], thread_name_prefix='async-db')
+        return _executor
+
+
+def _run(func, *args, **kwargs):
+    # Pool threads keep their connection between requests, so connections past CONN_MAX_AGE or broken are
+    # recycled here, as Django does at the start and end of every synchronous request
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_in_db_thread(func, *args, **kwargs):
+    # Context variables, such as the request metrics, follow the request into the pool thread
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        get_executor(), lambda: context.run(_run, func, *args, **kwargs))
+
+
+def render(view, request, **kwargs):
+    response = view(request, **kwargs)
+    if hasattr(response, 'render'):
+        response.render()
+    return response
+
+
+def async_view(view):
+    """Async entry point running a synchronous DRF view on the database threads"""
+    async def wrapper(request, **kwargs):
+        return await run_in_db_thread(render, view, request, **kwargs)
+    # csrf_exempt() would wrap the coroutine function in a synchronous one, DRF views handle CSRF themselves
+    wrapper.csrf_exempt = True
+    return wrapper
+
+
+class PortfolioWatchers:
+    """Events of the long-polls waiting on each portfolio, set from any thread when its positions change"""
+
+    def __init__(self):
+        self._watchers = {}
+        self._lock = threading.Lock()
+
+    def add(self, portfolio_id):
+        watcher = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._watchers.setdefault(str(portfolio_id), set()).add(watcher)
+        return watcher
+
+    def remove(self, portfolio_id, watcher):
+        with self._lock:
+            watchers = self._watchers.get(str(portfolio_id), set())
+            watchers.discard(watcher)
+            if not watchers:
+                self._watchers.pop(str(portfolio_id), None)
+
+    def notify(self, portfolio_ids):
+        with self._lock:
+            watchers = [w for pk in portfolio_ids for w in self._watchers.get(str(pk), ())]
+        for loop, event in watchers:
+            loop.call_soon_threadsafe(event.set)
+
+
+watchers = PortfolioWatchers()
+
+
+@receiver(positions_changed)
+def wake_long_polls(sender, portfolio_ids, **kwargs):
+    watchers.notify(portfolio_ids)
+
+
+async def wait_for_change(portfolio_id, etag, timeout):
+    """
+    Waits until the portfolio no longer matches `etag` or the timeout passes. Changes made in this process wake
+    the wait right away, the portfolio's summary is re-read every LONG_POLL_INTERVAL seconds for changes made by
+    other processes.
+    """
+    deadline = time.monotonic() + timeout
+    watcher = watchers.add(portfolio_id)
+    try:
+        while True:
+            version = await run_in_db_thread(sync_version, portfolio_id)
+            remaining = deadline - time.monotonic()
+            if f'"{portfolio_id}-{version}"' not in etag or remaining <= 0:
+                return
+            watcher[1].clear()
+            try:
+                await asyncio.wait_for(watcher[1].wait(), min(remaining, get_config()['LONG_POLL_INTERVAL']))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        watchers.remove(portfolio_id, watcher)
+
+
+portfolio_view = PortfolioViewset.as_view({'get': 'retrieve'})
+position_list_view = PortfolioViewset.as_view({'get': 'positions'})
+trade_list_view = TradeViewset.as_view({'get': 'list'})
+
+
+async def portfolio_detail(request, pk):
+    """
+    Portfolio detail, same as /portfolio/1/. Long-poll with ?wait=30 and the ETag of the previous response in
+    If-None-Match: the response comes as soon as a trade changes the portfolio, or as a 304 after `wait` seconds.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    etag = request.headers.get('If-None-Match')
+    if etag and request.GET.get('wait'):
+        try:
+            wait = float(request.GET['wait'])
+        except ValueError:
+            return JsonResponse({'wait': ['Expected a number of seconds']}, status=400)
+        await wait_for_change(pk, etag, max(0.0, min(wait, get_config()['LONG_POLL_TIMEOUT'])))
+    return await run_in_db_thread(render, portfolio_view, request, pk=pk)
+
+
+portfolio_detail.csrf_exempt = True
+position_list = async_view(position_list_view)
+trade_list = async_view(trade_list_view)
+
+
+@receiver(setting_changed)
+def reset_executor(setting, **kwargs):
+    global _executor
+    if setting == 'ASYNC_API':
+        with _executor_lock:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = None
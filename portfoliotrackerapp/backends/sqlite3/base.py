@@ -0,0 +1,12 @@
+from django.db.backends.sqlite3 import base
+
+"""
+SQLite backend whose transactions take the write lock when they begin. Under a deferred BEGIN the lock is taken by
+the first write, after the transaction may have read, and writers queued on it can starve past the busy timeout.
+With BEGIN IMMEDIATE they wait for it on the busy timeout before doing anything.
+"""
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
@@ -0,0 +1,141 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import Portfolio, PortfolioGroup, PortfolioSummary
+from .replicas import current_read_alias, get_config as get_replica_config
+from .signals import positions_changed
+
+"""
+Cached portfolio responses. Every portfolio and portfolio group has a version token which trade changes replace.
+Versions expire like the responses, so changes that never reach this cache are served at most TIMEOUT seconds late
+"""
+
+DEFAULT_PORTFOLIO_CACHE = {
+    'ALIAS': 'default',
+    'TIMEOUT': 300,
+}
+LIST_SCOPE = 'list'
+
+
+def get_config():
+    return {**DEFAULT_PORTFOLIO_CACHE, **getattr(settings, 'PORTFOLIO_CACHE', {})}
+
+
+def get_cache():
+    return caches[get_config()['ALIAS']]
+
+
+def version_key(scope):
+    return f'portfolio:version:{scope}'
+
+
+def get_version(scope):
+    cache = get_cache()
+    version = cache.get(version_key(scope))
+    if version is None:
+        cache.add(version_key(scope), uuid.uuid4().hex, get_config()['TIMEOUT'])
+        version = cache.get(version_key(scope))
+    return version
+
+
+def sync_version(portfolio_id):
+    """
+    Version of a portfolio, replaced first when its summary was updated since this cache last looked, so changes made
+    by processes that don't share the cache are noticed by whoever polls it
+    """
+    cache = get_cache()
+    key = f'portfolio:updated:{portfolio_id}'
+    updated_at = PortfolioSummary.objects.filter(portfolio_id=portfolio_id) \
+        .values_list('updated_at', flat=True).first()
+    seen = cache.get(key)
+    if seen != updated_at:
+        if seen is not None:
+            invalidate_portfolios([portfolio_id])
+        cache.set(key, updated_at, get_config()['TIMEOUT'])
+    return get_version(portfolio_id)
+
+
+def group_scope(group_id):
+    return f'group:{group_id}'
+
+
+def invalidate_portfolios(portfolio_ids):
+    """
+    Replaces the version of the portfolios, of the groups they belong to and of the portfolio list, orphaning their
+    cached responses
+    """
+    group_ids = PortfolioGroup.portfolios.through.objects.filter(portfolio__in=portfolio_ids) \
+        .values_list('portfoliogroup', flat=True).distinct()
+    scopes = (*portfolio_ids, *map(group_scope, group_ids), LIST_SCOPE)
+    get_cache().set_many({version_key(scope): uuid.uuid4().hex for scope in scopes}, get_config()['TIMEOUT'])
+
+
+def invalidate_groups(group_ids):
+    get_cache().set_many({version_key(group_scope(pk)): uuid.uuid4().hex for pk in group_ids},
+                          get_config()['TIMEOUT'])
+
+
+def cached_response(request, scope, render):
+    """
+    Serves a portfolio response from the cache. The ETag is the scope's version, so a client revalidating
+    with If-None-Match gets a 304 while nothing changed, without the response being built or read.
+    Responses read from a replica are cached and tagged apart, so clients pinned to the primary never get them.
+    """
+    version = get_version(scope)
+    alias = current_read_alias.get()
+    etag = f'"{scope}-{version}-{alias}"' if alias else f'"{scope}-{version}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+    cache = get_cache()
+    key = f'portfolio:response:{scope}:{version}:{alias or "primary"}:{request.get_full_path()}'
+    data = cache.get(key)
+    if data is None:
+        response = render()
+        if response.status_code != status.HTTP_200_OK:
+            return response
+        data = response.data
+        timeout = get_config()['TIMEOUT']
+        if alias is not None:
+            # A lagging replica may have served changes older than this version, so the response only lives as long
+            # as the replica may lag
+            timeout = min(timeout, get_replica_config()['MAX_LAG'])
+        cache.set(key, data, timeout)
+    return Response(data, headers={'ETag': etag})
+
+
+@receiver(positions_changed)
+def invalidate_on_positions_changed(sender, portfolio_ids, **kwargs):
+    invalidate_portfolios(portfolio_ids)
+
+
+@receiver(post_save, sender=Portfolio)
+@receiver(pre_delete, sender=Portfolio)
+@receiver(post_delete, sender=Portfolio)
+def invalidate_on_portfolio_changed(sender, instance, **kwargs):
+    # The groups of a deleted portfolio are only found before the delete removes it from them
+    invalidate_portfolios([instance.pk])
+
+
+@receiver(post_save, sender=PortfolioGroup)
+@receiver(post_delete, sender=PortfolioGroup)
+def invalidate_on_group_changed(sender, instance, **kwargs):
+    invalidate_groups([instance.pk])
+
+
+@receiver(m2m_changed, sender=PortfolioGroup.portfolios.through)
+def invalidate_on_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_groups([instance.pk])
+    # Changed from the portfolio side, where pk_set holds groups, except on clear
+    elif action in ('post_add', 'post_remove'):
+        invalidate_groups(pk_set)
+    elif action == 'pre_clear':
+        invalidate_portfolios([instance.pk])
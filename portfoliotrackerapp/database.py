@@ -0,0 +1,63 @@
+import re
+
+from django.conf import settings
+from django.db import OperationalError, transaction
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.views import exception_handler as drf_exception_handler
+
+"""
+Connection tuning. The PRAGMAs of the SQLITE_PRAGMAS setting run on every new SQLite connection. Write transactions
+that find the database locked past the busy timeout are retried, and answered with a 503 if they still fail.
+"""
+
+PRAGMA_NAME = re.compile(r'^[a-z_]+$')
+LOCK_RETRIES = 3
+
+
+class DatabaseBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'The database is busy, retry the request.'
+    default_code = 'database_busy'
+
+
+def is_database_locked(error):
+    return isinstance(error, OperationalError) and 'database is locked' in str(error)
+
+
+def retry_when_locked(write, retries=LOCK_RETRIES):
+    """
+    Calls `write`, which runs a transaction, again while it finds the database locked. Nothing is retried inside an
+    outer transaction, which the error leaves broken.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return write()
+        except OperationalError as error:
+            if not is_database_locked(error) or attempt == retries or transaction.get_connection().in_atomic_block:
+                raise
+
+
+def exception_handler(exc, context):
+    """DRF exception handler answering requests that found the database locked with a 503 rather than a 500"""
+    if is_database_locked(exc):
+        response = drf_exception_handler(DatabaseBusy(), context)
+        response['Retry-After'] = '1'
+        return response
+    return drf_exception_handler(exc, context)
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', {})
+    if not pragmas:
+        return
+    cursor = connection.connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            if not PRAGMA_NAME.match(name):
+                raise ValueError(f'Invalid SQLite PRAGMA name {name!r}')
+            cursor.execute(f'PRAGMA {name} = {value}')
+    finally:
+        cursor.close()
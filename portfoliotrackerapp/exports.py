@@ -0,0 +1,52 @@
+import csv
+import io
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+""" Streaming exports. Rows are read as tuples in chunks and written out as they arrive """
+
+CHUNK_SIZE = 2000
+
+TRADE_COLUMNS = ('id', 'portfolio', 'security', 'trade_type', 'count', 'trade_price', 'trade_time')
+POSITION_COLUMNS = ('portfolio', 'security', 'count', 'average_price')
+
+
+def csv_chunks(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for index, row in enumerate(rows, start=1):
+        writer.writerow([value.isoformat() if hasattr(value, 'isoformat') else value for value in row])
+        if index % CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_chunks(rows, columns):
+    encoder = DjangoJSONEncoder()
+    lines = []
+    for row in rows:
+        lines.append(encoder.encode(dict(zip(columns, row))))
+        if len(lines) == CHUNK_SIZE:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def stream_export(queryset, columns, export_format, filename):
+    """
+    Streams the given columns of a queryset as CSV or NDJSON. Rows come from values_list over a chunked
+    iterator (a server-side cursor where the database has them), so no model instances are built and memory
+    stays flat however many rows there are.
+    """
+    rows = queryset.values_list(*columns).iterator(chunk_size=CHUNK_SIZE)
+    if export_format == 'csv':
+        response = StreamingHttpResponse(csv_chunks(rows, columns), content_type='text/csv; charset=utf-8')
+    else:
+        response = StreamingHttpResponse(ndjson_chunks(rows, columns), content_type='application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{export_format}"'
+    return response
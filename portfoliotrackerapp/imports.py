@@ -0,0 +1,130 @@
+"""
+Broker file imports. Files are streamed through generators, read → normalized → batched → ingested, so memory
+depends on the batch size and not on the file. Each batch is ingested like POST /trade/bulk/: checked for short
+selling, deduplicated on broker_trade_id and written with its positions in one transaction.
+"""
+import csv
+import json
+import os
+
+from .ingest import DUPLICATE_TRADE, ingest_trades
+
+# Column names of broker files, by the trade row field they hold
+COLUMNS = {
+    'broker_trade_id': ('broker_trade_id', 'trade_id', 'trade_no', 'order_id'),
+    'portfolio': ('portfolio', 'portfolio_id', 'account'),
+    'security': ('security', 'symbol', 'scrip', 'ticker'),
+    'trade_type': ('trade_type', 'side', 'buy_sell', 'type'),
+    'count': ('count', 'quantity', 'qty'),
+    'trade_price': ('trade_price', 'price', 'rate'),
+}
+TRADE_TYPES = {'B': 'B', 'BUY': 'B', 'S': 'S', 'SELL': 'S'}
+
+
+def read_rows(path, offset=0, encoding='utf-8'):
+    """
+    Yields (end offset, row dict) for the CSV rows of a file, starting at the byte offset of a row. The offset is
+    where the next row starts, so an import can resume there. Quoted fields may span lines.
+    """
+    with open(path, 'rb') as f:
+        header = next(csv.reader([f.readline().decode(encoding).lstrip('\ufeff')]), None)
+        if header is None:
+            return
+        header = [column.strip().lower().replace(' ', '_') for column in header]
+        if offset:
+            f.seek(offset)
+        position = [f.tell()]
+
+        def lines():
+            for line in iter(f.readline, b''):
+                position[0] += len(line)
+                yield line.decode(encoding)
+
+        for values in csv.reader(lines()):
+            if values:
+                yield position[0], dict(zip(header, values))
+
+
+def column_map(columns):
+    """Trade row field of every column of a file that holds one"""
+    fields = {}
+    for field, names in COLUMNS.items():
+        for name in names:
+            if name in columns:
+                fields[field] = name
+                break
+    return fields
+
+
+def normalize_rows(rows, portfolio=None):
+    """
+    Maps broker columns to trade row fields. Sides are accepted as B/S or BUY/SELL, and `portfolio` fills in files
+    without a portfolio column.
+    """
+    fields = None
+    for offset, row in rows:
+        if fields is None:
+            fields = column_map(row)
+        # Fields missing from short rows are left blank, for validation to reject the row
+        trade = {field: row.get(column, '').strip() for field, column in fields.items()}
+        if 'trade_type' in trade:
+            trade['trade_type'] = TRADE_TYPES.get(trade['trade_type'].upper(), trade['trade_type'])
+        for field in ('count', 'trade_price'):
+            if field in trade:
+                trade[field] = trade[field].replace(',', '') or None
+        if portfolio is not None:
+            trade['portfolio'] = portfolio
+        yield offset, trade
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ImportProgress:
+    """Counts of an import, saved as its checkpoint after every committed batch"""
+
+    def __init__(self, offset=0, rows=0, imported=0, duplicates=0, rejected=0):
+        self.offset = offset
+        self.rows = rows
+        self.imported = imported
+        self.duplicates = duplicates
+        self.rejected = rejected
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def save(self, path):
+        # Written aside and renamed, so a crash never leaves a partial checkpoint
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(vars(self), f)
+        os.replace(f'{path}.tmp', path)
+
+
+def import_batches(rows, progress, batch_size):
+    """
+    Ingests batches of (offset, trade row) pairs and advances `progress` past each. Yields the progress and the
+    rejected rows of every batch, as (row number, trade row, errors), once the batch is committed.
+    """
+    for batch in batches(rows, batch_size):
+        trades, errors = ingest_trades([trade for _, trade in batch])
+        rejected = []
+        for error in errors:
+            if error['errors'].get('broker_trade_id') == [DUPLICATE_TRADE]:
+                progress.duplicates += 1
+            else:
+                rejected.append((progress.rows + error['row'] + 1, batch[error['row']][1], error['errors']))
+        progress.imported += len(trades)
+        progress.rejected += len(rejected)
+        progress.rows += len(batch)
+        progress.offset = batch[-1][0]
+        yield progress, rejected
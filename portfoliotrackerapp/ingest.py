@@ -0,0 +1,144 @@
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from rest_framework.exceptions import ValidationError
+
+from .ledger import record_events, trade_event
+from .lots import record_lots
+from .models import *
+from .positions import apply_trade, lock_positions
+from .prices import get_prices
+from .summaries import apply_position_changes
+from .serializers import TradeRowSerializer
+
+""" Batched trade ingestion. Short selling is checked in memory and everything is written in one transaction """
+
+BATCH_SIZE = 1000
+INVALID_POSITION = 'This trade results in invalid position'
+DUPLICATE_TRADE = 'A trade with this broker trade id is already recorded'
+
+
+def bulk_create_trades(trades):
+    Trade.objects.bulk_create(trades, batch_size=BATCH_SIZE)
+    if trades and trades[0].pk is None:
+        # Backends that can't return ids from bulk inserts (SQLite on Django 3.x) hand out AUTOINCREMENT ids while
+        # this transaction holds the database write lock, so the newest rows are exactly the ones just inserted.
+        ids = Trade.objects.order_by('-id').values_list('id', flat=True)[:len(trades)]
+        for trade, pk in zip(trades, reversed(list(ids))):
+            trade.pk = trade.id = pk
+    return trades
+
+
+def ingest_trades(rows, atomic=False):
+    """
+    Validates and records a batch of trade rows given in trade order.
+
+    Rows are grouped by (portfolio, security) and checked for short selling against the stored positions in
+    memory, so the whole batch costs a handful of queries. Rows repeating the broker_trade_id of a recorded trade
+    or of an earlier row are reported as duplicates. Invalid rows are reported and skipped, or reject the
+    whole batch when `atomic` is set. Returns the created trades and a list of {'row': index, 'errors': ...}.
+    """
+    errors = []
+    accepted = []
+    # One serializer validates every row, as many=True would, so its fields are only built once
+    serializer = TradeRowSerializer()
+    for index, row in enumerate(rows):
+        try:
+            accepted.append((index, Trade(**serializer.run_validation(row))))
+        except ValidationError as exc:
+            errors.append({'row': index, 'errors': exc.detail})
+
+    # Rows without a price are booked at the market price, looked up in one batch
+    prices = get_prices({trade.security for _, trade in accepted if trade.trade_price is None})
+    for index, trade in accepted:
+        if trade.trade_price is None:
+            trade.trade_price = prices.get(trade.security)
+
+    # A concurrent request may open one of the new positions first, in which case the batch is checked again
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                return _record(accepted, list(errors), atomic)
+        except IntegrityError:
+            if attempt:
+                raise
+
+
+def _record(accepted, errors, atomic):
+    portfolio_ids = {trade.portfolio_id for _, trade in accepted}
+    securities = {trade.security for _, trade in accepted}
+    positions = {(p.portfolio_id, p.security): p
+                 for p in lock_positions(portfolio__in=portfolio_ids, security__in=securities)}
+    lot_methods = dict(Portfolio.objects.filter(pk__in=portfolio_ids).values_list('pk', 'lot_method'))
+
+    broker_trade_ids = {trade.broker_trade_id for _, trade in accepted if trade.broker_trade_id}
+    recorded = set(Trade.objects.filter(portfolio__in=portfolio_ids, broker_trade_id__in=broker_trade_ids)
+                   .values_list('portfolio', 'broker_trade_id')) if broker_trade_ids else set()
+
+    state = {key: (p.count, p.average_price) for key, p in positions.items()}
+    trades = []
+    snapshots = []
+    for index, trade in accepted:
+        if trade.portfolio_id not in lot_methods:
+            errors.append({'row': index, 'errors': {'portfolio': [f'Invalid pk "{trade.portfolio_id}" - '
+                                                                  f'object does not exist.']}})
+            continue
+        if trade.broker_trade_id and (trade.portfolio_id, trade.broker_trade_id) in recorded:
+            errors.append({'row': index, 'errors': {'broker_trade_id': [DUPLICATE_TRADE]}})
+            continue
+        if trade.trade_price is None:
+            errors.append({'row': index, 'errors': {'trade_price': ['No market price available for this security']}})
+            continue
+        key = (trade.portfolio_id, trade.security)
+        if trade.trade_type == Trade.SELL and key not in state:
+            count = -1
+        else:
+            count, average_price = apply_trade(*state.get(key, (0, 0)), trade.trade_type, trade.count,
+                                               trade.trade_price)
+        if count < 0:
+            errors.append({'row': index, 'errors': {'non_field_errors': [INVALID_POSITION]}})
+            continue
+        state[key] = (count, average_price)
+        if trade.broker_trade_id:
+            recorded.add((trade.portfolio_id, trade.broker_trade_id))
+        trades.append(trade)
+        snapshots.append((count, average_price))
+
+    errors.sort(key=lambda error: error['row'])
+    if atomic and errors:
+        return [], errors
+
+    bulk_create_trades(trades)
+    record_events([trade_event(trade, TradeEvent.CREATE) for trade in trades])
+    record_lots(trades, lot_methods)
+    PositionSnapshot.objects.bulk_create(
+        [PositionSnapshot(trade_id=trade.pk, portfolio_id=trade.portfolio_id, security=trade.security,
+                          trade_time=trade.trade_time, count=count, average_price=average_price)
+         for trade, (count, average_price) in zip(trades, snapshots)],
+        batch_size=BATCH_SIZE)
+
+    touched = {(trade.portfolio_id, trade.security) for trade in trades}
+    changed = []
+    new = []
+    summary_changes = defaultdict(list)
+    for key in touched:
+        count, average_price = state[key]
+        if key in positions:
+            position = positions[key]
+            summary_changes[key[0]].append((key[1], position.count, position.average_price, count, average_price))
+            position.count, position.average_price = count, average_price
+            position.version += 1
+            changed.append(position)
+        else:
+            summary_changes[key[0]].append((key[1], 0, 0, count, average_price))
+            new.append(Position(portfolio_id=key[0], security=key[1], count=count, average_price=average_price))
+    Position.objects.bulk_update(changed, ['count', 'average_price', 'version'], batch_size=BATCH_SIZE)
+    Position.objects.bulk_create(new, batch_size=BATCH_SIZE)
+
+    last_trade_times = {}
+    for trade in trades:
+        last_trade_times[trade.portfolio_id] = max(trade.trade_time, last_trade_times.get(trade.portfolio_id,
+                                                                                          trade.trade_time))
+    for portfolio_id, changes in summary_changes.items():
+        apply_position_changes(portfolio_id, changes, last_trade_time=last_trade_times[portfolio_id])
+    return trades, errors
@@ -0,0 +1,129 @@
+from django.db import transaction
+from django.db.models import Max
+
+from .models import *
+from .positions import apply_trade, lock_positions, same_position
+from .summaries import rebuild_summaries
+
+"""
+Trade ledger. Trade writes append events, and the projector folds them back into positions, starting from the
+latest checkpoint of a portfolio
+"""
+
+EVENT_BATCH_SIZE = 10000
+
+
+def trade_event(trade, event_type, previous_security=None):
+    return TradeEvent(portfolio_id=trade.portfolio_id, trade_id=trade.pk, event_type=event_type,
+                      security=trade.security, previous_security=previous_security, count=trade.count,
+                      trade_type=trade.trade_type, trade_price=trade.trade_price, trade_time=trade.trade_time)
+
+
+def record_events(events):
+    TradeEvent.objects.bulk_create(events, batch_size=EVENT_BATCH_SIZE)
+
+
+def latest_checkpoint(portfolio_id):
+    return LedgerCheckpoint.objects.filter(portfolio_id=portfolio_id).order_by('-last_event_id').first()
+
+
+def project_positions(portfolio_id, checkpoint=None):
+    """
+    Positions of a portfolio folded from its trade events, continuing from `checkpoint` when given.
+    Returns ({security: (count, average_price)}, id of the last event folded).
+
+    New trades always land at the end of their stream, so their events are folded onto the checkpoint as they
+    come. Amendments and cancellations rewrite a stream from the middle, so the streams they touch are folded
+    again from the latest state of each of their trades.
+    """
+    state, after = {}, 0
+    if checkpoint is not None:
+        state = {security: tuple(position) for security, position in checkpoint.positions.items()}
+        after = checkpoint.last_event_id
+    last = TradeEvent.objects.filter(portfolio_id=portfolio_id, id__gt=after).aggregate(last=Max('id'))['last']
+    if last is None:
+        return state, after
+    events = TradeEvent.objects.filter(portfolio_id=portfolio_id, id__gt=after, id__lte=last)
+
+    dirty = set()
+    for security, previous_security in events.exclude(event_type=TradeEvent.CREATE) \
+            .values_list('security', 'previous_security'):
+        dirty.update(s for s in (security, previous_security) if s)
+
+    creates = events.filter(event_type=TradeEvent.CREATE).exclude(security__in=dirty).order_by('id') \
+        .values_list('security', 'trade_type', 'count', 'trade_price')
+    for security, trade_type, count, trade_price in creates.iterator(chunk_size=EVENT_BATCH_SIZE):
+        state[security] = apply_trade(*state.get(security, (0, 0)), trade_type, count, trade_price)
+
+    if dirty:
+        for security in dirty:
+            state.pop(security, None)
+        for security, trade_type, count, trade_price in live_trades(portfolio_id, dirty, last):
+            state[security] = apply_trade(*state.get(security, (0, 0)), trade_type, count, trade_price)
+    return state, last
+
+
+def live_trades(portfolio_id, securities, last_event_id):
+    """
+    The trades on the given securities as of an event, in stream order, as (security, trade_type, count,
+    trade_price) tuples. A trade is in the state of its latest event, unless that is a cancellation.
+    """
+    events = TradeEvent.objects.filter(portfolio_id=portfolio_id, id__lte=last_event_id)
+    touched = events.filter(security__in=securities).values('trade_id')
+    latest = {}
+    for event in events.filter(trade_id__in=touched).order_by('id') \
+            .values_list('trade_id', 'event_type', 'security', 'trade_type', 'count', 'trade_price', 'trade_time') \
+            .iterator(chunk_size=EVENT_BATCH_SIZE):
+        latest[event[0]] = event
+    trades = sorted((event for event in latest.values() if event[1] != TradeEvent.CANCEL and event[2] in securities),
+                    key=lambda event: (event[6], event[0]))
+    return [(security, trade_type, count, trade_price) for _, _, security, trade_type, count, trade_price, _ in trades]
+
+
+def checkpoint_portfolio(portfolio_id):
+    """Records a checkpoint of the portfolio at its latest event. Returns None when there is nothing new"""
+    with transaction.atomic():
+        # Holds off trade writes on the portfolio, so no event commits below the checkpoint afterwards
+        lock_positions(portfolio_id=portfolio_id)
+        previous = latest_checkpoint(portfolio_id)
+        state, last = project_positions(portfolio_id, previous)
+        if previous is not None and last == previous.last_event_id:
+            return None
+        return LedgerCheckpoint.objects.create(
+            portfolio_id=portfolio_id, last_event_id=last,
+            positions={security: [count, average_price] for security, (count, average_price) in state.items()})
+
+
+def position_drift(portfolio_id, state):
+    """Positions of a portfolio that differ from a projection, as {security: ((count, average_price), projected)}"""
+    stored = {security: (count, average_price) for security, count, average_price in
+              Position.objects.filter(portfolio_id=portfolio_id).values_list('security', 'count', 'average_price')}
+    drift = {}
+    for security in stored.keys() | state.keys():
+        have, want = stored.get(security, (0, 0)), state.get(security, (0, 0))
+        if not same_position(have, want):
+            drift[security] = (have, want)
+    return drift
+
+
+def rebuild_positions(portfolio_id, use_checkpoint=True):
+    """Overwrites the positions of a portfolio with its ledger projection. Returns the securities that changed"""
+    with transaction.atomic():
+        positions = {p.security: p for p in lock_positions(portfolio_id=portfolio_id)}
+        state, _ = project_positions(portfolio_id, latest_checkpoint(portfolio_id) if use_checkpoint else None)
+        drift = position_drift(portfolio_id, state)
+        changed, new = [], []
+        for security, (_, (count, average_price)) in drift.items():
+            if security in positions:
+                position = positions[security]
+                position.count, position.average_price = count, average_price
+                position.version += 1
+                changed.append(position)
+            else:
+                new.append(Position(portfolio_id=portfolio_id, security=security, count=count,
+                                    average_price=average_price))
+        Position.objects.bulk_update(changed, ['count', 'average_price', 'version'], batch_size=EVENT_BATCH_SIZE)
+        Position.objects.bulk_create(new, batch_size=EVENT_BATCH_SIZE)
+        if drift:
+            rebuild_summaries([portfolio_id])
+    return sorted(drift)
@@ -0,0 +1,165 @@
+import heapq
+from collections import defaultdict, deque
+
+from django.db.models import Q, Sum
+
+from .models import *
+
+""" Lot level cost basis. Buys open lots and sells relieve them in the order of the portfolio's lot method """
+
+
+class LotBook:
+    """
+    The open lots of a (portfolio, security) stream, queued in the order sells relieve them. FIFO and LIFO lots sit
+    in a deque relieved from either end, highest cost lots in a heap, so a sell costs O(lots it relieves) (times log n
+    for the heap) however long the history is.
+    """
+
+    def __init__(self, method, lots=()):
+        self.method = method
+        self.lots = [] if method == Portfolio.HIFO else deque()
+        self.changed = {}
+        self.closures = []
+        # Lots come in acquisition order
+        for lot in lots:
+            self._push(lot)
+
+    def _push(self, lot):
+        if self.method == Portfolio.HIFO:
+            heapq.heappush(self.lots, (-lot.price, lot.acquired_at, lot.pk, lot))
+        else:
+            self.lots.append(lot)
+
+    def _next(self):
+        if self.method == Portfolio.HIFO:
+            return self.lots[0][-1]
+        return self.lots[0] if self.method == Portfolio.FIFO else self.lots[-1]
+
+    def _pop(self):
+        if self.method == Portfolio.HIFO:
+            heapq.heappop(self.lots)
+        elif self.method == Portfolio.FIFO:
+            self.lots.popleft()
+        else:
+            self.lots.pop()
+
+    def apply(self, trade):
+        if trade.trade_type == Trade.BUY:
+            if trade.count:
+                lot = Lot(trade_id=trade.pk, portfolio_id=trade.portfolio_id, security=trade.security,
+                          acquired_at=trade.trade_time, quantity=trade.count, remaining=trade.count,
+                          price=trade.trade_price)
+                self._push(lot)
+                self.changed[lot.pk] = lot
+            return
+        count = trade.count
+        while count and self.lots:
+            lot = self._next()
+            relieved = min(count, lot.remaining)
+            lot.remaining -= relieved
+            count -= relieved
+            self.changed[lot.pk] = lot
+            self.closures.append(LotClosure(lot_id=lot.pk, sell_trade_id=trade.pk, count=relieved,
+                                            sell_price=trade.trade_price,
+                                            realized_pnl=(trade.trade_price - lot.price) * relieved,
+                                            closed_at=trade.trade_time))
+            if not lot.remaining:
+                self._pop()
+
+
+def save_books(books, existing=()):
+    """Writes the lots opened or relieved and the closures of lot books. `existing` are the pks of stored lots"""
+    existing = set(existing)
+    changed = [lot for book in books for lot in book.changed.values()]
+    Lot.objects.bulk_update([lot for lot in changed if lot.pk in existing], ['remaining'], batch_size=1000)
+    Lot.objects.bulk_create([lot for lot in changed if lot.pk not in existing], batch_size=1000)
+    LotClosure.objects.bulk_create([closure for book in books for closure in book.closures], batch_size=1000)
+
+
+def record_lots(trades, lot_methods):
+    """
+    Applies new trades, which land at the end of their streams, on the open lots of their streams.
+    `lot_methods` maps the portfolios of the trades to their lot method.
+    """
+    streams = defaultdict(list)
+    for trade in trades:
+        streams[(trade.portfolio_id, trade.security)].append(trade)
+    # Buys only open lots, so only streams with sells need their open lots
+    selling = {key for key, stream_trades in streams.items()
+               if any(trade.trade_type == Trade.SELL for trade in stream_trades)}
+    lots = defaultdict(list)
+    existing = []
+    if selling:
+        for lot in Lot.objects.filter(portfolio__in={key[0] for key in selling},
+                                      security__in={key[1] for key in selling},
+                                      remaining__gt=0).order_by('acquired_at', 'trade_id'):
+            if (lot.portfolio_id, lot.security) in selling:
+                lots[(lot.portfolio_id, lot.security)].append(lot)
+                existing.append(lot.pk)
+
+    books = []
+    for key, stream_trades in streams.items():
+        book = LotBook(lot_methods[key[0]], lots[key])
+        for trade in stream_trades:
+            book.apply(trade)
+        books.append(book)
+    save_books(books, existing)
+
+
+def rebuild_lots(portfolio_id, securities=None):
+    """Replays the lots of the given streams of a portfolio, or all of them, from their trades"""
+    lot_method = Portfolio.objects.values_list('lot_method', flat=True).get(pk=portfolio_id)
+    lots = Lot.objects.filter(portfolio_id=portfolio_id)
+    trades = Trade.objects.filter(portfolio_id=portfolio_id)
+    if securities is not None:
+        lots = lots.filter(security__in=securities)
+        trades = trades.filter(security__in=securities)
+    lots.delete()
+
+    book = None
+    stream = None
+    for trade in trades.order_by('security', 'trade_time', 'id').iterator(chunk_size=2000):
+        if trade.security != stream:
+            if book is not None:
+                save_books([book])
+            book, stream = LotBook(lot_method), trade.security
+        book.apply(trade)
+    if book is not None:
+        save_books([book])
+
+
+def rewind_lots(portfolio_id, securities, since, exclude=None):
+    """
+    Replays the lots of the given streams of a portfolio from the trade `since` on, leaving out the `exclude` trade,
+    for changes to a trade in the middle of its stream. Sells from `since` on give back what they relieved and the
+    lots opened since are dropped, so this costs O(trades since) rather than O(history).
+    """
+    lot_method = Portfolio.objects.values_list('lot_method', flat=True).get(pk=portfolio_id)
+    lots = Lot.objects.filter(portfolio_id=portfolio_id, security__in=securities)
+    closures = LotClosure.objects.filter(lot__portfolio_id=portfolio_id, lot__security__in=securities) \
+        .filter(Q(closed_at__gt=since.trade_time) | Q(closed_at=since.trade_time, sell_trade_id__gte=since.pk))
+    restored = dict(closures.values_list('lot').annotate(count=Sum('count')).order_by())
+    closures.delete()
+    lots.filter(Q(acquired_at__gt=since.trade_time) | Q(acquired_at=since.trade_time, trade_id__gte=since.pk)).delete()
+
+    open_lots = defaultdict(list)
+    for lot in lots.filter(Q(remaining__gt=0) | Q(pk__in=restored)).order_by('acquired_at', 'trade_id'):
+        lot.remaining += restored.get(lot.pk, 0)
+        open_lots[lot.security].append(lot)
+    trades = Trade.objects.filter(portfolio_id=portfolio_id, security__in=securities) \
+        .filter(Q(trade_time__gt=since.trade_time) | Q(trade_time=since.trade_time, id__gte=since.pk))
+    if exclude is not None:
+        trades = trades.exclude(pk=exclude.pk)
+    tails = defaultdict(list)
+    for trade in trades.order_by('trade_time', 'id'):
+        tails[trade.security].append(trade)
+
+    books = []
+    for security in securities:
+        book = LotBook(lot_method, open_lots[security])
+        # Lots that got shares back are written even if no sell relieves them again
+        book.changed.update((lot.pk, lot) for lot in open_lots[security] if lot.pk in restored)
+        for trade in tails[security]:
+            book.apply(trade)
+        books.append(book)
+    save_books(books, [lot.pk for security in securities for lot in open_lots[security]])
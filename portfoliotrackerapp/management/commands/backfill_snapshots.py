@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from portfoliotrackerapp.models import PositionSnapshot, Trade
+from portfoliotrackerapp.positions import apply_trade
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds position snapshots for every existing trade by replaying each (portfolio, security) stream'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--portfolio', type=int, action='append', dest='portfolios',
+                            help='Only backfill the given portfolio id. Can be repeated.')
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        trades = Trade.objects.all()
+        snapshots = PositionSnapshot.objects.all()
+        if options['portfolios']:
+            trades = trades.filter(portfolio__in=options['portfolios'])
+            snapshots = snapshots.filter(portfolio__in=options['portfolios'])
+
+        rows = trades.order_by('portfolio', 'security', 'trade_time', 'id') \
+            .values_list('id', 'portfolio', 'security', 'trade_time', 'trade_type', 'count', 'trade_price')
+
+        created = 0
+        with transaction.atomic():
+            snapshots.delete()
+            stream, count, average_price = None, 0, 0
+            batch = []
+            for trade_id, portfolio_id, security, trade_time, trade_type, trade_count, trade_price in \
+                    rows.iterator(chunk_size=batch_size):
+                if stream != (portfolio_id, security):
+                    stream, count, average_price = (portfolio_id, security), 0, 0
+                count, average_price = apply_trade(count, average_price, trade_type, trade_count, trade_price)
+                if count < 0:
+                    self.stderr.write(f'Trade {trade_id} makes position on {security} in portfolio {portfolio_id} '
+                                      f'negative, clamping snapshot to 0')
+                    count = 0
+                batch.append(PositionSnapshot(trade_id=trade_id, portfolio_id=portfolio_id, security=security,
+                                              trade_time=trade_time, count=count, average_price=average_price))
+                if len(batch) >= batch_size:
+                    PositionSnapshot.objects.bulk_create(batch)
+                    created += len(batch)
+                    batch = []
+            PositionSnapshot.objects.bulk_create(batch)
+            created += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f'Created {created} position snapshots'))
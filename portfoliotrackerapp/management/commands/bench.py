@@ -0,0 +1,233 @@
+import datetime
+import json
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from portfoliotrackerapp.caching import invalidate_portfolios
+from portfoliotrackerapp.ingest import ingest_trades
+from portfoliotrackerapp.models import Portfolio, Trade
+
+
+def percentile(sorted_values, fraction):
+    # Nearest rank, so every reported latency is one that was actually measured
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))]
+
+
+class Command(BaseCommand):
+    help = 'Seeds a throwaway database and reports latency, throughput and query counts of the trade and ' \
+           'portfolio APIs as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--portfolios', type=int, default=10)
+        parser.add_argument('--securities', type=int, default=20)
+        parser.add_argument('--trades', type=int, default=5000, help='Trades seeded before measuring')
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests per endpoint')
+        parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests per endpoint')
+        parser.add_argument('--endpoint', action='append', dest='endpoints',
+                            help='Only run the given endpoint. Can be repeated.')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Clients sending requests at the same time, each from its own thread and database '
+                                 'connection. Throughput is then measured over the wall clock.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+        parser.add_argument('--compare', help='JSON results of a previous run to report p95 changes against')
+        parser.add_argument('--current-db', action='store_true',
+                            help='Seed and measure the configured database instead of a throwaway one. '
+                                 'Seeded data is left behind.')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        endpoints = self.endpoints()
+        selected = options['endpoints'] or list(endpoints)
+        unknown = set(selected) - set(endpoints)
+        if options['requests'] < 1:
+            raise CommandError('--requests must be at least 1')
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+        if unknown:
+            raise CommandError(f'Unknown endpoints {", ".join(sorted(unknown))}, choose from {", ".join(endpoints)}')
+
+        old_name = old_test_settings = None
+        if not options['current_db']:
+            old_name, old_test_settings = connection.settings_dict['NAME'], connection.settings_dict['TEST']
+            directory = tempfile.mkdtemp()
+            connection.settings_dict['TEST'] = {**old_test_settings, 'NAME': os.path.join(directory, 'bench.sqlite3')}
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            seeded = self.seed(options['portfolios'], options['securities'], options['trades'])
+            # Measured like production, without DEBUG
+            with override_settings(DEBUG=False, ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                results = {name: self.measure(endpoints[name], options['requests'], options['warmup'],
+                                              options['concurrency'])
+                           for name in selected}
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                connection.settings_dict['TEST'] = old_test_settings
+                os.rmdir(directory)
+
+        report = {
+            'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'database_settings': {key: connection.settings_dict.get(key) for key in ('CONN_MAX_AGE', 'OPTIONS')},
+            'sqlite_pragmas': getattr(settings, 'SQLITE_PRAGMAS', {}),
+            'config': {key: options[key] for key in ('portfolios', 'securities', 'requests', 'warmup', 'concurrency',
+                                                     'seed')},
+            'seeded_trades': seeded,
+            'results': results,
+        }
+        if options['compare']:
+            self.compare(report, options['compare'])
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            for name, result in results.items():
+                self.stdout.write(f'{name:24} p50 {result["p50_ms"]:8.2f}ms  p95 {result["p95_ms"]:8.2f}ms  '
+                                  f'p99 {result["p99_ms"]:8.2f}ms  {result["throughput_rps"]:8.1f} req/s  '
+                                  f'{result["queries_mean"]:6.1f} queries')
+        else:
+            self.stdout.write(output)
+
+    def seed(self, portfolios, securities, trades):
+        """Seeds trades through the bulk ingestion path, so positions, snapshots and summaries are all written"""
+        self.portfolio_ids = [Portfolio.objects.create(name=f'Bench portfolio {index}').pk
+                              for index in range(portfolios)]
+        self.securities = [f'SEC{index:04d}' for index in range(securities)]
+        held = {}
+        rows = []
+        for _ in range(trades):
+            key = (self.rng.choice(self.portfolio_ids), self.rng.choice(self.securities))
+            count = self.rng.randint(1, 100)
+            trade_type = 'S' if held.get(key, 0) >= count and self.rng.random() < 0.3 else 'B'
+            held[key] = held.get(key, 0) + (count if trade_type == 'B' else -count)
+            rows.append({'portfolio': key[0], 'security': key[1], 'count': count, 'trade_type': trade_type,
+                         'trade_price': round(self.rng.uniform(50, 500), 2)})
+
+        self.buy_ids = []
+        for start in range(0, len(rows), 1000):
+            trades, errors = ingest_trades(rows[start:start + 1000], atomic=True)
+            if errors:
+                raise CommandError(f'Seeding failed: {errors[:3]}')
+            self.buy_ids += [trade.pk for trade in trades if trade.trade_type == Trade.BUY]
+        return len(rows)
+
+    def endpoints(self):
+        """
+        Request makers of each endpoint, returning (method, path, data, uncache) for every call. Cached responses
+        of the portfolios in `uncache` are dropped before the call, so the serializers are measured.
+        """
+        def new_trade():
+            return ('post', '/api/v1/trade/', {
+                'portfolio': self.rng.choice(self.portfolio_ids), 'security': self.rng.choice(self.securities),
+                'count': self.rng.randint(1, 100), 'trade_type': 'B', 'trade_price': self.rng.uniform(50, 500),
+            }, None)
+
+        def update_trade():
+            trade = Trade.objects.only('count').get(pk=self.rng.choice(self.buy_ids))
+            return ('patch', f'/api/v1/trade/{trade.pk}/', {'count': trade.count + 1}, None)
+
+        def portfolio(suffix='', uncached=False):
+            def request():
+                pk = self.rng.choice(self.portfolio_ids)
+                return 'get', f'/api/v1/portfolio/{pk}/{suffix}', None, [pk] if uncached else None
+            return request
+
+        return {
+            'trade_create': new_trade,
+            'trade_update': update_trade,
+            'trade_list': lambda: ('get', f'/api/v1/trade/?portfolio={self.rng.choice(self.portfolio_ids)}',
+                                   None, None),
+            'portfolio_detail': portfolio(),
+            'portfolio_detail_uncached': portfolio(uncached=True),
+            'portfolio_list_uncached': lambda: ('get', '/api/v1/portfolio/', None, []),
+            'portfolio_positions': portfolio('positions/'),
+            'portfolio_analytics': portfolio('analytics/?freq=W'),
+        }
+
+    def measure(self, endpoint, requests, warmup, concurrency=1):
+        latencies = []
+        queries = []
+        statuses = []
+        lock = threading.Lock()
+
+        def client(calls, measured):
+            # Test client errors become 500 responses, which concurrent writers get once the busy timeout runs out
+            browser = Client(raise_request_exception=False)
+            for _ in range(calls):
+                method, path, data, uncache = endpoint()
+                if uncache is not None:
+                    # Also drops the portfolio list
+                    invalidate_portfolios(uncache)
+                kwargs = {'data': json.dumps(data), 'content_type': 'application/json'} if data is not None else {}
+                with CaptureQueriesContext(connections['default']) as captured:
+                    started = time.perf_counter()
+                    response = getattr(browser, method)(path, **kwargs)
+                    elapsed = time.perf_counter() - started
+                if measured:
+                    with lock:
+                        statuses.append(response.status_code)
+                        latencies.append(elapsed)
+                        queries.append(len(captured))
+
+        client(warmup, False)
+        started = time.perf_counter()
+        if concurrency == 1:
+            client(requests, True)
+        else:
+            def run(calls):
+                try:
+                    client(calls, True)
+                finally:
+                    connections.close_all()
+            threads = [threading.Thread(target=run, args=(requests // concurrency + (index < requests % concurrency),))
+                       for index in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        wall_time = time.perf_counter() - started
+
+        latencies.sort()
+        return {
+            'requests': requests,
+            'errors': sum(status >= 400 for status in statuses),
+            'server_errors': sum(status >= 500 for status in statuses),
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'mean_ms': sum(latencies) / len(latencies) * 1000,
+            'throughput_rps': len(latencies) / (sum(latencies) if concurrency == 1 else wall_time),
+            'queries_mean': sum(queries) / len(queries),
+            'queries_max': max(queries),
+        }
+
+    def compare(self, report, path):
+        with open(path) as f:
+            previous = json.load(f)['results']
+        for name, result in report['results'].items():
+            if name in previous:
+                change = (result['p95_ms'] - previous[name]['p95_ms']) / previous[name]['p95_ms']
+                result['p95_change'] = change
+                throughput_change = (result['throughput_rps'] - previous[name]['throughput_rps']) \
+                    / previous[name]['throughput_rps']
+                result['throughput_change'] = throughput_change
+                self.stderr.write(f'{name:24} p95 {previous[name]["p95_ms"]:8.2f}ms -> {result["p95_ms"]:8.2f}ms '
+                                  f'({change:+.1%})  throughput {previous[name]["throughput_rps"]:8.1f} -> '
+                                  f'{result["throughput_rps"]:8.1f} req/s ({throughput_change:+.1%})')
@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max
+from django.utils import timezone
+
+from portfoliotrackerapp.models import Portfolio, Position, PositionSnapshot, QueuedTrade, Trade
+from portfoliotrackerapp.positions import placed_after, placed_before, snapshots_as_of
+
+
+def hot_queries(portfolio_id, security, trade_time, trade_id):
+    """The queries behind trade writes, replays and reads, for the given point of a trade stream"""
+    stream = Trade.objects.filter(portfolio=portfolio_id, security=security)
+    return {
+        'trade create validation': Position.objects.filter(portfolio=portfolio_id, security=security),
+        'stream replay snapshot': PositionSnapshot.objects
+            .filter(placed_before(trade_time, trade_id, 'trade_id'), portfolio=portfolio_id, security=security)
+            .order_by('-trade_time', '-trade_id')[:1],
+        'stream replay trades': stream.filter(placed_after(trade_time, trade_id)).order_by('trade_time', 'id'),
+        'trade list by portfolio': Trade.objects.filter(portfolio=portfolio_id).order_by('trade_time', 'id')[:100],
+        'trade list by stream': stream.order_by('trade_time', 'id')[:100],
+        'trade list': Trade.objects.order_by('trade_time', 'id')[:100],
+        'analytics trades': Trade.objects.filter(portfolio=portfolio_id, trade_time__lt=trade_time)
+            .order_by('trade_time', 'id'),
+        'last trade time': Trade.objects.filter(portfolio=portfolio_id).values('portfolio')
+            .annotate(last=Max('trade_time')).order_by(),
+        'portfolio positions': Position.objects.filter(portfolio=portfolio_id).order_by('security'),
+        'positions as of': snapshots_as_of(portfolio_id, trade_time),
+        'trade queue batch': QueuedTrade.objects.filter(status=QueuedTrade.PENDING).order_by('id')[:500],
+    }
+
+
+def full_scans(plan):
+    """Plan lines that read a whole table or sort rows outside an index"""
+    if connection.vendor == 'sqlite':
+        return [line for line in plan.splitlines()
+                if ('SCAN' in line and 'INDEX' not in line) or 'TEMP B-TREE' in line]
+    if connection.vendor == 'postgresql':
+        return [line for line in plan.splitlines() if 'Seq Scan' in line or 'Sort' in line.split('(')[0]]
+    return []
+
+
+class Command(BaseCommand):
+    help = 'Prints the EXPLAIN plan of every hot trade and position query, to check which indexes they use'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Fail if a hot query scans a table or sorts outside an index. On PostgreSQL, '
+                                 'run ANALYZE on a populated database first, as tiny tables are always scanned.')
+
+    def handle(self, *args, **options):
+        trade = Trade.objects.order_by('-id').first()
+        if trade is not None:
+            point = (trade.portfolio_id, trade.security, trade.trade_time, trade.pk)
+        else:
+            point = (Portfolio.objects.values_list('pk', flat=True).first() or 1, 'TCS', timezone.now(), 1)
+
+        queries = hot_queries(*point)
+        failures = []
+        for name, queryset in queries.items():
+            plan = queryset.explain()
+            self.stdout.write(f'== {name}\n{queryset.query}\n{plan}\n')
+            if full_scans(plan):
+                failures.append(name)
+
+        if options['check'] and failures:
+            raise CommandError(f'Queries not served by an index: {", ".join(failures)}')
+        self.stdout.write(self.style.SUCCESS(f'Explained {len(queries)} queries on {connection.vendor}'))
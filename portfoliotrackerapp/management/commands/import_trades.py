@@ -0,0 +1,49 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from portfoliotrackerapp.imports import ImportProgress, import_batches, normalize_rows, read_rows
+from portfoliotrackerapp.ingest import BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Imports trades from a broker CSV file of any size, in batches, skipping trades already imported. ' \
+           'Resumes from its checkpoint after a crash.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file with a header row')
+        parser.add_argument('--portfolio', type=int, help='Portfolio of every trade, for files without a '
+                                                         'portfolio column')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Rows ingested per transaction')
+        parser.add_argument('--checkpoint', help='Checkpoint file, by default the CSV path with .checkpoint added')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and import from the start')
+        parser.add_argument('--encoding', default='utf-8')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.isfile(path):
+            raise CommandError(f'No such file {path}')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        checkpoint = options['checkpoint'] or f'{path}.checkpoint'
+        progress = ImportProgress()
+        if os.path.exists(checkpoint) and not options['restart']:
+            progress = ImportProgress.load(checkpoint)
+            self.stdout.write(f'Resuming after row {progress.rows} at byte {progress.offset}')
+
+        rows = normalize_rows(read_rows(path, progress.offset, options['encoding']), options['portfolio'])
+        started, start_rows = time.perf_counter(), progress.rows
+        for progress, rejected in import_batches(rows, progress, options['batch_size']):
+            progress.save(checkpoint)
+            for row_number, trade, errors in rejected:
+                self.stderr.write(f'Row {row_number} rejected: {dict(errors)} {trade}')
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'{progress.rows} rows, {progress.imported} imported, {progress.duplicates} duplicates, '
+                              f'{progress.rejected} rejected, {(progress.rows - start_rows) / elapsed:.0f} rows/s')
+
+        elapsed = time.perf_counter() - started
+        rate = (progress.rows - start_rows) / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {progress.imported} of {progress.rows} rows in {elapsed:.2f}s ({rate:.0f} rows/s), skipped '
+            f'{progress.duplicates} duplicates, rejected {progress.rejected}'))
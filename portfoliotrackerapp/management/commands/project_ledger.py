@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from portfoliotrackerapp.ledger import (checkpoint_portfolio, latest_checkpoint, position_drift, project_positions,
+                                        rebuild_positions)
+from portfoliotrackerapp.models import Portfolio
+
+
+class Command(BaseCommand):
+    help = 'Folds the trade ledger into positions and reports positions that drifted from it. ' \
+           'Rebuilds them with --rebuild, records checkpoints with --checkpoint.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--portfolio', type=int, action='append', dest='portfolios',
+                            help='Only project the given portfolio id. Can be repeated.')
+        parser.add_argument('--full', action='store_true', help='Fold every event, ignoring checkpoints')
+        parser.add_argument('--rebuild', action='store_true', help='Overwrite drifted positions with the projection')
+        parser.add_argument('--checkpoint', action='store_true',
+                            help='Record a checkpoint of every portfolio with new events. Run it periodically.')
+
+    def handle(self, *args, **options):
+        portfolio_ids = options['portfolios'] or list(Portfolio.objects.order_by('pk').values_list('pk', flat=True))
+        started = time.perf_counter()
+        drifted = 0
+        for portfolio_id in portfolio_ids:
+            if options['rebuild']:
+                securities = rebuild_positions(portfolio_id, use_checkpoint=not options['full'])
+            else:
+                checkpoint = None if options['full'] else latest_checkpoint(portfolio_id)
+                securities = sorted(position_drift(portfolio_id, project_positions(portfolio_id, checkpoint)[0]))
+            if securities:
+                drifted += 1
+                action = 'rebuilt' if options['rebuild'] else 'drifted'
+                self.stdout.write(f'Portfolio {portfolio_id}: {action} {", ".join(securities)}')
+            if options['checkpoint']:
+                checkpoint_portfolio(portfolio_id)
+        elapsed = time.perf_counter() - started
+
+        summary = f'Projected {len(portfolio_ids)} portfolios in {elapsed:.2f}s'
+        if drifted and not options['rebuild']:
+            raise CommandError(f'{summary}, {drifted} have positions that drifted from the ledger')
+        self.stdout.write(self.style.SUCCESS(f'{summary}, {drifted} rebuilt' if options['rebuild'] else summary))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from portfoliotrackerapp.lots import rebuild_lots
+from portfoliotrackerapp.models import Lot, Portfolio
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the lots of every portfolio from its trades, by the lot method of the portfolio'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--portfolio', type=int, action='append', dest='portfolios',
+                            help='Only rebuild the given portfolio id. Can be repeated.')
+
+    def handle(self, *args, **options):
+        portfolio_ids = options['portfolios'] or list(Portfolio.objects.order_by('pk').values_list('pk', flat=True))
+        for portfolio_id in portfolio_ids:
+            with transaction.atomic():
+                rebuild_lots(portfolio_id)
+        lots = Lot.objects.filter(portfolio__in=portfolio_ids).count()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {lots} lots of {len(portfolio_ids)} portfolios'))
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from portfoliotrackerapp.models import Portfolio, PortfolioSummary
+from portfoliotrackerapp.summaries import compute_summaries, rebuild_summaries
+
+CHECKED_FIELDS = ('total_cost_basis', 'position_count', 'last_trade_time')
+
+
+class Command(BaseCommand):
+    help = 'Recomputes portfolio summaries from positions, or checks them with --check'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--portfolio', type=int, action='append', dest='portfolios',
+                            help='Only rebuild the given portfolio id. Can be repeated.')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--check', action='store_true',
+                            help='Report summaries that differ from a recomputation instead of rebuilding them')
+        parser.add_argument('--tolerance', type=float, default=1e-6,
+                            help='Largest difference in amounts --check accepts')
+
+    def handle(self, *args, **options):
+        portfolio_ids = options['portfolios'] or list(Portfolio.objects.order_by('pk').values_list('pk', flat=True))
+        batch_size = options['batch_size']
+        mismatches = 0
+        for start in range(0, len(portfolio_ids), batch_size):
+            batch = portfolio_ids[start:start + batch_size]
+            if options['check']:
+                mismatches += self.check_summaries(batch, options['tolerance'])
+            else:
+                with transaction.atomic():
+                    rebuild_summaries(batch)
+
+        if not options['check']:
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt {len(portfolio_ids)} portfolio summaries'))
+        elif mismatches:
+            raise CommandError(f'{mismatches} of {len(portfolio_ids)} portfolio summaries are inconsistent')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'All {len(portfolio_ids)} portfolio summaries are consistent'))
+
+    def check_summaries(self, portfolio_ids, tolerance):
+        expected = compute_summaries(portfolio_ids)
+        stored = PortfolioSummary.objects.in_bulk(portfolio_ids)
+        mismatches = 0
+        for pk, summary in expected.items():
+            if pk not in stored:
+                mismatches += 1
+                self.stdout.write(f'Portfolio {pk}: summary missing')
+                continue
+            for field in CHECKED_FIELDS:
+                want, have = getattr(summary, field), getattr(stored[pk], field)
+                if isinstance(want, float) and isinstance(have, float):
+                    differs = abs(want - have) > tolerance
+                else:
+                    differs = want != have
+                if differs:
+                    mismatches += 1
+                    self.stdout.write(f'Portfolio {pk}: {field} is {have}, expected {want}')
+                    break
+        return mismatches
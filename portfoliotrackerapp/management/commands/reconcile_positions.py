@@ -0,0 +1,57 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from portfoliotrackerapp.models import Portfolio
+from portfoliotrackerapp.reconcile import BATCH_SIZE, reconcile_in_worker, reconcile_portfolios
+
+
+class Command(BaseCommand):
+    help = 'Replays every (portfolio, security) trade stream and reports positions that differ from it. ' \
+           'Fixes them with --fix.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--portfolios', type=int, nargs='+', help='Only reconcile the given portfolio ids')
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument('--dry-run', action='store_true', help='Only report mismatches, the default')
+        mode.add_argument('--fix', action='store_true', help='Overwrite mismatched positions with the replay')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Worker processes. 0 reconciles in this process.')
+        parser.add_argument('--chunk-size', type=int, default=200, help='Portfolios per worker task')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Trades fetched per round trip')
+
+    def handle(self, *args, **options):
+        portfolio_ids = options['portfolios'] or list(Portfolio.objects.order_by('pk').values_list('pk', flat=True))
+        chunk_size = options['chunk_size']
+        chunks = [portfolio_ids[start:start + chunk_size] for start in range(0, len(portfolio_ids), chunk_size)]
+        fix, batch_size = options['fix'], options['batch_size']
+
+        started = time.perf_counter()
+        if options['workers']:
+            # Forked workers must not share the connections of this process
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as executor:
+                futures = [executor.submit(reconcile_in_worker, chunk, fix, batch_size) for chunk in chunks]
+                results = [future.result() for future in as_completed(futures)]
+        else:
+            results = [reconcile_portfolios(chunk, fix, batch_size) for chunk in chunks]
+        elapsed = time.perf_counter() - started
+
+        streams = sum(result['streams'] for result in results)
+        trades = sum(result['trades'] for result in results)
+        mismatches = sorted(mismatch for result in results for mismatch in result['mismatches'])
+        for portfolio_id, security, stored, replayed in mismatches:
+            self.stdout.write(f'Portfolio {portfolio_id} {security}: stored {stored}, replayed {replayed}'
+                              f'{", fixed" if fix else ""}')
+
+        rate = streams / elapsed if elapsed else 0
+        summary = f'Reconciled {streams} streams ({trades} trades) of {len(portfolio_ids)} portfolios in ' \
+                  f'{elapsed:.2f}s, {rate:.0f} streams/s'
+        if mismatches and not fix:
+            raise CommandError(f'{summary}. {len(mismatches)} positions differ from their trades')
+        self.stdout.write(self.style.SUCCESS(f'{summary}. {len(mismatches)} positions '
+                                             f'{"fixed" if fix else "differ from their trades"}'))
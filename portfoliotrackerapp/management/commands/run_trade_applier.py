@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from portfoliotrackerapp.models import QueuedTrade
+from portfoliotrackerapp.trade_queue import apply_queued_trades, get_config
+
+
+class Command(BaseCommand):
+    help = 'Applies trades queued by POST /api/v1/trade/ while the trade queue is enabled, in batches, until stopped'
+
+    def add_arguments(self, parser):
+        config = get_config()
+        parser.add_argument('--batch-size', type=int, default=config['BATCH_SIZE'],
+                            help='Queued trades applied per transaction')
+        parser.add_argument('--interval', type=float, default=config['POLL_INTERVAL'],
+                            help='Seconds to wait for new trades once the queue is drained')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is drained')
+
+    def handle(self, *args, **options):
+        applied = rejected = 0
+        try:
+            while True:
+                started = time.perf_counter()
+                batch = apply_queued_trades(options['batch_size'])
+                if batch:
+                    batch_rejected = sum(queued.status == QueuedTrade.REJECTED for queued in batch)
+                    applied += len(batch) - batch_rejected
+                    rejected += batch_rejected
+                    self.stdout.write(f'Applied {len(batch) - batch_rejected} trades, rejected {batch_rejected} '
+                                      f'in {time.perf_counter() - started:.3f}s')
+                if len(batch) < options['batch_size']:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+                    # Drops the connection once it is past CONN_MAX_AGE or broken, as at the end of a request
+                    close_old_connections()
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f'Applied {applied} trades, rejected {rejected}'))
@@ -0,0 +1,202 @@
+import asyncio
+import bisect
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+"""
+Per request instrumentation, enabled by adding RequestMetricsMiddleware to MIDDLEWARE. Query count, database time,
+serializer time and view time of every request go to a Server-Timing header, a log line and per endpoint histograms
+served by /api/v1/metrics/ in the Prometheus text format.
+"""
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REQUEST_METRICS = {
+    'SERVER_TIMING': True,
+    'LOG': True,
+}
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+current_metrics = contextvars.ContextVar('request_metrics', default=None)
+
+
+def get_config():
+    return {**DEFAULT_REQUEST_METRICS, **getattr(settings, 'REQUEST_METRICS', {})}
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = current_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_time += time.perf_counter() - started
+        metrics.queries += 1
+
+
+def install_query_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextmanager
+def timed_serializer():
+    """Adds the time spent inside to the serializer time of the request. Nested serializers are counted once."""
+    metrics = current_metrics.get()
+    if metrics is None:
+        yield
+        return
+    metrics.serializer_depth += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.serializer_depth -= 1
+        if not metrics.serializer_depth:
+            metrics.serializer_time += time.perf_counter() - started
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """Histograms per (view name, method) of this process"""
+
+    METRICS = (
+        ('view_seconds', 'Time spent handling the request', SECONDS_BUCKETS),
+        ('db_seconds', 'Time spent in database queries', SECONDS_BUCKETS),
+        ('serializer_seconds', 'Time spent in serializers, including their queries', SECONDS_BUCKETS),
+        ('queries', 'Database queries per request', QUERY_BUCKETS),
+    )
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, values):
+        with self._lock:
+            histograms = self._histograms.get(labels)
+            if histograms is None:
+                histograms = self._histograms[labels] = {name: Histogram(buckets)
+                                                         for name, _, buckets in self.METRICS}
+            for name, value in values.items():
+                histograms[name].observe(value)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, description, buckets in self.METRICS:
+                metric = f'portfoliotracker_request_{name}'
+                lines += [f'# HELP {metric} {description}', f'# TYPE {metric} histogram']
+                for (view, method), histograms in sorted(self._histograms.items()):
+                    histogram = histograms[name]
+                    labels = f'view="{view}",method="{method}"'
+                    cumulative = 0
+                    for bound, count in zip((*buckets, '+Inf'), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_sum{{{labels}}} {histogram.sum}')
+                    lines.append(f'{metric}_count{{{labels}}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class RequestMetricsMiddleware:
+    """Records the metrics of every request. Works under WSGI and ASGI, including the async read endpoints."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # Marks this instance as a coroutine function for Django's handler, as MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        connection_created.connect(install_query_recorder, dispatch_uid='request_metrics')
+        for connection in connections.all():
+            install_query_recorder(connection)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - started)
+
+    def finish(self, request, response, metrics, view_time):
+        config = get_config()
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unmatched'
+        registry.observe((view, request.method), {
+            'view_seconds': view_time,
+            'db_seconds': metrics.db_time,
+            'serializer_seconds': metrics.serializer_time,
+            'queries': metrics.queries,
+        })
+        if config['SERVER_TIMING']:
+            response['Server-Timing'] = ', '.join((
+                f'db;dur={metrics.db_time * 1000:.2f};desc="{metrics.queries} queries"',
+                f'serializer;dur={metrics.serializer_time * 1000:.2f}',
+                f'view;dur={view_time * 1000:.2f}',
+            ))
+        if config['LOG']:
+            logger.info(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'view': view,
+                'status': response.status_code,
+                'queries': metrics.queries,
+                'db_ms': round(metrics.db_time * 1000, 3),
+                'serializer_ms': round(metrics.serializer_time * 1000, 3),
+                'view_ms': round(view_time * 1000, 3),
+            }))
+        return response
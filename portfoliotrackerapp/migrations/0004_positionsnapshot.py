@@ -0,0 +1,30 @@
+# Generated by Django 3.1.7 on 2026-10-18 13:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfoliotrackerapp', '0003_auto_20210411_0310'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PositionSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('security', models.CharField(max_length=10)),
+                ('trade_time', models.DateTimeField()),
+                ('count', models.PositiveIntegerField()),
+                ('average_price', models.FloatField()),
+                ('portfolio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='portfoliotrackerapp.portfolio')),
+                ('trade', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='snapshot', to='portfoliotrackerapp.trade')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='positionsnapshot',
+            index=models.Index(fields=['portfolio', 'security', 'trade_time', 'trade'], name='portfoliotr_portfol_310988_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 13:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfoliotrackerapp', '0004_positionsnapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='trade',
+            name='trade_price',
+            field=models.FloatField(),
+        ),
+    ]
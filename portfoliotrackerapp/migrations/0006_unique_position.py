@@ -0,0 +1,31 @@
+# Generated by Django 3.1.7 on 2026-10-18 13:15
+
+from django.db import migrations, models
+
+
+def remove_duplicate_positions(apps, schema_editor):
+    # Trades always updated the first position found for a security, so that's the one to keep
+    Position = apps.get_model('portfoliotrackerapp', 'Position')
+    keep = {}
+    duplicates = []
+    for pk, portfolio_id, security in Position.objects.order_by('pk').values_list('pk', 'portfolio_id', 'security'):
+        if (portfolio_id, security) in keep:
+            duplicates.append(pk)
+        else:
+            keep[(portfolio_id, security)] = pk
+    Position.objects.filter(pk__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfoliotrackerapp', '0005_trade_price_without_default'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_positions, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='position',
+            constraint=models.UniqueConstraint(fields=('portfolio', 'security'), name='unique_position_per_security'),
+        ),
+    ]
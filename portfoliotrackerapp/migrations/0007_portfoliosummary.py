@@ -0,0 +1,26 @@
+# Generated by Django 3.1.7 on 2026-10-18 13:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfoliotrackerapp', '0006_unique_position'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioSummary',
+            fields=[
+                ('portfolio', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='portfoliotrackerapp.portfolio')),
+                ('total_cost_basis', models.FloatField(default=0)),
+                ('market_value', models.FloatField(default=0)),
+                ('returns', models.FloatField(default=0)),
+                ('position_count', models.PositiveIntegerField(default=0)),
+                ('last_trade_time', models.DateTimeField(null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
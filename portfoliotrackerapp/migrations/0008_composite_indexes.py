@@ -0,0 +1,48 @@
+# Generated by Django 3.1.7 on 2026-10-18 13:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfoliotrackerapp', '0007_portfoliosummary'),
+    ]
+
+    operations = [
+        # The composite indexes are built before the single column ones they replace are dropped
+        migrations.AddIndex(
+            model_name='trade',
+            index=models.Index(fields=['portfolio', 'security', 'trade_time', 'id'], name='trade_stream_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trade',
+            index=models.Index(fields=['portfolio', 'trade_time', 'id'], name='trade_portfolio_time_idx'),
+        ),
+        migrations.AlterField(
+            model_name='position',
+            name='portfolio',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='portfoliotrackerapp.portfolio'),
+        ),
+        migrations.AlterField(
+            model_name='position',
+            name='security',
+            field=models.CharField(max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='positionsnapshot',
+            name='portfolio',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='portfoliotrackerapp.portfolio'),
+        ),
+        migrations.AlterField(
+            model_name='trade',
+            name='portfolio',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='portfoliotrackerapp.portfolio'),
+        ),
+        migrations.AlterField(
+            model_name='trade',
+            name='security',
+            field=models.CharField(max_length=10),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 3.1.7 on 2026-10-18 13:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def record_existing_trades(apps, schema_editor):
+    # The ledger starts with a create event for every trade already recorded, in stream order
+    Trade = apps.get_model('portfoliotrackerapp', 'Trade')
+    TradeEvent = apps.get_model('portfoliotrackerapp', 'TradeEvent')
+    batch = []
+    for trade_id, portfolio_id, security, count, trade_type, trade_price, trade_time in Trade.objects \
+            .order_by('trade_time', 'id') \
+            .values_list('id', 'portfolio_id', 'security', 'count', 'trade_type', 'trade_price', 'trade_time') \
+            .iterator(chunk_size=2000):
+        batch.append(TradeEvent(portfolio_id=portfolio_id, trade_id=trade_id, event_type='C', security=security,
+                                count=count, trade_type=trade_type, trade_price=trade_price, trade_time=trade_time))
+        if len(batch) >= 2000:
+            TradeEvent.objects.bulk_create(batch)
+            batch = []
+    TradeEvent.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfoliotrackerapp', '0008_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TradeEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trade_id', models.IntegerField()),
+                ('event_type', models.CharField(choices=[('C', 'Create'), ('A', 'Amend'), ('X', 'Cancel')], max_length=1)),
+                ('security', models.CharField(max_length=10)),
+                ('previous_security', models.CharField(blank=True, max_length=10, null=True)),
+                ('count', models.PositiveIntegerField()),
+                ('trade_type', models.CharField(choices=[('B', 'Buy'), ('S', 'Sell')], max_length=5)),
+                ('trade_price', models.FloatField()),
+                ('trade_time', models.DateTimeField()),
+                ('recorded_at', models.DateTimeField(auto_now_add=True)),
+                ('portfolio', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='portfoliotrackerapp.portfolio')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LedgerCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_event_id', models.BigIntegerField()),
+                ('positions', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('portfolio', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='portfoliotrackerapp.portfolio')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='tradeevent',
+            index=models.Index(fields=['portfolio', 'id'], name='trade_event_portfolio_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tradeevent',
+            index=models.Index(fields=['portfolio', 'trade_id'], name='trade_event_trade_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ledgercheckpoint',
+            index=models.Index(fields=['portfolio', 'last_event_id'], name='ledger_checkpoint_idx'),
+        ),
+        migrations.RunPython(record_existing_trades, migrations.RunPython.noop),
+    ]
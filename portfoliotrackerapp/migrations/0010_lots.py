@@ -0,0 +1,51 @@
+# Generated by Django 3.1.7 on 2026-10-18 13:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfoliotrackerapp', '0009_trade_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lot',
+            fields=[
+                ('trade', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='lot', serialize=False, to='portfoliotrackerapp.trade')),
+                ('security', models.CharField(max_length=10)),
+                ('acquired_at', models.DateTimeField()),
+                ('quantity', models.PositiveIntegerField()),
+                ('remaining', models.PositiveIntegerField()),
+                ('price', models.FloatField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='portfolio',
+            name='lot_method',
+            field=models.CharField(choices=[('FIFO', 'First in, first out'), ('LIFO', 'Last in, first out'), ('HIFO', 'Highest cost first')], default='FIFO', max_length=4),
+        ),
+        migrations.CreateModel(
+            name='LotClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField()),
+                ('sell_price', models.FloatField()),
+                ('realized_pnl', models.FloatField()),
+                ('closed_at', models.DateTimeField()),
+                ('lot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='closures', to='portfoliotrackerapp.lot')),
+                ('sell_trade', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lot_closures', to='portfoliotrackerapp.trade')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='lot',
+            name='portfolio',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='portfoliotrackerapp.portfolio'),
+        ),
+        migrations.AddIndex(
+            model_name='lot',
+            index=models.Index(fields=['portfolio', 'security', 'acquired_at'], name='lot_stream_idx'),
+        ),
+    ]
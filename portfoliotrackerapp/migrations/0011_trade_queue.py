@@ -0,0 +1,34 @@
+# Generated by Django 3.1.7 on 2026-10-18 13:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfoliotrackerapp', '0010_lots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedTrade',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('security', models.CharField(max_length=10)),
+                ('count', models.PositiveIntegerField()),
+                ('trade_type', models.CharField(choices=[('B', 'Buy'), ('S', 'Sell')], default='B', max_length=5)),
+                ('trade_price', models.FloatField()),
+                ('status', models.CharField(choices=[('P', 'Pending'), ('A', 'Applied'), ('R', 'Rejected')], default='P', max_length=1)),
+                ('errors', models.JSONField(blank=True, null=True)),
+                ('queued_at', models.DateTimeField(auto_now_add=True)),
+                ('applied_at', models.DateTimeField(blank=True, null=True)),
+                ('portfolio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='portfoliotrackerapp.portfolio')),
+                ('trade', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='queued', to='portfoliotrackerapp.trade')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='queuedtrade',
+            index=models.Index(fields=['status', 'id'], name='queued_trade_status_idx'),
+        ),
+    ]
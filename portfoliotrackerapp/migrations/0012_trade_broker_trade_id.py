@@ -0,0 +1,22 @@
+# Generated by Django 3.1.7 on 2026-10-18 14:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfoliotrackerapp', '0011_trade_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trade',
+            name='broker_trade_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='trade',
+            constraint=models.UniqueConstraint(fields=('portfolio', 'broker_trade_id'), name='unique_broker_trade_id'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.7 on 2026-10-18 14:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfoliotrackerapp', '0012_trade_broker_trade_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, null=True)),
+                ('portfolios', models.ManyToManyField(blank=True, related_name='groups', to='portfoliotrackerapp.Portfolio')),
+            ],
+        ),
+    ]
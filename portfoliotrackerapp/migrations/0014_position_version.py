@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 14:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfoliotrackerapp', '0013_portfolio_group'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='position',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.7 on 2026-10-18 15:06
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfoliotrackerapp', '0014_position_version'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='portfoliosummary',
+            name='market_value',
+        ),
+        migrations.RemoveField(
+            model_name='portfoliosummary',
+            name='returns',
+        ),
+    ]
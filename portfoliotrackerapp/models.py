@@ -2,7 +2,23 @@ from django.db import models
 
 
 class Portfolio(models.Model):
+    FIFO = 'FIFO'
+    LIFO = 'LIFO'
+    HIFO = 'HIFO'
+    LOT_METHOD_CHOICES = ((FIFO, 'First in, first out'), (LIFO, 'Last in, first out'), (HIFO, 'Highest cost first'))
+
+    name = models.CharField(max_length=50, null=True)
+    # Which lots sells relieve, for lot level cost basis
+    lot_method = models.CharField(max_length=4, choices=LOT_METHOD_CHOICES, default=FIFO)
+
+    def __str__(self):
+        return f"{self.name}"
+
+
+class PortfolioGroup(models.Model):
+    """Portfolios reported together, such as the accounts of a household"""
     name = models.CharField(max_length=50, null=True)
+    portfolios = models.ManyToManyField(Portfolio, related_name='groups', blank=True)
 
     def __str__(self):
         return f"{self.name}"
@@ -23,22 +39,189 @@ class Trade(models.Model):
     SELL = 'S'
     TRADE_TYPE_CHOICES = ((BUY, 'Buy'), (SELL, 'Sell'))
 
-    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, db_index=True)
-    security = models.CharField(max_length=10, db_index=True)
+    # Trades are read per (portfolio, security) stream or per portfolio in time order, which the composite
+    # indexes below serve. Their leading portfolio column also covers lookups by portfolio alone.
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, db_index=False)
+    security = models.CharField(max_length=10)
     count = models.PositiveIntegerField()
     trade_type = models.CharField(max_length=5, choices=TRADE_TYPE_CHOICES, default=BUY)
-    trade_price = models.FloatField(default=100)
+    trade_price = models.FloatField()
     trade_time = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Id of the trade at the broker, for trades imported from broker files, which are deduplicated on it
+    broker_trade_id = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['portfolio', 'security', 'trade_time', 'id'], name='trade_stream_idx'),
+            models.Index(fields=['portfolio', 'trade_time', 'id'], name='trade_portfolio_time_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['portfolio', 'broker_trade_id'], name='unique_broker_trade_id'),
+        ]
 
     def __str__(self):
         return f"{self.portfolio.name}: {self.security}: {self.trade_type}"
 
 
 class Position(models.Model):
-    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, db_index=True)
-    security = models.CharField(max_length=10, db_index=True)
+    # The unique (portfolio, security) constraint indexes both
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, db_index=False)
+    security = models.CharField(max_length=10)
     count = models.PositiveIntegerField()
     average_price = models.FloatField()
+    # Bumped by every write, so copies held in memory can tell they are stale, see position_book.py
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['portfolio', 'security'], name='unique_position_per_security'),
+        ]
 
     def __str__(self):
         return f"{self.portfolio.name} : {self.security}"
+
+
+class PositionSnapshot(models.Model):
+    """Position on a (portfolio, security) right after a trade was applied"""
+    trade = models.OneToOneField(Trade, on_delete=models.CASCADE, related_name='snapshot')
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, db_index=False)
+    security = models.CharField(max_length=10)
+    trade_time = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    average_price = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['portfolio', 'security', 'trade_time', 'trade']),
+        ]
+
+    def __str__(self):
+        return f"{self.portfolio.name} : {self.security} @ {self.trade_time}"
+
+
+class PortfolioSummary(models.Model):
+    """
+    Totals of a portfolio that don't depend on prices, kept up to date by every trade change in the same
+    transaction. Market value and returns are marked at current prices when read, see PortfolioSerializer.
+    """
+    portfolio = models.OneToOneField(Portfolio, on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    total_cost_basis = models.FloatField(default=0)
+    position_count = models.PositiveIntegerField(default=0)
+    last_trade_time = models.DateTimeField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.portfolio.name} summary"
+
+
+class TradeEvent(models.Model):
+    """
+    Append-only history of trades. Every create, amendment and cancellation of a trade appends the state of the
+    trade after it, so positions can be rebuilt from the ledger, see ledger.py
+    """
+    CREATE = 'C'
+    AMEND = 'A'
+    CANCEL = 'X'
+    EVENT_TYPE_CHOICES = ((CREATE, 'Create'), (AMEND, 'Amend'), (CANCEL, 'Cancel'))
+
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, db_index=False)
+    # Not a foreign key, the events of a trade outlive it
+    trade_id = models.IntegerField()
+    event_type = models.CharField(max_length=1, choices=EVENT_TYPE_CHOICES)
+    security = models.CharField(max_length=10)
+    # Security of the trade before an amendment moved it to another one
+    previous_security = models.CharField(max_length=10, null=True, blank=True)
+    count = models.PositiveIntegerField()
+    trade_type = models.CharField(max_length=5, choices=Trade.TRADE_TYPE_CHOICES)
+    trade_price = models.FloatField()
+    trade_time = models.DateTimeField()
+    recorded_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['portfolio', 'id'], name='trade_event_portfolio_idx'),
+            models.Index(fields=['portfolio', 'trade_id'], name='trade_event_trade_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.portfolio.name}: trade {self.trade_id}: {self.get_event_type_display()}"
+
+
+class LedgerCheckpoint(models.Model):
+    """Positions of a portfolio as folded from its trade events up to and including `last_event_id`"""
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, db_index=False)
+    last_event_id = models.BigIntegerField()
+    # {security: [count, average_price]}
+    positions = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['portfolio', 'last_event_id'], name='ledger_checkpoint_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.portfolio.name} @ event {self.last_event_id}"
+
+
+class Lot(models.Model):
+    """Shares acquired by a buy trade, relieved by sells according to the lot method of the portfolio"""
+    trade = models.OneToOneField(Trade, on_delete=models.CASCADE, primary_key=True, related_name='lot')
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, db_index=False)
+    security = models.CharField(max_length=10)
+    acquired_at = models.DateTimeField()
+    quantity = models.PositiveIntegerField()
+    remaining = models.PositiveIntegerField()
+    price = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['portfolio', 'security', 'acquired_at'], name='lot_stream_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.portfolio.name} : {self.security} lot of trade {self.trade_id}"
+
+
+class LotClosure(models.Model):
+    """Part of a lot relieved by a sell trade, with the P&L it realized"""
+    lot = models.ForeignKey(Lot, on_delete=models.CASCADE, related_name='closures')
+    sell_trade = models.ForeignKey(Trade, on_delete=models.CASCADE, related_name='lot_closures')
+    count = models.PositiveIntegerField()
+    sell_price = models.FloatField()
+    realized_pnl = models.FloatField()
+    closed_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.count} of lot {self.lot_id} sold by trade {self.sell_trade_id}"
+
+
+class QueuedTrade(models.Model):
+    """
+    A trade accepted while the trade queue is enabled, waiting for run_trade_applier to apply it.
+    See trade_queue.py
+    """
+    PENDING = 'P'
+    APPLIED = 'A'
+    REJECTED = 'R'
+    STATUS_CHOICES = ((PENDING, 'Pending'), (APPLIED, 'Applied'), (REJECTED, 'Rejected'))
+
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE)
+    security = models.CharField(max_length=10)
+    count = models.PositiveIntegerField()
+    trade_type = models.CharField(max_length=5, choices=Trade.TRADE_TYPE_CHOICES, default=Trade.BUY)
+    trade_price = models.FloatField()
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=PENDING)
+    # The trade it became once applied
+    trade = models.OneToOneField(Trade, on_delete=models.SET_NULL, null=True, blank=True, related_name='queued')
+    errors = models.JSONField(null=True, blank=True)
+    queued_at = models.DateTimeField(auto_now_add=True)
+    applied_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='queued_trade_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.portfolio.name}: {self.security}: {self.trade_type} ({self.get_status_display()})"
@@ -0,0 +1,211 @@
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import groupby
+
+from django.conf import settings
+from django.core.signals import request_started, setting_changed
+from django.db import IntegrityError, connections, router, transaction
+from django.dispatch import receiver
+from rest_framework.exceptions import ValidationError
+
+from .models import *
+from .positions import apply_trade, lock_positions
+
+"""
+In-process copy of every position, so trade creation validates short selling with a lookup and writes the position
+with one conditional UPDATE. Entries carry the version of their row, which every position write bumps. An UPDATE
+matching no row means the entry is stale, and the position is read again under a lock before retrying.
+
+The first request of a process starts loading the book in a thread of its own. Until it is loaded, trades go through
+the database as with the book disabled, so no request waits for the load nor holds a transaction open during it.
+"""
+
+DEFAULT_POSITION_BOOK = {
+    'ENABLED': False,
+}
+INVALID_POSITION = 'This trade results in invalid position'
+# Keys pack the portfolio id above the code of the security
+SECURITY_BITS = 24
+
+
+def get_config():
+    return {**DEFAULT_POSITION_BOOK, **getattr(settings, 'POSITION_BOOK', {})}
+
+
+class PositionBook:
+    """
+    Positions as parallel arrays of machine numbers, 40 bytes each. Keys are kept sorted as warmed and searched by
+    bisection, positions opened later are found through a dict. Securities are stored once, as a code in the key.
+    """
+    __slots__ = ('_lock', '_warm', '_warming', '_keys', '_added', '_codes', '_pks', '_counts', '_average_prices',
+                 '_versions')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._warming = None
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        self._warm = False
+        self._keys = array('q')
+        self._added = {}
+        self._codes = {}
+        self._pks = array('q')
+        self._counts = array('q')
+        self._average_prices = array('d')
+        self._versions = array('q')
+
+    def __len__(self):
+        return len(self._pks)
+
+    @property
+    def is_warm(self):
+        return self._warm
+
+    def _key(self, portfolio_id, security):
+        code = self._codes.get(security)
+        if code is None:
+            code = self._codes[security] = len(self._codes)
+        return portfolio_id << SECURITY_BITS | code
+
+    def _slot(self, key):
+        slot = bisect_left(self._keys, key)
+        if slot < len(self._keys) and self._keys[slot] == key:
+            return slot
+        return self._added.get(key)
+
+    def _append(self, pk, count, average_price, version):
+        self._pks.append(pk)
+        self._counts.append(count)
+        self._average_prices.append(average_price)
+        self._versions.append(version)
+
+    def _set(self, pk, portfolio_id, security, count, average_price, version):
+        key = self._key(portfolio_id, security)
+        slot = self._slot(key)
+        if slot is None:
+            self._added[key] = len(self._pks)
+            self._append(pk, count, average_price, version)
+        elif self._pks[slot] != pk or self._versions[slot] <= version:
+            # An entry applied late never replaces a newer one
+            self._pks[slot], self._counts[slot], self._average_prices[slot], self._versions[slot] = \
+                pk, count, average_price, version
+
+    def warm(self):
+        """Loads every position in one query, once per process. Lookups don't wait for the load."""
+        if self._warm:
+            return
+        loaded = PositionBook()
+        positions = Position.objects.db_manager(router.db_for_write(Position)).order_by('portfolio') \
+            .values_list('pk', 'portfolio_id', 'security', 'count', 'average_price', 'version')
+        rows = ((loaded._key(portfolio_id, security), pk, count, average_price, version)
+                for pk, portfolio_id, security, count, average_price, version in positions.iterator(10000))
+        # Rows come by portfolio, the high bits of their keys, so sorting each portfolio sorts all keys
+        for _, portfolio_rows in groupby(rows, key=lambda row: row[0] >> SECURITY_BITS):
+            for key, *entry in sorted(portfolio_rows):
+                loaded._keys.append(key)
+                loaded._append(*entry)
+        with self._lock:
+            for name in ('_keys', '_added', '_codes', '_pks', '_counts', '_average_prices', '_versions'):
+                setattr(self, name, getattr(loaded, name))
+            self._warm = True
+
+    def start_warming(self):
+        """Starts warming the book in a thread of its own unless it is warm. Returns the thread, if still running."""
+        with self._lock:
+            if not self._warm and self._warming is None:
+                self._warming = threading.Thread(target=self._warm_in_thread, name='position-book', daemon=True)
+                self._warming.start()
+            return self._warming
+
+    def _warm_in_thread(self):
+        try:
+            self.warm()
+        finally:
+            connections.close_all()
+            # A failed load is retried by the next request
+            with self._lock:
+                self._warming = None
+
+    def get(self, portfolio_id, security):
+        """(pk, count, average_price, version) of a position, or None if the book has none"""
+        with self._lock:
+            slot = self._slot(self._key(portfolio_id, security))
+            if slot is None:
+                return None
+            return self._pks[slot], self._counts[slot], self._average_prices[slot], self._versions[slot]
+
+    def set(self, pk, portfolio_id, security, count, average_price, version):
+        with self._lock:
+            self._set(pk, portfolio_id, security, count, average_price, version)
+
+    def reload(self, portfolio_id, security, lock=False):
+        """Reads a position from the database into the book, locked until the end of the transaction if `lock`"""
+        filters = {'portfolio_id': portfolio_id, 'security': security}
+        positions = lock_positions(**filters) if lock else Position.objects.filter(**filters)
+        for position in positions:
+            entry = (position.pk, position.count, position.average_price, position.version)
+            self.set(entry[0], portfolio_id, security, *entry[1:])
+            return entry
+        return None
+
+    def can_sell(self, portfolio_id, security, count):
+        entry = self.get(portfolio_id, security)
+        if entry is None or entry[1] < count:
+            # Other processes may have bought since the book was last updated
+            entry = self.reload(portfolio_id, security)
+        return entry is not None and entry[1] >= count
+
+    def apply_trade(self, trade):
+        """
+        Applies a new trade on its position, in the caller's transaction, and returns the (count, average_price) of
+        the position before and after. The book is updated once the transaction commits.
+        """
+        portfolio_id, security = trade.portfolio_id, trade.security
+        entry = self.get(portfolio_id, security)
+        for locked in (False, True):
+            if entry is None and trade.trade_type == Trade.BUY:
+                try:
+                    with transaction.atomic():
+                        position = Position.objects.create(portfolio_id=portfolio_id, security=security, count=0,
+                                                           average_price=0)
+                    entry = (position.pk, 0, 0, 0)
+                except IntegrityError:
+                    # Another request opened this position in the meantime
+                    entry = self.reload(portfolio_id, security, lock=True)
+            if entry is not None:
+                pk, count, average_price, version = entry
+                new = apply_trade(count, average_price, trade.trade_type, trade.count, trade.trade_price)
+                if new[0] >= 0 and Position.objects.filter(pk=pk, version=version) \
+                        .update(count=new[0], average_price=new[1], version=version + 1):
+                    transaction.on_commit(lambda: self.set(pk, portfolio_id, security, *new, version + 1))
+                    return (count, average_price), new
+            if locked:
+                raise ValidationError(INVALID_POSITION)
+            # The entry is stale, or the sell may have been checked against a stale entry
+            entry = self.reload(portfolio_id, security, lock=True)
+
+
+book = PositionBook()
+
+
+def get_book():
+    """The position book of this process, or None while it is disabled or not loaded yet"""
+    return book if get_config()['ENABLED'] and book.is_warm else None
+
+
+@receiver(request_started)
+def warm_position_book(**kwargs):
+    if get_config()['ENABLED'] and not book.is_warm:
+        book.start_warming()
+
+
+@receiver(setting_changed)
+def reset_position_book(setting, **kwargs):
+    if setting == 'POSITION_BOOK':
+        book.clear()
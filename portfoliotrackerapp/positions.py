@@ -0,0 +1,178 @@
+from django.db import connections, router
+from django.db.models import Count, ExpressionWrapper, F, FloatField, OuterRef, Q, Subquery, Sum
+from rest_framework.exceptions import ValidationError
+
+from .models import *
+from .summaries import apply_position_changes
+
+""" Position arithmetic shared by trade create, update and delete """
+
+SNAPSHOT_FIELDS = ('portfolio', 'security', 'trade_time', 'count', 'average_price')
+
+
+def apply_trade(count, average_price, trade_type, trade_count, trade_price):
+    """Returns the (count, average_price) of a position after a trade is applied on it"""
+    if trade_type == Trade.BUY:
+        if trade_count == 0:
+            return count, average_price
+        new_count = count + trade_count
+        return new_count, (average_price * count + trade_price * trade_count) / new_count
+    return count - trade_count, average_price
+
+
+def same_position(position, other):
+    """Whether two (count, average_price) pairs agree, up to the rounding of prices computed in different orders"""
+    return position[0] == other[0] and abs(position[1] - other[1]) <= 1e-6 * max(1, abs(other[1]))
+
+
+def placed_after(trade_time, trade_id, id_field='id'):
+    """
+    Filter for rows placed after the given point of a trade stream, which is ordered by (trade_time, id).
+    The outer bound on trade_time lets the database use it as an index range.
+    """
+    return Q(trade_time__gte=trade_time) & (Q(trade_time__gt=trade_time) | Q(**{f'{id_field}__gt': trade_id}))
+
+
+def placed_before(trade_time, trade_id, id_field='id'):
+    """Filter for rows placed before the given point of a trade stream"""
+    return Q(trade_time__lte=trade_time) & (Q(trade_time__lt=trade_time) | Q(**{f'{id_field}__lt': trade_id}))
+
+
+def snapshots_as_of(portfolio_id, moment):
+    """
+    Snapshots holding the positions of a portfolio right after its last trade placed at or before `moment`, one
+    per security. Every security the portfolio ever traded has a position row, and its snapshot is found with one
+    backward seek on the snapshot index, so any point in time costs the same.
+    """
+    latest = PositionSnapshot.objects \
+        .filter(portfolio=portfolio_id, security=OuterRef('security'), trade_time__lte=moment) \
+        .order_by('-trade_time', '-trade_id') \
+        .values('pk')[:1]
+    return PositionSnapshot.objects \
+        .filter(pk__in=Position.objects.filter(portfolio=portfolio_id).values(snapshot=Subquery(latest)))
+
+
+def group_positions(group_id):
+    """
+    Open positions of the portfolios of a group summed per security, with their cost basis and how many portfolios
+    hold them, in one grouped query whatever the size of the group
+    """
+    members = PortfolioGroup.portfolios.through.objects.filter(portfoliogroup=group_id).values('portfolio')
+    return Position.objects.filter(portfolio__in=members, count__gt=0).values('security') \
+        .annotate(total_count=Sum('count'), cost_basis=Sum(F('count') * F('average_price'), output_field=FloatField()),
+                  portfolio_count=Count('portfolio')) \
+        .order_by('security')
+
+
+def lock_positions(**filters):
+    """
+    Locks the positions matching the filters until the end of the current transaction and returns them.
+    Should be the first statement of the transaction. SQLite has no row locks, but its transactions begin with the
+    database write lock (see backends/sqlite3), so concurrent writers already queue on the busy timeout rather than
+    read positions that are about to change. The no-op UPDATE keeps that so on the stock backend.
+    """
+    positions = Position.objects.filter(**filters)
+    if connections[router.db_for_write(Position)].features.has_select_for_update:
+        return list(positions.select_for_update().order_by('pk'))
+    positions.update(count=F('count'))
+    return list(positions)
+
+
+def apply_trade_to_position(position, trade):
+    """
+    Applies a new trade on a locked position with a single UPDATE computed by the database.
+    Sells only go through while the position holds enough. Returns whether the position was updated.
+    """
+    positions = Position.objects.filter(pk=position.pk)
+    if trade.trade_type == Trade.BUY:
+        if trade.count == 0:
+            return True
+        updated = positions.update(
+            average_price=ExpressionWrapper(
+                (F('average_price') * F('count') + trade.trade_price * trade.count) / (F('count') + trade.count),
+                output_field=FloatField()),
+            count=F('count') + trade.count,
+            version=F('version') + 1)
+    else:
+        updated = positions.filter(count__gte=trade.count).update(count=F('count') - trade.count,
+                                                                  version=F('version') + 1)
+    position.refresh_from_db(fields=['count', 'average_price'])
+    return updated == 1
+
+
+def record_snapshot(trade, count, average_price):
+    return PositionSnapshot.objects.create(trade=trade, portfolio=trade.portfolio, security=trade.security,
+                                           trade_time=trade.trade_time, count=count, average_price=average_price)
+
+
+class StreamReplay:
+    """
+    Recomputes the trade stream of a (portfolio, security) from the point of `trade` onward.
+
+    The replay restarts from the snapshot immediately before `trade`, so only the tail of the stream
+    is walked. `trade` is dropped from the stream unless `replacement` is given, in which case the
+    replacement is applied at the place of `trade`. The replacement may come from another security's
+    stream, which is how a trade moves between securities on update.
+    """
+
+    def __init__(self, portfolio, security, trade, replacement=None):
+        self.portfolio = portfolio
+        self.security = security
+        self.trade = trade
+        self.replacement = replacement
+        self.count = 0
+        self.average_price = 0
+        self.snapshots = []
+
+    def run(self, error_message):
+        """Replays the tail in memory, raising ValidationError if the position goes negative anywhere"""
+        trades = Trade.objects.filter(portfolio=self.portfolio, security=self.security)
+        previous = PositionSnapshot.objects \
+            .filter(placed_before(self.trade.trade_time, self.trade.pk, 'trade_id'),
+                    portfolio=self.portfolio, security=self.security) \
+            .order_by('-trade_time', '-trade_id') \
+            .first()
+        if previous is not None:
+            self.count, self.average_price = previous.count, previous.average_price
+            trades = trades.filter(placed_after(previous.trade_time, previous.trade_id))
+        trades = trades.exclude(pk=self.trade.pk).select_related('snapshot').order_by('trade_time', 'id')
+
+        pending = self.replacement
+        for t in trades.iterator():
+            if pending is not None and (t.trade_time, t.pk) > (pending.trade_time, pending.pk):
+                self._apply(pending, error_message)
+                pending = None
+            self._apply(t, error_message)
+        if pending is not None:
+            self._apply(pending, error_message)
+        return self
+
+    def _apply(self, t, error_message):
+        self.count, self.average_price = apply_trade(self.count, self.average_price,
+                                                     t.trade_type, t.count, t.trade_price)
+        if self.count < 0:
+            raise ValidationError(error_message)
+        try:
+            snapshot = t.snapshot
+        except PositionSnapshot.DoesNotExist:
+            snapshot = PositionSnapshot(trade=t)
+        snapshot.portfolio = self.portfolio
+        snapshot.security = self.security
+        snapshot.trade_time = t.trade_time
+        snapshot.count = self.count
+        snapshot.average_price = self.average_price
+        self.snapshots.append(snapshot)
+
+    def save(self):
+        PositionSnapshot.objects.bulk_update([s for s in self.snapshots if s.pk is not None], SNAPSHOT_FIELDS,
+                                             batch_size=500)
+        PositionSnapshot.objects.bulk_create([s for s in self.snapshots if s.pk is None], batch_size=500)
+        position, created = Position.objects.get_or_create(
+            portfolio=self.portfolio, security=self.security,
+            defaults={'count': self.count, 'average_price': self.average_price})
+        old = (0, 0) if created else (position.count, position.average_price)
+        if not created:
+            position.count, position.average_price = self.count, self.average_price
+            position.version = F('version') + 1
+            position.save(update_fields=['count', 'average_price', 'version'])
+        apply_position_changes(self.portfolio.pk, [(self.security, *old, self.count, self.average_price)])
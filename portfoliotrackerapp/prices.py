@@ -0,0 +1,146 @@
+import csv
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+""" Market prices used to value positions. The provider is configured by PRICE_PROVIDER in settings """
+
+DEFAULT_PRICE_PROVIDER = {
+    'BACKEND': 'portfoliotrackerapp.prices.CSVPriceProvider',
+    'OPTIONS': {'path': 'prices.csv'},
+    'CACHE_TTL': 60,
+    'CACHE_MAX_ENTRIES': 10000,
+}
+
+
+class PriceProvider:
+    """
+    Source of current market prices. Lookups are always batched, one call per response,
+    so remote sources cost a single round trip.
+    """
+
+    def get_prices(self, securities):
+        """Returns {security: price} for the given securities that have a price"""
+        raise NotImplementedError
+
+
+class StaticPriceProvider(PriceProvider):
+    """Fixed prices given in settings, handy for tests and demos"""
+
+    def __init__(self, prices):
+        self.prices = dict(prices)
+
+    def get_prices(self, securities):
+        return {security: self.prices[security] for security in securities if security in self.prices}
+
+
+class CSVPriceProvider(PriceProvider):
+    """
+    Prices from a local CSV file of `security,price` rows. The file is re-read when it changes on disk,
+    so a price feed can simply overwrite it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self._prices = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return {}
+        with self._lock:
+            if mtime != self._mtime:
+                prices = {}
+                with open(self.path, newline='') as f:
+                    for row in csv.reader(f):
+                        if len(row) < 2 or row[0].strip().lower() == 'security':
+                            continue
+                        try:
+                            prices[row[0].strip()] = float(row[1])
+                        except ValueError:
+                            continue
+                self._prices, self._mtime = prices, mtime
+            return self._prices
+
+    def get_prices(self, securities):
+        prices = self._load()
+        return {security: prices[security] for security in securities if security in prices}
+
+
+class CachedPriceProvider(PriceProvider):
+    """
+    In-process TTL + LRU cache in front of another provider. All misses of a lookup go to the provider
+    in one batch. Securities the provider has no price for are cached as well, so they don't hit it again.
+    """
+
+    def __init__(self, provider, ttl=60, max_entries=10000):
+        self.provider = provider
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_prices(self, securities):
+        now = time.monotonic()
+        prices = {}
+        missing = []
+        with self._lock:
+            for security in set(securities):
+                entry = self._entries.get(security)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(security)
+                    if entry[1] is not None:
+                        prices[security] = entry[1]
+                else:
+                    missing.append(security)
+
+        if missing:
+            fetched = self.provider.get_prices(missing)
+            expires_at = time.monotonic() + self.ttl
+            with self._lock:
+                for security in missing:
+                    self._entries[security] = (expires_at, fetched.get(security))
+                    self._entries.move_to_end(security)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            prices.update({security: fetched[security] for security in missing if security in fetched})
+        return prices
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_provider = None
+
+
+def get_price_provider():
+    global _provider
+    if _provider is None:
+        config = {**DEFAULT_PRICE_PROVIDER, **getattr(settings, 'PRICE_PROVIDER', {})}
+        provider = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+        if config.get('CACHE_TTL'):
+            provider = CachedPriceProvider(provider, ttl=config['CACHE_TTL'],
+                                           max_entries=config.get('CACHE_MAX_ENTRIES', 10000))
+        _provider = provider
+    return _provider
+
+
+def get_prices(securities):
+    return get_price_provider().get_prices(securities)
+
+
+@receiver(setting_changed)
+def reset_price_provider(setting, **kwargs):
+    global _provider
+    if setting == 'PRICE_PROVIDER':
+        _provider = None
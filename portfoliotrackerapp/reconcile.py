@@ -0,0 +1,73 @@
+from django.db import connections, transaction
+
+from .models import *
+from .positions import apply_trade, lock_positions, same_position
+from .summaries import rebuild_summaries
+
+""" Reconciliation of stored positions against a replay of their trade streams, a chunk of portfolios at a time """
+
+BATCH_SIZE = 5000
+
+
+def replay_streams(portfolio_ids, batch_size=BATCH_SIZE):
+    """
+    Replays every trade stream of the portfolios. Trades are streamed in index order, through a server-side
+    cursor where the database has them, so memory holds one batch. Returns ({(portfolio, security): (count,
+    average_price)}, number of trades).
+    """
+    trades = Trade.objects.filter(portfolio__in=portfolio_ids) \
+        .order_by('portfolio', 'security', 'trade_time', 'id') \
+        .values_list('portfolio', 'security', 'trade_type', 'count', 'trade_price')
+    state = {}
+    replayed = 0
+    for portfolio_id, security, trade_type, count, trade_price in trades.iterator(chunk_size=batch_size):
+        key = (portfolio_id, security)
+        state[key] = apply_trade(*state.get(key, (0, 0)), trade_type, count, trade_price)
+        replayed += 1
+    return state, replayed
+
+
+def reconcile_portfolios(portfolio_ids, fix=False, batch_size=BATCH_SIZE):
+    """
+    Compares the positions of the portfolios with a replay of their trades. With `fix`, the positions are locked
+    first and mismatches are overwritten with the replay. Returns {'streams', 'trades', 'mismatches'}, mismatches
+    being (portfolio, security, stored, replayed) tuples.
+    """
+    with transaction.atomic():
+        if fix:
+            positions = {(p.portfolio_id, p.security): p for p in lock_positions(portfolio__in=portfolio_ids)}
+        else:
+            positions = {(p.portfolio_id, p.security): p for p in Position.objects.filter(portfolio__in=portfolio_ids)}
+        state, replayed = replay_streams(portfolio_ids, batch_size)
+
+        mismatches = []
+        for key in sorted(positions.keys() | state.keys()):
+            position = positions.get(key)
+            stored = (position.count, position.average_price) if position is not None else None
+            want = state.get(key, (0, 0))
+            if not same_position(stored or (0, 0), want):
+                mismatches.append((*key, stored, want))
+
+        if fix and mismatches:
+            changed, new = [], []
+            for portfolio_id, security, stored, (count, average_price) in mismatches:
+                if stored is None:
+                    new.append(Position(portfolio_id=portfolio_id, security=security, count=count,
+                                        average_price=average_price))
+                else:
+                    position = positions[(portfolio_id, security)]
+                    position.count, position.average_price = count, average_price
+                    position.version += 1
+                    changed.append(position)
+            Position.objects.bulk_update(changed, ['count', 'average_price', 'version'], batch_size=batch_size)
+            Position.objects.bulk_create(new, batch_size=batch_size)
+            rebuild_summaries(sorted({mismatch[0] for mismatch in mismatches}))
+    return {'streams': len(positions.keys() | state.keys()), 'trades': replayed, 'mismatches': mismatches}
+
+
+def reconcile_in_worker(portfolio_ids, fix=False, batch_size=BATCH_SIZE):
+    # Worker processes open their own connections, which are closed with the task
+    try:
+        return reconcile_portfolios(portfolio_ids, fix, batch_size)
+    finally:
+        connections.close_all()
@@ -0,0 +1,38 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.renderers import BaseRenderer
+
+
+class StreamFormatRenderer(BaseRenderer):
+    """
+    Makes an export format negotiable with ?format= or the Accept header. Export views stream their rows
+    themselves, so this only renders the odd error response, as JSON.
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return json.dumps(data, cls=DjangoJSONEncoder).encode()
+
+
+class CSVRenderer(StreamFormatRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class NDJSONRenderer(StreamFormatRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+class PrometheusRenderer(StreamFormatRenderer):
+    """Prometheus text exposition format. Errors are rendered as JSON"""
+    media_type = 'text/plain'
+    format = 'prometheus'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, str):
+            return data.encode()
+        return super().render(data, accepted_media_type, renderer_context)
@@ -0,0 +1,84 @@
+import contextvars
+import math
+import time
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.permissions import SAFE_METHODS
+
+"""
+Read replica routing. Heavy reads of the views using ReplicaReadMixin run on the READ_REPLICA alias, except for
+clients that wrote within the last MAX_LAG seconds, who keep reading from the primary so they see their writes
+"""
+
+DEFAULT_READ_REPLICA = {
+    # Database alias of the replica, None to read everything from the primary
+    'ALIAS': None,
+    # Seconds the replica may lag behind the primary
+    'MAX_LAG': 5,
+    'COOKIE': 'read_primary_until',
+}
+
+current_read_alias = contextvars.ContextVar('read_alias', default=None)
+
+
+def get_config():
+    return {**DEFAULT_READ_REPLICA, **getattr(settings, 'READ_REPLICA', {})}
+
+
+def reads_primary(request):
+    """Whether the client wrote recently enough that the replica may not have its writes yet"""
+    try:
+        return float(request.COOKIES.get(get_config()['COOKIE'], 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReadReplicaRouter:
+    """Sends reads to the replica while a ReplicaReadMixin view routes them there, and everything else to default"""
+
+    def db_for_read(self, model, **hints):
+        return current_read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica is a copy of the primary
+        return True
+
+
+class ReplicaReadMixin:
+    """
+    Runs safe requests to the actions in `replica_actions` on the read replica. Successful writes through the view
+    pin the client to the primary for MAX_LAG seconds, with a cookie.
+    """
+    replica_actions = ()
+
+    def dispatch(self, request, *args, **kwargs):
+        # Reset however the view exits, as DRF skips finalize_response() when an exception escapes it
+        token = current_read_alias.set(None)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            current_read_alias.reset(token)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        alias = get_config()['ALIAS']
+        if alias and request.method in SAFE_METHODS and self.action in self.replica_actions \
+                and not reads_primary(request):
+            current_read_alias.set(alias)
+
+    def get_queryset(self):
+        # Streamed responses are read after the view returns, so their querysets carry the alias themselves
+        queryset = super().get_queryset()
+        alias = current_read_alias.get()
+        return queryset.using(alias) if alias else queryset
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        config = get_config()
+        if config['ALIAS'] and request.method not in SAFE_METHODS and status.is_success(response.status_code):
+            response.set_cookie(config['COOKIE'], str(time.time() + config['MAX_LAG']),
+                                max_age=math.ceil(config['MAX_LAG']), httponly=True, samesite='Lax')
+        return super().finalize_response(request, response, *args, **kwargs)
@@ -1,40 +1,131 @@
+from django.db import IntegrityError, models, transaction
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
+from .database import retry_when_locked
+from .ledger import record_events, trade_event
+from .lots import record_lots, rewind_lots
+from .metrics import timed_serializer
 from .models import *
+from .position_book import get_book
+from .positions import StreamReplay, apply_trade_to_position, lock_positions, record_snapshot
+from .prices import get_prices
+from .summaries import apply_position_changes, market_value
 
 """ Serializer has most of our business logic """
 
 
-class PortfolioSerializer(serializers.ModelSerializer):
+class TimedSerializerMixin:
+    """Counts validation, saving and rendering towards the serializer time of request metrics"""
+
+    def run_validation(self, *args, **kwargs):
+        with timed_serializer():
+            return super().run_validation(*args, **kwargs)
+
+    def save(self, *args, **kwargs):
+        # Timed around save() so that create() and update() overrides are counted without calling super()
+        with timed_serializer():
+            return super().save(*args, **kwargs)
+
+    def to_representation(self, *args, **kwargs):
+        with timed_serializer():
+            return super().to_representation(*args, **kwargs)
+
+
+class PortfolioListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+    def to_representation(self, data):
+        # Marks for every security in the response are looked up in one batch
+        portfolios = list(data.all() if isinstance(data, models.Manager) else data)
+        self.context['prices'] = get_prices({position.security for portfolio in portfolios
+                                             for position in portfolio.position_set.all()})
+        return super().to_representation(portfolios)
+
+
+class PortfolioSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PortfolioSummary
+        fields = ('total_cost_basis', 'position_count', 'last_trade_time')
+
+
+class PortfolioSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     stocks = serializers.SerializerMethodField()
     returns = serializers.SerializerMethodField()
+    summary = serializers.SerializerMethodField()
 
     def get_stocks(self, portfolio):
-        allocations = Position.objects.filter(portfolio=portfolio)
-        serializer = PositionSerializer(data=allocations, many=True)
-        serializer.is_valid()
-        return serializer.data
+        return PositionSerializer(portfolio.position_set.all(), many=True).data
+
+    def get_market_value(self, portfolio):
+        # Marked at current prices over the positions prefetched by the viewset, as prices move without trades.
+        # Positions without a market price are valued at cost.
+        positions = [(position.security, position.count, position.average_price)
+                     for position in portfolio.position_set.all()]
+        prices = self.context.get('prices')
+        if prices is None:
+            prices = self.context['prices'] = get_prices({position[0] for position in positions})
+        return market_value(positions, prices)
 
     def get_returns(self, portfolio):
-        # Returns calculations are done during serialization.
-        positions = Position.objects.filter(portfolio=portfolio)
-        returns = 0
-        for position in positions:
-            # We assume current price of every stock as 100
-            returns += (100 - position.average_price) * position.count
-        return returns
+        if hasattr(portfolio, 'summary'):
+            cost_basis = portfolio.summary.total_cost_basis
+        else:
+            cost_basis = sum(position.count * position.average_price for position in portfolio.position_set.all())
+        return self.get_market_value(portfolio) - cost_basis
+
+    def get_summary(self, portfolio):
+        if not hasattr(portfolio, 'summary'):
+            return None
+        return {**PortfolioSummarySerializer(portfolio.summary).data,
+                'market_value': self.get_market_value(portfolio)}
 
     class Meta:
         model = Portfolio
         fields = '__all__'
+        list_serializer_class = PortfolioListSerializer
 
 
-class TradeSerializer(serializers.ModelSerializer):
+class PortfolioGroupSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = PortfolioGroup
+        fields = '__all__'
+
+
+class FieldSelectionMixin:
+    """Lets clients ask for a subset of fields with ?fields=a,b on GET requests"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is not None and request.method == 'GET' and request.query_params.get('fields'):
+            requested = set(request.query_params['fields'].split(','))
+            for name in set(self.fields) - requested:
+                self.fields.pop(name)
+
+
+class TradeSerializer(TimedSerializerMixin, FieldSelectionMixin, serializers.ModelSerializer):
+    # Trades without a price are booked at the current market price
+    trade_price = serializers.FloatField(required=False)
+
     class Meta:
         model = Trade
         fields = '__all__'
+        # Only set by bulk ingestion, which deduplicates on it
+        read_only_fields = ('broker_trade_id',)
 
     def validate(self, attrs):
+        if self.instance is not None:
+            # Updates are validated by replaying the trade stream in update()
+            return attrs
+        if 'trade_price' not in attrs:
+            prices = get_prices([attrs['security']])
+            if attrs['security'] not in prices:
+                raise serializers.ValidationError({'trade_price': 'No market price available for this security'})
+            attrs['trade_price'] = prices[attrs['security']]
+        book = get_book()
+        if book is not None:
+            if attrs['trade_type'] == Trade.SELL and \
+                    not book.can_sell(attrs['portfolio'].pk, attrs['security'], attrs['count']):
+                raise serializers.ValidationError('This trade results in invalid position')
+            return attrs
         try:
             positions_on_security = Position.objects.filter(portfolio=attrs['portfolio'],
                                                             security=attrs['security'])
@@ -51,103 +142,119 @@ class TradeSerializer(serializers.ModelSerializer):
         return attrs
 
     def create(self, validated_data):
-        positions_on_security = Position.objects.filter(portfolio=self.validated_data['portfolio'],
-                                                        security=self.validated_data['security'])
-        if len(positions_on_security) == 0:
-            Position.objects.create(
-                portfolio=self.validated_data['portfolio'],
-                security=self.validated_data['security'],
-                count=self.validated_data['count'],
-                average_price=self.validated_data['trade_price']
-            )
-        else:
-            position = positions_on_security[0]
-            if self.validated_data['trade_type'] == Trade.BUY:
-                new_average_price = (position.average_price * position.count + self.validated_data['trade_price'] * self.validated_data['count']) / (
-                        position.count + self.validated_data['count'])
-                position.count = position.count + self.validated_data['count']
-                position.average_price = new_average_price
-                position.save()
-            else:
-                position.count = position.count - self.validated_data['count']
-                position.save()
-        trade = Trade(**validated_data)
-        trade.save()
-        return trade
+        # validate() is only a fast path, the position is checked again under a lock by a conditional UPDATE
+        def write():
+            trade = Trade(**validated_data)
+            book = get_book()
+            with transaction.atomic():
+                old, new = book.apply_trade(trade) if book is not None else self.apply_to_locked_position(trade)
+                trade.save()
+                record_events([trade_event(trade, TradeEvent.CREATE)])
+                # New trades always land at the end of the stream, so the snapshot is the updated position
+                record_snapshot(trade, *new)
+                record_lots([trade], {trade.portfolio_id: trade.portfolio.lot_method})
+                apply_position_changes(trade.portfolio_id, [(trade.security, *old, *new)],
+                                       last_trade_time=trade.trade_time)
+            return trade
+
+        return retry_when_locked(write)
+
+    def apply_to_locked_position(self, trade):
+        """Returns the (count, average_price) of the position of a new trade before and after applying it"""
+        positions = lock_positions(portfolio=trade.portfolio, security=trade.security)
+        if len(positions) == 0 and trade.trade_type == Trade.BUY:
+            try:
+                with transaction.atomic():
+                    positions = [Position.objects.create(portfolio=trade.portfolio, security=trade.security,
+                                                         count=0, average_price=0)]
+            except IntegrityError:
+                # Another request opened this position in the meantime
+                positions = lock_positions(portfolio=trade.portfolio, security=trade.security)
+        if len(positions) == 0:
+            raise serializers.ValidationError('This trade results in invalid position')
+        position = positions[0]
+        old = (position.count, position.average_price)
+        if not apply_trade_to_position(position, trade):
+            raise serializers.ValidationError('This trade results in invalid position')
+        return old, (position.count, position.average_price)
 
     def update(self, trade, validated_data):
-        # Update is tricky as the security can change. We need to validate the positions for new as well
-        # as old security when the security change for a trade
-        trades_on_security = Trade.objects.filter(portfolio=trade.portfolio,
-                                                  security=trade.security) \
-            .order_by('trade_time')
-
-        count = 0
-        buy_count = 0
-        average_price = 0
-        for t in trades_on_security:
-            if t == trade:
-                if t.security == validated_data['security']:
-                    t = Trade(trade_type=validated_data['trade_type'],
-                              count=validated_data['count'],
-                              trade_price=validated_data['trade_price'])
-                else:
-                    continue
-
-            if t.trade_type == Trade.BUY:
-                count += t.count
-                buy_count += t.count
-                average_price += t.trade_price * t.count
-            else:
-                count -= t.count
-                # average_price -= t.trade_price * t.count
-            if count < 0:
-                raise ValidationError('Position becomes invalid on updating this trade')
-
-        # Handle security change on trade, need validation for positions on new security
-        if trade.security != validated_data['security']:
-            trades_on_security = Trade.objects.filter(portfolio=trade.portfolio,
-                                                      security=validated_data['security'])\
-                .order_by('trade_time')
-            count_new_sec = 0
-            average_price_new_sec = 0
-            for t in trades_on_security:
-                if trade.time_of_addition > t.time_of_addition:
-                    t = Trade(trade_type=validated_data['trade_type'],
-                              count=validated_data['count'],
-                              average_price=validated_data['average_price'])
-                if t.trade_type == Trade.BUY:
-                    count_new_sec += t.count
-                    average_price_new_sec += t.trade_price * t.count
-                else:
-                    count_new_sec -= t.count
-                    average_price_new_sec -= t.trade_price * t.count
-                if count_new_sec < 0:
-                    raise ValidationError('Position becomes invalid on updating this trade')
+        # Update is tricky as the security can change. The trade is replayed in place on its old stream, or dropped
+        # from it when the security changes, in which case it is also inserted into the new security's stream at the
+        # same point in time. Both replays restart from the snapshot just before the trade.
+        old_security = trade.security
+        for field in ('security', 'count', 'trade_type', 'trade_price'):
+            setattr(trade, field, validated_data.get(field, getattr(trade, field)))
 
-        if buy_count != 0:
-            average_price /= buy_count
-        else:
-            average_price = 0
-
-        positions_on_security = Position.objects.filter(portfolio=trade.portfolio, security=trade.security)
-        # Ideally positions can be time series snapshots for every new trade. For simplicity, storing only latest now.
-        # Former way helps with lower compute as only positions post that point need to be checked.
-        if len(positions_on_security) > 0:
-            position = positions_on_security[0]
-            position.count = count
-            position.average_price = average_price
-            position.save()
-
-        trade.security = validated_data['security']
-        trade.count = validated_data['count']
-        trade.trade_type = validated_data['trade_type']
-        trade.trade_price = validated_data['trade_price']
-        trade.save()
+        def write():
+            with transaction.atomic():
+                lock_positions(portfolio=trade.portfolio, security__in={old_security, trade.security})
+                replays = [StreamReplay(trade.portfolio, old_security, trade,
+                                        replacement=trade if trade.security == old_security else None)]
+                if trade.security != old_security:
+                    replays.append(StreamReplay(trade.portfolio, trade.security, trade, replacement=trade))
+                for replay in replays:
+                    replay.run('Position becomes invalid on updating this trade')
+                for replay in replays:
+                    replay.save()
+                trade.save()
+                previous_security = old_security if old_security != trade.security else None
+                record_events([trade_event(trade, TradeEvent.AMEND, previous_security=previous_security)])
+                rewind_lots(trade.portfolio_id, {old_security, trade.security}, trade)
+
+        retry_when_locked(write)
         return trade
 
 
-class PositionSerializer(serializers.ModelSerializer):
+class TradeRowSerializer(serializers.ModelSerializer):
+    """Field checks for a row of a bulk trade upload. Portfolios and positions are checked once per batch"""
+    portfolio = serializers.IntegerField(source='portfolio_id')
+    trade_price = serializers.FloatField(required=False)
+
+    class Meta:
+        model = Trade
+        fields = ('portfolio', 'security', 'count', 'trade_type', 'trade_price', 'broker_trade_id')
+
+    def validate_broker_trade_id(self, value):
+        return value or None
+
+
+class PositionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Position
         fields = ('security', 'count', 'average_price')
+
+
+class LotSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Lot
+        fields = ('trade', 'security', 'acquired_at', 'quantity', 'remaining', 'price')
+
+
+class LotClosureSerializer(serializers.ModelSerializer):
+    security = serializers.CharField(source='lot.security')
+    cost_price = serializers.FloatField(source='lot.price')
+
+    class Meta:
+        model = LotClosure
+        fields = ('lot', 'sell_trade', 'security', 'count', 'cost_price', 'sell_price', 'realized_pnl', 'closed_at')
+
+
+class QueuedTradeSerializer(serializers.ModelSerializer):
+    # Trades without a price are booked at the market price of the time they are queued
+    trade_price = serializers.FloatField(required=False)
+
+    class Meta:
+        model = QueuedTrade
+        fields = ('id', 'portfolio', 'security', 'count', 'trade_type', 'trade_price', 'status', 'trade', 'errors',
+                  'queued_at', 'applied_at')
+        read_only_fields = ('status', 'trade', 'errors', 'queued_at', 'applied_at')
+
+    def validate(self, attrs):
+        # Positions are checked when the trade is applied
+        if 'trade_price' not in attrs:
+            prices = get_prices([attrs['security']])
+            if attrs['security'] not in prices:
+                raise serializers.ValidationError({'trade_price': 'No market price available for this security'})
+            attrs['trade_price'] = prices[attrs['security']]
+        return attrs
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent once a transaction that changed positions has committed, with the ids of the affected portfolios
+# as `portfolio_ids`.
+positions_changed = Signal()
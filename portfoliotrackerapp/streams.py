@@ -0,0 +1,210 @@
+import asyncio
+import json
+import re
+import threading
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.dispatch import receiver
+
+from .async_views import get_config, run_in_db_thread
+from .caching import get_version, sync_version
+from .models import *
+from .prices import get_prices
+from .signals import positions_changed
+from .summaries import market_value
+
+"""
+Server-sent event streams of portfolio positions, for ASGI deployments. The process keeps the last state sent for
+every portfolio with subscribers. A trade change is diffed against it, serialized once into a delta event and
+handed to the queue of every subscriber, so streams cost nothing while a portfolio is unchanged.
+"""
+
+STREAM_PATH = re.compile(r'^/api/v1/async/portfolio/(?P<pk>[0-9]+)/stream/$')
+SUMMARY_FIELDS = ('total_cost_basis', 'position_count', 'last_trade_time')
+# Queued in place of the events a slow subscriber missed, which then gets a new snapshot
+RESYNC = object()
+
+
+def event(sequence, name, data):
+    payload = json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return f'id: {sequence}\nevent: {name}\ndata: {payload}\n\n'.encode()
+
+
+def position_list(positions, securities):
+    return [{'security': security, 'count': positions.get(security, (0, 0))[0],
+             'average_price': positions.get(security, (0, 0))[1]} for security in sorted(securities)]
+
+
+class Channel:
+    """Subscribers of a portfolio and the state last sent to them"""
+
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.positions = None
+        self.summary = None
+        self.version = None
+        self.sequence = 0
+
+
+class PortfolioBroadcaster:
+    def __init__(self):
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, portfolio_id):
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(get_config()['STREAM_QUEUE_SIZE']))
+        with self._lock:
+            self._channels.setdefault(portfolio_id, Channel()).subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, portfolio_id, subscriber):
+        with self._lock:
+            channel = self._channels.get(portfolio_id)
+            if channel is not None:
+                channel.subscribers.discard(subscriber)
+                if not channel.subscribers:
+                    del self._channels[portfolio_id]
+
+    def _load(self, channel, portfolio_id):
+        # The version is read first, so a change committed during the reads makes the state stale rather than lost
+        channel.version = get_version(portfolio_id)
+        channel.positions = {security: (count, average_price) for security, count, average_price in
+                             Position.objects.filter(portfolio_id=portfolio_id)
+                             .values_list('security', 'count', 'average_price')}
+        channel.summary = PortfolioSummary.objects.filter(portfolio_id=portfolio_id).values(*SUMMARY_FIELDS).first()
+        if channel.summary is not None:
+            positions = [(security, *position) for security, position in channel.positions.items()]
+            channel.summary['market_value'] = market_value(positions, get_prices(channel.positions))
+            channel.summary['returns'] = channel.summary['market_value'] - channel.summary['total_cost_basis']
+
+    def snapshot(self, portfolio_id):
+        """The snapshot event of a portfolio with subscribers, from the state last sent to them"""
+        with self._lock:
+            channel = self._channels[portfolio_id]
+        with channel.lock:
+            if channel.positions is None:
+                self._load(channel, portfolio_id)
+            channel.sequence += 1
+            return event(channel.sequence, 'snapshot', {
+                'portfolio': portfolio_id,
+                'positions': position_list(channel.positions, channel.positions),
+                'summary': channel.summary,
+            })
+
+    def publish(self, portfolio_ids):
+        """Sends the positions that changed since the last event to the subscribers of the given portfolios"""
+        for portfolio_id in portfolio_ids:
+            with self._lock:
+                channel = self._channels.get(int(portfolio_id))
+            if channel is None:
+                continue
+            with channel.lock:
+                if channel.positions is None:
+                    continue
+                positions, summary = channel.positions, channel.summary
+                self._load(channel, int(portfolio_id))
+                changed = {security for security in positions.keys() | channel.positions.keys()
+                           if positions.get(security) != channel.positions.get(security)}
+                if not changed and summary == channel.summary:
+                    continue
+                channel.sequence += 1
+                frame = event(channel.sequence, 'delta', {
+                    'portfolio': int(portfolio_id),
+                    'positions': position_list(channel.positions, changed),
+                    'summary': channel.summary,
+                })
+                subscribers = list(channel.subscribers)
+            for loop, queue in subscribers:
+                try:
+                    loop.call_soon_threadsafe(self._deliver, queue, frame)
+                except RuntimeError:
+                    # The subscriber's event loop is closed
+                    pass
+
+    def refresh(self, portfolio_id):
+        """Publishes changes made by other processes, which are only noticed through the portfolio's summary"""
+        with self._lock:
+            channel = self._channels.get(portfolio_id)
+        if channel is not None and channel.version != sync_version(portfolio_id):
+            self.publish([portfolio_id])
+
+    @staticmethod
+    def _deliver(queue, frame):
+        if queue.full():
+            while not queue.empty():
+                queue.get_nowait()
+            frame = RESYNC
+        queue.put_nowait(frame)
+
+
+broadcaster = PortfolioBroadcaster()
+
+
+@receiver(positions_changed)
+def publish_position_changes(sender, portfolio_ids, **kwargs):
+    broadcaster.publish(portfolio_ids)
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def portfolio_stream(scope, receive, send, portfolio_id):
+    """
+    Streams a snapshot event of the portfolio's positions and summary, then a delta event with the positions that
+    changed and the new summary after every trade change. A comment line is sent every STREAM_HEARTBEAT seconds
+    while nothing changes.
+    """
+    if scope['method'] != 'GET':
+        return await send_json(send, 405, {'detail': f'Method "{scope["method"]}" not allowed.'})
+    if not await run_in_db_thread(Portfolio.objects.filter(pk=portfolio_id).exists):
+        return await send_json(send, 404, {'detail': 'Not found.'})
+
+    subscriber = broadcaster.subscribe(portfolio_id)
+    queue = subscriber[1]
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            # Keeps proxies such as nginx from buffering the stream
+            (b'x-accel-buffering', b'no'),
+        ]})
+        frame = await run_in_db_thread(broadcaster.snapshot, portfolio_id)
+        while True:
+            if frame is RESYNC:
+                frame = await run_in_db_thread(broadcaster.snapshot, portfolio_id)
+            await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+            getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({getter, disconnect}, timeout=get_config()['STREAM_HEARTBEAT'],
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnect in done:
+                getter.cancel()
+                return
+            if getter in done:
+                frame = getter.result()
+            else:
+                getter.cancel()
+                await run_in_db_thread(broadcaster.refresh, portfolio_id)
+                frame = b': heartbeat\n\n'
+    finally:
+        disconnect.cancel()
+        broadcaster.unsubscribe(portfolio_id, subscriber)
+
+
+async def send_json(send, status, data):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': json.dumps(data).encode()})
+
+
+def stream_application(application):
+    """Serves portfolio streams in front of the Django ASGI application, which can't stream asynchronously"""
+    async def router(scope, receive, send):
+        match = STREAM_PATH.match(scope['path']) if scope['type'] == 'http' else None
+        if match is None:
+            return await application(scope, receive, send)
+        return await portfolio_stream(scope, receive, send, int(match['pk']))
+    return router
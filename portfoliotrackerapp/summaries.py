@@ -0,0 +1,84 @@
+from django.db import transaction
+from django.db.models import F, Max
+from django.utils import timezone
+
+from .caching import invalidate_portfolios
+from .models import *
+from .signals import positions_changed
+
+""" Materialized portfolio totals. Trade changes apply deltas to them, rebuild_summaries recomputes them """
+
+SUMMARY_FIELDS = ('total_cost_basis', 'position_count', 'last_trade_time', 'updated_at')
+
+
+def position_value(count, average_price, price):
+    # Positions without a market price are valued at cost
+    return count * (average_price if price is None else price)
+
+
+def market_value(positions, prices):
+    """Value of (security, count, average_price) positions at the given {security: price}"""
+    return sum(position_value(count, average_price, prices.get(security))
+               for security, count, average_price in positions)
+
+
+def apply_position_changes(portfolio_id, changes, last_trade_time=None):
+    """
+    Applies position changes to the summary of a portfolio with a single UPDATE, in the caller's transaction.
+    `changes` holds (security, old_count, old_average_price, new_count, new_average_price) tuples and
+    positions must already be saved, as a portfolio without a summary yet gets one built from them.
+    """
+    cost = position_count = 0
+    for security, old_count, old_average_price, new_count, new_average_price in changes:
+        cost += new_count * new_average_price - old_count * old_average_price
+        position_count += (new_count > 0) - (old_count > 0)
+
+    updates = {
+        'total_cost_basis': F('total_cost_basis') + cost,
+        'position_count': F('position_count') + position_count,
+        'updated_at': timezone.now(),
+    }
+    if last_trade_time is not None:
+        updates['last_trade_time'] = last_trade_time
+    if not PortfolioSummary.objects.filter(portfolio_id=portfolio_id).update(**updates):
+        rebuild_summaries([portfolio_id])
+    else:
+        notify_positions_changed([portfolio_id])
+
+
+def notify_positions_changed(portfolio_ids):
+    # Cached responses are dropped right away, so this request never reads its own stale data, and the signal
+    # follows once the change is committed, when it drops anything a concurrent reader cached in between
+    invalidate_portfolios(portfolio_ids)
+    transaction.on_commit(lambda: positions_changed.send(sender=Position, portfolio_ids=portfolio_ids))
+
+
+def refresh_last_trade_time(portfolio_id):
+    last_trade_time = Trade.objects.filter(portfolio_id=portfolio_id).aggregate(last=Max('trade_time'))['last']
+    PortfolioSummary.objects.filter(portfolio_id=portfolio_id).update(last_trade_time=last_trade_time,
+                                                                     updated_at=timezone.now())
+
+
+def compute_summaries(portfolio_ids):
+    """Summaries of the given portfolios computed from scratch. Not saved."""
+    positions = Position.objects.filter(portfolio__in=portfolio_ids).values_list('portfolio', 'count', 'average_price')
+    last_trade_times = dict(Trade.objects.filter(portfolio__in=portfolio_ids).values_list('portfolio')
+                            .annotate(last=Max('trade_time')).order_by())
+
+    now = timezone.now()
+    summaries = {pk: PortfolioSummary(portfolio_id=pk, last_trade_time=last_trade_times.get(pk), updated_at=now)
+                 for pk in portfolio_ids}
+    for portfolio_id, count, average_price in positions:
+        summary = summaries[portfolio_id]
+        summary.total_cost_basis += count * average_price
+        summary.position_count += count > 0
+    return summaries
+
+
+def rebuild_summaries(portfolio_ids):
+    summaries = compute_summaries(portfolio_ids)
+    existing = set(PortfolioSummary.objects.filter(portfolio__in=portfolio_ids).values_list('portfolio', flat=True))
+    PortfolioSummary.objects.bulk_update([s for pk, s in summaries.items() if pk in existing], SUMMARY_FIELDS)
+    PortfolioSummary.objects.bulk_create([s for pk, s in summaries.items() if pk not in existing])
+    notify_positions_changed(list(portfolio_ids))
+    return summaries
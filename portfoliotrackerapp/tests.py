@@ -1,8 +1,54 @@
-from django.test import TestCase
+import asyncio
+import csv
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import sqlite3
+import threading
+import time
+import tempfile
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import CommandError, call_command
+from django.core.management.base import SystemCheckError
+from django.db import connection
+from django.db.models import F
+from django.test import Client, TestCase, TransactionTestCase, override_settings
 from django.test.client import encode_multipart
+from django.test.utils import CaptureQueriesContext
 
+from .analytics import load_trades
+from .caching import get_cache, invalidate_portfolios
+from .ingest import ingest_trades
+from .ledger import checkpoint_portfolio, latest_checkpoint, position_drift, project_positions
+from .metrics import registry
 from .models import *
+from .position_book import PositionBook, book
+from .positions import StreamReplay, apply_trade
+from .prices import CachedPriceProvider, CSVPriceProvider, PriceProvider
+from .replicas import current_read_alias
 from .serializers import TradeSerializer
+from .signals import positions_changed
+from .streams import broadcaster, stream_application
+
+
+# Under settings_replica the other tests would read the replica, which they leave empty. Only TestReadReplicas
+# turns it on.
+primary_reads = override_settings(READ_REPLICA={'ALIAS': None})
+
+
+def setUpModule():
+    primary_reads.enable()
+
+
+def tearDownModule():
+    primary_reads.disable()
 
 
 class TestPortfolioTracker(TestCase):
@@ -12,7 +58,7 @@ class TestPortfolioTracker(TestCase):
     def test_add_trades(self):
         # Initially no trades
         res = self.client.get('/api/v1/trade/')
-        self.assertEqual(0, len(res.data))
+        self.assertEqual(0, len(res.data['results']))
 
         # Add a buy trade
         data = {
@@ -27,7 +73,7 @@ class TestPortfolioTracker(TestCase):
 
         # Verify trade exists
         res = self.client.get('/api/v1/trade/')
-        self.assertEqual(1, len(res.data))
+        self.assertEqual(1, len(res.data['results']))
         res = self.client.get('/api/v1/trade/1/')
         # Compare data to original posted
         serializer = TradeSerializer(data=res.data)
@@ -211,7 +257,7 @@ class TestPortfolioTracker(TestCase):
         self.assertEqual(1, len(res.data['stocks']))
         self.assertEqual('TCS', res.data['stocks'][0]['security'])
         self.assertEqual(1, res.data['stocks'][0]['count'])
-        self.assertEqual(60.0, res.data['stocks'][0]['average_price'])
+        self.assertEqual(110.0, res.data['stocks'][0]['average_price'])
 
         # Update first BUY trade quantity to valid qty. Should PASS
         data = {
@@ -231,8 +277,10 @@ class TestPortfolioTracker(TestCase):
         self.assertEqual(1, len(res.data['stocks']))
         self.assertEqual('TCS', res.data['stocks'][0]['security'])
         self.assertEqual(5, res.data['stocks'][0]['count'])
-        self.assertEqual(100.0, res.data['stocks'][0]['average_price'])
+        self.assertEqual(110.0, res.data['stocks'][0]['average_price'])
 
+    @override_settings(PRICE_PROVIDER={'BACKEND': 'portfoliotrackerapp.prices.StaticPriceProvider',
+                                       'OPTIONS': {'prices': {'TCS': 130}}})
     def test_fetch_returns(self):
         # Add a BUY trade
         data = {
@@ -264,3 +312,1473 @@ class TestPortfolioTracker(TestCase):
         self.assertEqual('TCS', res.data['stocks'][0]['security'])
         self.assertEqual(20, res.data['stocks'][0]['count'])
         self.assertEqual(115.0, res.data['stocks'][0]['average_price'])
+
+
+class TestPositionSnapshots(TestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+
+    def add_trade(self, security, count, trade_type, trade_price):
+        data = {
+            'portfolio': self.p1.id,
+            'security': security,
+            'count': count,
+            'trade_type': trade_type,
+            'trade_price': trade_price
+        }
+        res = self.client.post('/api/v1/trade/', data)
+        self.assertEqual(201, res.status_code)
+        return res.data['id']
+
+    def snapshots(self, security):
+        return list(PositionSnapshot.objects.filter(portfolio=self.p1, security=security)
+                    .order_by('trade_time', 'trade_id').values_list('count', 'average_price'))
+
+    def test_snapshot_recorded_per_trade(self):
+        self.add_trade('TCS', 10, 'B', 100)
+        self.add_trade('TCS', 10, 'B', 200)
+        self.add_trade('TCS', 5, 'S', 300)
+        self.assertEqual([(10, 100.0), (20, 150.0), (15, 150.0)], self.snapshots('TCS'))
+
+    def test_delete_replays_tail(self):
+        self.add_trade('TCS', 10, 'B', 100)
+        second = self.add_trade('TCS', 10, 'B', 200)
+        self.add_trade('TCS', 5, 'S', 300)
+        self.add_trade('TCS', 5, 'B', 100)
+
+        res = self.client.delete(f'/api/v1/trade/{second}/')
+        self.assertEqual(204, res.status_code)
+        self.assertEqual([(10, 100.0), (5, 100.0), (10, 100.0)], self.snapshots('TCS'))
+        position = Position.objects.get(portfolio=self.p1, security='TCS')
+        self.assertEqual((10, 100.0), (position.count, position.average_price))
+
+    def test_update_moves_trade_between_securities(self):
+        self.add_trade('INFY', 10, 'B', 50)
+        first = self.add_trade('TCS', 10, 'B', 100)
+        self.add_trade('TCS', 10, 'B', 200)
+        self.add_trade('INFY', 10, 'S', 60)
+
+        data = {'portfolio': self.p1.id, 'security': 'INFY', 'count': 10, 'trade_type': 'B', 'trade_price': 80}
+        res = self.client.put(f'/api/v1/trade/{first}/', data, content_type='application/json')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual([(10, 200.0)], self.snapshots('TCS'))
+        self.assertEqual([(10, 50.0), (20, 65.0), (10, 65.0)], self.snapshots('INFY'))
+        position = Position.objects.get(portfolio=self.p1, security='INFY')
+        self.assertEqual((10, 65.0), (position.count, position.average_price))
+
+    def test_backfill_matches_incremental_snapshots(self):
+        self.add_trade('TCS', 10, 'B', 100)
+        self.add_trade('INFY', 4, 'B', 10)
+        self.add_trade('TCS', 10, 'B', 200)
+        self.add_trade('TCS', 20, 'S', 300)
+        expected = self.snapshots('TCS'), self.snapshots('INFY')
+
+        PositionSnapshot.objects.all().delete()
+        call_command('backfill_snapshots', stdout=io.StringIO())
+        self.assertEqual(expected, (self.snapshots('TCS'), self.snapshots('INFY')))
+
+
+class TestBulkTrades(TestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+        self.p2 = Portfolio.objects.create(name='Second Portfolio')
+
+    def rows(self):
+        return [
+            {'portfolio': self.p1.id, 'security': 'TCS', 'count': 10, 'trade_type': 'B', 'trade_price': 100},
+            {'portfolio': self.p1.id, 'security': 'TCS', 'count': 15, 'trade_type': 'S', 'trade_price': 110},
+            {'portfolio': self.p2.id, 'security': 'TCS', 'count': 5, 'trade_type': 'B', 'trade_price': 90},
+            {'portfolio': self.p1.id, 'security': 'TCS', 'count': 10, 'trade_type': 'B', 'trade_price': 200},
+            {'portfolio': self.p1.id, 'security': 'TCS', 'count': 15, 'trade_type': 'S', 'trade_price': 110},
+            {'portfolio': self.p1.id, 'security': 'INFY', 'count': -1, 'trade_type': 'B', 'trade_price': 10},
+            {'portfolio': 999, 'security': 'INFY', 'count': 1, 'trade_type': 'B', 'trade_price': 10},
+        ]
+
+    def test_bulk_json_reports_row_errors(self):
+        res = self.client.post('/api/v1/trade/bulk/', self.rows(), content_type='application/json')
+        self.assertEqual(201, res.status_code)
+        self.assertEqual(4, res.data['created'])
+        self.assertEqual([1, 5, 6], [error['row'] for error in res.data['errors']])
+
+        position = Position.objects.get(portfolio=self.p1, security='TCS')
+        self.assertEqual((5, 150.0), (position.count, position.average_price))
+        position = Position.objects.get(portfolio=self.p2, security='TCS')
+        self.assertEqual((5, 90.0), (position.count, position.average_price))
+        self.assertEqual(4, PositionSnapshot.objects.count())
+        self.assertEqual(sorted(res.data['ids']), sorted(Trade.objects.values_list('id', flat=True)))
+
+        # Trades added later on keep replaying from the bulk snapshots
+        res = self.client.delete(f"/api/v1/trade/{res.data['ids'][0]}/")
+        self.assertEqual(400, res.status_code)
+
+    def test_bulk_ndjson(self):
+        body = '\n'.join(json.dumps(row) for row in self.rows()[:5])
+        res = self.client.post('/api/v1/trade/bulk/', body, content_type='application/x-ndjson')
+        self.assertEqual(201, res.status_code)
+        self.assertEqual(4, res.data['created'])
+        self.assertEqual(4, Trade.objects.count())
+
+    def test_bulk_atomic_rejects_whole_batch(self):
+        res = self.client.post('/api/v1/trade/bulk/?atomic=true', self.rows(), content_type='application/json')
+        self.assertEqual(400, res.status_code)
+        self.assertEqual(0, res.data['created'])
+        self.assertEqual(0, Trade.objects.count())
+        self.assertEqual(0, Position.objects.count())
+
+    def test_bulk_query_count_is_independent_of_batch_size(self):
+        rows = [{'portfolio': self.p1.id, 'security': f'S{i % 50}', 'count': 1, 'trade_type': 'B',
+                 'trade_price': 10} for i in range(500)]
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.post('/api/v1/trade/bulk/', rows, content_type='application/json')
+        self.assertEqual(500, res.data['created'])
+        # Inserts are batched, nothing is queried per row
+        self.assertLess(len(queries), 50)
+
+
+@override_settings(PRICE_PROVIDER={'BACKEND': 'portfoliotrackerapp.prices.StaticPriceProvider',
+                                   'OPTIONS': {'prices': {'TCS': 100, 'INFY': 100, 'WIPRO': 100}}})
+class TestPortfolioQueries(TestCase):
+    def add_portfolio(self, index):
+        portfolio = Portfolio.objects.create(name=f'Portfolio {index}')
+        for security in ('TCS', 'INFY', 'WIPRO'):
+            Position.objects.create(portfolio=portfolio, security=security, count=10, average_price=90)
+        return portfolio
+
+    def test_list_query_count_is_constant(self):
+        self.add_portfolio(0)
+        with CaptureQueriesContext(connection) as single:
+            res = self.client.get('/api/v1/portfolio/')
+        self.assertEqual(1, len(res.data))
+
+        for index in range(1, 10):
+            self.add_portfolio(index)
+        with self.assertNumQueries(len(single)):
+            res = self.client.get('/api/v1/portfolio/')
+        self.assertEqual(10, len(res.data))
+        self.assertEqual(3, len(res.data[0]['stocks']))
+        self.assertEqual(300, res.data[0]['returns'])
+
+    def test_detail_fetches_positions_once(self):
+        portfolio = self.add_portfolio(0)
+        with self.assertNumQueries(2):
+            res = self.client.get(f'/api/v1/portfolio/{portfolio.id}/')
+        self.assertEqual(['TCS', 'INFY', 'WIPRO'], [stock['security'] for stock in res.data['stocks']])
+
+
+class CountingPriceProvider(PriceProvider):
+    def __init__(self, prices):
+        self.prices = prices
+        self.calls = []
+
+    def get_prices(self, securities):
+        self.calls.append(sorted(securities))
+        return {security: self.prices[security] for security in securities if security in self.prices}
+
+
+class TestPrices(TestCase):
+    def test_cache_batches_misses_and_expires(self):
+        source = CountingPriceProvider({'TCS': 10, 'INFY': 20})
+        provider = CachedPriceProvider(source, ttl=60)
+        self.assertEqual({'TCS': 10}, provider.get_prices(['TCS']))
+        self.assertEqual({'TCS': 10, 'INFY': 20}, provider.get_prices(['TCS', 'INFY', 'WIPRO']))
+        self.assertEqual({'TCS': 10, 'INFY': 20}, provider.get_prices(['TCS', 'INFY', 'WIPRO']))
+        self.assertEqual([['TCS'], ['INFY', 'WIPRO']], source.calls)
+
+        provider.ttl = 0
+        provider.clear()
+        provider.get_prices(['TCS'])
+        provider.get_prices(['TCS'])
+        self.assertEqual(4, len(source.calls))
+
+    def test_cache_evicts_least_recently_used(self):
+        source = CountingPriceProvider({'A': 1, 'B': 2, 'C': 3})
+        provider = CachedPriceProvider(source, ttl=60, max_entries=2)
+        provider.get_prices(['A'])
+        provider.get_prices(['B'])
+        provider.get_prices(['A'])
+        provider.get_prices(['C'])
+        provider.get_prices(['A'])
+        self.assertEqual([['A'], ['B'], ['C']], source.calls)
+        provider.get_prices(['B'])
+        self.assertEqual([['A'], ['B'], ['C'], ['B']], source.calls)
+
+    def test_csv_provider(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('security,price\nTCS,3100.5\nINFY,bad\n')
+        self.addCleanup(os.remove, f.name)
+        self.assertEqual({'TCS': 3100.5}, CSVPriceProvider(f.name).get_prices(['TCS', 'INFY', 'WIPRO']))
+        self.assertEqual({}, CSVPriceProvider(f.name + '.missing').get_prices(['TCS']))
+
+    def test_portfolio_list_looks_up_prices_once(self):
+        source = CountingPriceProvider({'TCS': 120, 'INFY': 10})
+        for index in range(5):
+            portfolio = Portfolio.objects.create(name=f'Portfolio {index}')
+            Position.objects.create(portfolio=portfolio, security='TCS', count=10, average_price=100)
+            Position.objects.create(portfolio=portfolio, security='INFY', count=10, average_price=10)
+        with mock.patch('portfoliotrackerapp.serializers.get_prices', source.get_prices):
+            res = self.client.get('/api/v1/portfolio/')
+        self.assertEqual([200] * 5, [portfolio['returns'] for portfolio in res.data])
+        self.assertEqual([['INFY', 'TCS']], source.calls)
+
+    @override_settings(PRICE_PROVIDER={'BACKEND': 'portfoliotrackerapp.prices.StaticPriceProvider',
+                                       'OPTIONS': {'prices': {'TCS': 130}}})
+    def test_trade_without_price_uses_market_price(self):
+        portfolio = Portfolio.objects.create(name='First Portfolio')
+        res = self.client.post('/api/v1/trade/', {'portfolio': portfolio.id, 'security': 'TCS', 'count': 1,
+                                                  'trade_type': 'B'})
+        self.assertEqual(201, res.status_code)
+        self.assertEqual(130, res.data['trade_price'])
+        res = self.client.post('/api/v1/trade/', {'portfolio': portfolio.id, 'security': 'INFY', 'count': 1,
+                                                  'trade_type': 'B'})
+        self.assertEqual(400, res.status_code)
+
+
+class TestAnalytics(TestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+
+    def add_trade(self, day, security, count, trade_type, trade_price):
+        trade = Trade.objects.create(portfolio=self.p1, security=security, count=count, trade_type=trade_type,
+                                     trade_price=trade_price)
+        trade_time = datetime.datetime(2021, 1, day, 10, tzinfo=datetime.timezone.utc)
+        Trade.objects.filter(pk=trade.pk).update(trade_time=trade_time)
+
+    def test_cost_basis_matches_replay(self):
+        rng = random.Random(7)
+        held = {}
+        for index in range(300):
+            security = rng.choice(['TCS', 'INFY', 'WIPRO'])
+            position = held.get(security, 0)
+            if position and rng.random() < 0.4:
+                count = position if rng.random() < 0.3 else rng.randint(1, position)
+                trade_type = 'S'
+                held[security] = position - count
+            else:
+                count = rng.randint(1, 50)
+                trade_type = 'B'
+                held[security] = position + count
+            self.add_trade(1 + index // 20, security, count, trade_type, rng.uniform(10, 200))
+
+        arrays = load_trades(self.p1)
+        expected = {}
+        for security, trade_type, count, price, _ in Trade.objects.order_by('trade_time', 'id') \
+                .values_list('security', 'trade_type', 'count', 'trade_price', 'trade_time'):
+            state = expected.setdefault(security, [])
+            state.append(apply_trade(*(state[-1] if state else (0, 0)), trade_type, count, price))
+        for index, name in enumerate(arrays.names):
+            rows = arrays.security == index
+            counts, average_prices = zip(*expected[name])
+            self.assertEqual(list(counts), list(arrays.position[rows]))
+            cost = [count * average_price for count, average_price in expected[name]]
+            for value, vectorized in zip(cost, arrays.cost[rows]):
+                self.assertAlmostEqual(value, vectorized, places=6)
+
+    def test_cost_basis_over_many_partial_sells(self):
+        for day in range(1, 31):
+            for _ in range(20):
+                self.add_trade(day, 'TCS', 1000, 'B', 50)
+                self.add_trade(day, 'TCS', 999, 'S', 60)
+
+        arrays = load_trades(self.p1)
+        self.assertEqual(600, arrays.position[-1])
+        self.assertAlmostEqual(600 * 50, arrays.cost[-1], places=6)
+
+        res = self.client.get(f'/api/v1/portfolio/{self.p1.id}/analytics/?from=2021-01-01&to=2021-01-31')
+        self.assertEqual(200, res.status_code)
+        self.assertAlmostEqual(600 * 50, res.data['equity_curve'][-1]['cost_basis'], places=6)
+        self.assertAlmostEqual(600 * 999 * 10, res.data['realized_pnl'], places=3)
+
+    def test_analytics_endpoint(self):
+        self.add_trade(1, 'TCS', 10, 'B', 100)
+        self.add_trade(2, 'TCS', 10, 'B', 120)
+        self.add_trade(3, 'TCS', 10, 'S', 130)
+        self.add_trade(4, 'INFY', 5, 'B', 10)
+
+        res = self.client.get(f'/api/v1/portfolio/{self.p1.id}/analytics/?from=2021-01-01&to=2021-01-04')
+        self.assertEqual(200, res.status_code)
+        self.assertAlmostEqual(200.0, res.data['realized_pnl'])
+        self.assertAlmostEqual(200.0, res.data['unrealized_pnl'])
+        curve = res.data['equity_curve']
+        self.assertEqual([datetime.date(2021, 1, day) for day in range(1, 5)], [point['date'] for point in curve])
+        self.assertEqual([1000.0, 2400.0, 1300.0, 1350.0], [point['market_value'] for point in curve])
+        self.assertEqual([1000.0, 2200.0, 1100.0, 1150.0], [point['cost_basis'] for point in curve])
+        # Day 2 is +200 on 1000, day 3 +200 on 2400 after the sale proceeds leave the portfolio
+        self.assertAlmostEqual(1.2 * (1 + 200 / 2400) - 1, res.data['time_weighted_return'])
+
+        res = self.client.get(f'/api/v1/portfolio/{self.p1.id}/analytics/?from=2021-01-01&to=2021-01-31&freq=W')
+        self.assertEqual([datetime.date(2021, 1, day) for day in (3, 10, 17, 24, 31)],
+                         [point['date'] for point in res.data['equity_curve']])
+
+        res = self.client.get(f'/api/v1/portfolio/{self.p1.id}/analytics/?freq=X')
+        self.assertEqual(400, res.status_code)
+
+
+class TestConcurrentTrades(TransactionTestCase):
+    THREADS = 8
+    TRADES_PER_THREAD = 250
+
+    def post_trades(self, seed, portfolio_ids, statuses, errors):
+        rng = random.Random(seed)
+        client = Client()
+        try:
+            for _ in range(self.TRADES_PER_THREAD):
+                data = {
+                    'portfolio': rng.choice(portfolio_ids),
+                    'security': rng.choice(['TCS', 'INFY']),
+                    'count': rng.randint(1, 10),
+                    'trade_type': rng.choice(['B', 'S']),
+                    'trade_price': rng.randint(90, 110),
+                }
+                status_code = 503
+                # Clients resubmit trades answered with a 503, as its Retry-After asks
+                while status_code == 503:
+                    status_code = client.post('/api/v1/trade/', data).status_code
+                statuses.append(status_code)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            connection.close()
+
+    def test_concurrent_trades_match_replay(self):
+        portfolio_ids = [Portfolio.objects.create(name=f'Portfolio {index}').id for index in range(2)]
+        statuses, errors = [], []
+        threads = [threading.Thread(target=self.post_trades, args=(seed, portfolio_ids, statuses, errors))
+                   for seed in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual(self.THREADS * self.TRADES_PER_THREAD, len(statuses))
+        self.assertEqual({201, 400}, set(statuses))
+        self.assertEqual(statuses.count(201), Trade.objects.count())
+
+        replayed = {}
+        for portfolio_id, security, trade_type, count, price in Trade.objects.order_by('trade_time', 'id') \
+                .values_list('portfolio', 'security', 'trade_type', 'count', 'trade_price'):
+            state = replayed.get((portfolio_id, security), (0, 0))
+            replayed[(portfolio_id, security)] = apply_trade(*state, trade_type, count, price)
+            self.assertGreaterEqual(replayed[(portfolio_id, security)][0], 0)
+
+        positions = {(p.portfolio_id, p.security): p for p in Position.objects.all()}
+        self.assertEqual(set(replayed), set(positions))
+        for key, (count, average_price) in replayed.items():
+            self.assertEqual(count, positions[key].count)
+            self.assertAlmostEqual(average_price, positions[key].average_price, places=6)
+
+
+@override_settings(POSITION_BOOK={'ENABLED': True})
+class TestConcurrentTradesWithPositionBook(TestConcurrentTrades):
+    TRADES_PER_THREAD = 100
+
+    def setUp(self) -> None:
+        book.clear()
+        book.warm()
+
+
+class TestTradeListing(TestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+        self.p2 = Portfolio.objects.create(name='Second Portfolio')
+        trades = [Trade(portfolio=self.p1 if index % 3 else self.p2, security='TCS' if index % 2 else 'INFY',
+                        count=1, trade_price=100) for index in range(25)]
+        Trade.objects.bulk_create(trades)
+        # Several trades share a timestamp, the id breaks the tie
+        start = datetime.datetime(2021, 4, 1, tzinfo=datetime.timezone.utc)
+        for trade in Trade.objects.order_by('id'):
+            Trade.objects.filter(pk=trade.pk).update(trade_time=start + datetime.timedelta(days=trade.pk // 4))
+
+    def read_all(self, url):
+        ids = []
+        pages = 0
+        while url:
+            res = self.client.get(url)
+            self.assertEqual(200, res.status_code)
+            ids += [trade['id'] for trade in res.data['results']]
+            url = res.data['next']
+            pages += 1
+        return ids, pages
+
+    def test_cursor_walks_every_trade_once(self):
+        ids, pages = self.read_all('/api/v1/trade/?page_size=4')
+        expected = list(Trade.objects.order_by('trade_time', 'id').values_list('id', flat=True))
+        self.assertEqual(expected, ids)
+        self.assertEqual(7, pages)
+
+    def test_page_query_count_is_constant(self):
+        res = self.client.get('/api/v1/trade/?page_size=4')
+        with self.assertNumQueries(1):
+            self.client.get(res.data['next'])
+
+    def test_filters(self):
+        ids, _ = self.read_all(f'/api/v1/trade/?portfolio={self.p2.id}&security=INFY')
+        expected = Trade.objects.filter(portfolio=self.p2, security='INFY').order_by('trade_time', 'id')
+        self.assertEqual(list(expected.values_list('id', flat=True)), ids)
+
+        ids, _ = self.read_all('/api/v1/trade/?from=2021-04-02&to=2021-04-03')
+        expected = Trade.objects.filter(trade_time__date__range=(datetime.date(2021, 4, 2),
+                                                                 datetime.date(2021, 4, 3)))
+        self.assertEqual(8, len(ids))
+        self.assertEqual(set(expected.values_list('id', flat=True)), set(ids))
+
+        self.assertEqual(400, self.client.get('/api/v1/trade/?from=yesterday').status_code)
+        self.assertEqual(404, self.client.get('/api/v1/trade/?cursor=bogus').status_code)
+
+    def test_field_selection(self):
+        res = self.client.get('/api/v1/trade/?fields=id,security')
+        self.assertEqual([{'id', 'security'}], list({frozenset(trade) for trade in res.data['results']}))
+
+
+class TestExports(TestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+        rows = [{'portfolio': self.p1.id, 'security': f'S{index % 7}', 'count': 2, 'trade_type': 'B',
+                 'trade_price': 10.5} for index in range(2500)]
+        self.client.post('/api/v1/trade/bulk/', rows, content_type='application/json')
+
+    def test_trade_csv_export(self):
+        res = self.client.get('/api/v1/trade/export/?format=csv')
+        self.assertEqual(200, res.status_code)
+        self.assertTrue(res.streaming)
+        rows = list(csv.reader(io.StringIO(b''.join(res.streaming_content).decode())))
+        self.assertEqual(['id', 'portfolio', 'security', 'trade_type', 'count', 'trade_price', 'trade_time'], rows[0])
+        self.assertEqual(2501, len(rows))
+        first = Trade.objects.order_by('trade_time', 'id').first()
+        self.assertEqual([str(first.id), str(self.p1.id), 'S0', 'B', '2', '10.5', first.trade_time.isoformat()],
+                         rows[1])
+
+    def test_trade_ndjson_export_with_filters(self):
+        res = self.client.get('/api/v1/trade/export/?format=ndjson&security=S3&fields=id,count')
+        self.assertEqual('application/x-ndjson', res['Content-Type'])
+        rows = [json.loads(line) for line in b''.join(res.streaming_content).decode().splitlines()]
+        self.assertEqual(Trade.objects.filter(security='S3').count(), len(rows))
+        self.assertEqual({'id', 'count'}, set(rows[0]))
+
+    def test_position_export(self):
+        res = self.client.get(f'/api/v1/position/export/?format=ndjson&portfolio={self.p1.id}')
+        rows = [json.loads(line) for line in b''.join(res.streaming_content).decode().splitlines()]
+        self.assertEqual(7, len(rows))
+        self.assertEqual({'portfolio': self.p1.id, 'security': 'S0', 'count': 716, 'average_price': 10.5}, rows[0])
+
+
+@override_settings(PRICE_PROVIDER={'BACKEND': 'portfoliotrackerapp.prices.StaticPriceProvider',
+                                   'OPTIONS': {'prices': {'TCS': 120, 'INFY': 10}}})
+class TestPortfolioSummary(TestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+
+    def add_trade(self, security, count, trade_type, trade_price):
+        data = {'portfolio': self.p1.id, 'security': security, 'count': count, 'trade_type': trade_type,
+                'trade_price': trade_price}
+        res = self.client.post('/api/v1/trade/', data)
+        self.assertEqual(201, res.status_code)
+        return res.data['id']
+
+    def assert_consistent(self):
+        call_command('rebuild_summaries', '--check', stdout=io.StringIO())
+
+    def test_summary_follows_trades(self):
+        self.add_trade('TCS', 10, 'B', 100)
+        second = self.add_trade('INFY', 10, 'B', 20)
+        self.add_trade('TCS', 5, 'S', 130)
+        summary = PortfolioSummary.objects.get(portfolio=self.p1)
+        self.assertEqual((700, 2), (summary.total_cost_basis, summary.position_count))
+        self.assertEqual(Trade.objects.latest('trade_time').trade_time, summary.last_trade_time)
+        self.assert_consistent()
+
+        res = self.client.put(f'/api/v1/trade/{second}/', {'portfolio': self.p1.id, 'security': 'TCS', 'count': 10,
+                                                            'trade_type': 'B', 'trade_price': 40},
+                              content_type='application/json')
+        self.assertEqual(200, res.status_code)
+        self.assert_consistent()
+
+        res = self.client.delete(f'/api/v1/trade/{Trade.objects.latest("trade_time").id}/')
+        self.assertEqual(204, res.status_code)
+        self.assert_consistent()
+
+        rows = [{'portfolio': self.p1.id, 'security': 'INFY', 'count': 3, 'trade_type': 'B', 'trade_price': 8}] * 3
+        self.client.post('/api/v1/trade/bulk/', rows, content_type='application/json')
+        self.assert_consistent()
+
+    def test_portfolio_reads_summary_with_its_positions(self):
+        self.add_trade('TCS', 10, 'B', 100)
+        with self.assertNumQueries(2):
+            res = self.client.get(f'/api/v1/portfolio/{self.p1.id}/')
+        self.assertEqual(200, res.data['returns'])
+        self.assertEqual((1000, 1200, 1), (res.data['summary']['total_cost_basis'],
+                                           res.data['summary']['market_value'], res.data['summary']['position_count']))
+
+    def test_market_value_and_returns_follow_prices(self):
+        def prices(price):
+            return override_settings(PRICE_PROVIDER={'BACKEND': 'portfoliotrackerapp.prices.StaticPriceProvider',
+                                                     'OPTIONS': {'prices': {'TCS': price}}})
+
+        with prices(110):
+            self.add_trade('TCS', 10, 'B', 100)
+        with prices(120):
+            self.add_trade('TCS', 10, 'B', 120)
+            res = self.client.get(f'/api/v1/portfolio/{self.p1.id}/')
+            self.assertEqual((2200, 2400), (res.data['summary']['total_cost_basis'],
+                                            res.data['summary']['market_value']))
+            self.assertEqual(200, res.data['returns'])
+        with prices(130):
+            self.assert_consistent()
+
+    @override_settings(PRICE_PROVIDER={'BACKEND': 'portfoliotrackerapp.prices.StaticPriceProvider',
+                                       'OPTIONS': {'prices': {'TCS': 120}}})
+    def test_returns_read_the_summary_cost_basis(self):
+        self.add_trade('TCS', 10, 'B', 100)
+        PortfolioSummary.objects.filter(portfolio=self.p1).update(total_cost_basis=900)
+        invalidate_portfolios([self.p1.id])
+        self.assertEqual(300, self.client.get(f'/api/v1/portfolio/{self.p1.id}/').data['returns'])
+
+        # Portfolios without a summary yet fall back to their positions
+        PortfolioSummary.objects.filter(portfolio=self.p1).delete()
+        invalidate_portfolios([self.p1.id])
+        res = self.client.get(f'/api/v1/portfolio/{self.p1.id}/')
+        self.assertIsNone(res.data['summary'])
+        self.assertEqual(200, res.data['returns'])
+
+    def test_check_reports_drift_and_rebuild_fixes_it(self):
+        self.add_trade('TCS', 10, 'B', 100)
+        PortfolioSummary.objects.filter(portfolio=self.p1).update(total_cost_basis=0)
+        with self.assertRaises(CommandError):
+            self.assert_consistent()
+        call_command('rebuild_summaries', stdout=io.StringIO())
+        self.assert_consistent()
+
+    def test_command_runs_with_system_checks(self):
+        self.add_trade('TCS', 10, 'B', 100)
+        for args in ((), ('--check',)):
+            call_command('rebuild_summaries', *args, skip_checks=False, stdout=io.StringIO())
+
+
+class TestPortfolioCaching(TestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+        self.trade = {'portfolio': self.p1.id, 'security': 'TCS', 'count': 10, 'trade_type': 'B',
+                      'trade_price': 100}
+        self.client.post('/api/v1/trade/', self.trade)
+
+    def test_cached_until_trade_changes(self):
+        res = self.client.get(f'/api/v1/portfolio/{self.p1.id}/')
+        etag = res['ETag']
+        with self.assertNumQueries(0):
+            res = self.client.get(f'/api/v1/portfolio/{self.p1.id}/')
+        self.assertEqual(10, res.data['stocks'][0]['count'])
+        with self.assertNumQueries(0):
+            res = self.client.get(f'/api/v1/portfolio/{self.p1.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, res.status_code)
+
+        self.client.post('/api/v1/trade/', self.trade)
+        res = self.client.get(f'/api/v1/portfolio/{self.p1.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, res.status_code)
+        self.assertNotEqual(etag, res['ETag'])
+        self.assertEqual(20, res.data['stocks'][0]['count'])
+
+    def test_versions_expire_with_the_responses(self):
+        etag = self.client.get(f'/api/v1/portfolio/{self.p1.id}/')['ETag']
+        # Written without signals, like another process with its own cache would
+        Position.objects.filter(portfolio=self.p1).update(count=30)
+        self.assertEqual(304, self.client.get(f'/api/v1/portfolio/{self.p1.id}/', HTTP_IF_NONE_MATCH=etag).status_code)
+
+        later = time.time() + 301
+        with mock.patch('django.core.cache.backends.locmem.time.time', return_value=later):
+            res = self.client.get(f'/api/v1/portfolio/{self.p1.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(30, res.data['stocks'][0]['count'])
+
+    def test_list_invalidated_by_any_portfolio(self):
+        p2 = Portfolio.objects.create(name='Second Portfolio')
+        etag = self.client.get('/api/v1/portfolio/')['ETag']
+        self.assertEqual(304, self.client.get('/api/v1/portfolio/', HTTP_IF_NONE_MATCH=etag).status_code)
+
+        self.client.post('/api/v1/trade/', {**self.trade, 'portfolio': p2.id})
+        res = self.client.get('/api/v1/portfolio/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual([1, 1], [len(portfolio['stocks']) for portfolio in res.data])
+
+    def test_rename_and_delete_invalidate(self):
+        self.client.get(f'/api/v1/portfolio/{self.p1.id}/')
+        self.client.put(f'/api/v1/portfolio/{self.p1.id}/', {'name': 'Renamed'}, content_type='application/json')
+        self.assertEqual('Renamed', self.client.get(f'/api/v1/portfolio/{self.p1.id}/').data['name'])
+        self.client.delete(f'/api/v1/portfolio/{self.p1.id}/')
+        self.assertEqual(404, self.client.get(f'/api/v1/portfolio/{self.p1.id}/').status_code)
+
+
+class TestAsyncReads(TransactionTestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+        self.trade = {'portfolio': self.p1.id, 'security': 'TCS', 'count': 10, 'trade_type': 'B',
+                      'trade_price': 100}
+        self.client.post('/api/v1/trade/', self.trade)
+
+    def test_same_payloads_as_sync_views(self):
+        for path in (f'portfolio/{self.p1.id}/', f'portfolio/{self.p1.id}/positions/', f'trade/?portfolio={self.p1.id}'):
+            res = self.client.get(f'/api/v1/async/{path}')
+            self.assertEqual(200, res.status_code)
+            self.assertEqual(json.loads(self.client.get(f'/api/v1/{path}').content), json.loads(res.content))
+        self.assertEqual(404, self.client.get('/api/v1/async/portfolio/999/').status_code)
+
+    def test_long_poll(self):
+        res = self.client.get(f'/api/v1/async/portfolio/{self.p1.id}/')
+        etag = res['ETag']
+        res = self.client.get(f'/api/v1/async/portfolio/{self.p1.id}/?wait=0.2', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, res.status_code)
+
+        def post_trade():
+            Client().post('/api/v1/trade/', self.trade)
+            connection.close()
+        timer = threading.Timer(0.3, post_trade)
+        timer.start()
+        try:
+            started = time.monotonic()
+            res = self.client.get(f'/api/v1/async/portfolio/{self.p1.id}/?wait=30', HTTP_IF_NONE_MATCH=etag)
+            self.assertLess(time.monotonic() - started, 10)
+        finally:
+            timer.join()
+        self.assertEqual(200, res.status_code)
+        self.assertNotEqual(etag, res['ETag'])
+        self.assertEqual(20, json.loads(res.content)['stocks'][0]['count'])
+
+    @override_settings(ASYNC_API={'LONG_POLL_INTERVAL': 0.1})
+    def test_long_poll_notices_changes_made_elsewhere(self):
+        etag = self.client.get(f'/api/v1/async/portfolio/{self.p1.id}/')['ETag']
+        timer = threading.Timer(0.3, change_elsewhere, ({**self.trade, 'count': 5},))
+        timer.start()
+        try:
+            res = self.client.get(f'/api/v1/async/portfolio/{self.p1.id}/?wait=30', HTTP_IF_NONE_MATCH=etag)
+        finally:
+            timer.join()
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(15, json.loads(res.content)['stocks'][0]['count'])
+
+
+def change_elsewhere(trade):
+    """Posts a trade like another process would, with a cache of its own and signals that don't reach this one"""
+    own_cache, shared_cache, writer = LocMemCache('elsewhere', {}), get_cache(), threading.current_thread()
+    with mock.patch('portfoliotrackerapp.caching.get_cache',
+                    side_effect=lambda: own_cache if threading.current_thread() is writer else shared_cache), \
+            mock.patch.object(positions_changed, 'send'):
+        Client().post('/api/v1/trade/', trade)
+    connection.close()
+
+
+class TestBench(TestCase):
+    def test_bench_reports_every_endpoint(self):
+        out = io.StringIO()
+        call_command('bench', '--current-db', '--portfolios', '2', '--securities', '3', '--trades', '40',
+                     '--requests', '3', '--warmup', '1', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(40, report['seeded_trades'])
+        self.assertEqual(40 + 4, Trade.objects.count())
+        self.assertIn('portfolio_detail_uncached', report['results'])
+        for name, result in report['results'].items():
+            self.assertEqual(0, result['errors'], name)
+            self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+            self.assertLessEqual(result['p95_ms'], result['p99_ms'])
+            self.assertGreater(result['throughput_rps'], 0)
+        self.assertEqual(2, report['results']['portfolio_detail_uncached']['queries_mean'])
+
+        with self.assertRaises(CommandError):
+            call_command('bench', '--current-db', '--endpoint', 'nothing', stdout=out)
+
+
+@override_settings(MIDDLEWARE=['portfoliotrackerapp.metrics.RequestMetricsMiddleware', *settings.MIDDLEWARE])
+class TestRequestMetrics(TestCase):
+    def setUp(self) -> None:
+        registry.clear()
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+
+    def test_server_timing_and_log(self):
+        with self.assertLogs('portfoliotrackerapp.metrics', 'INFO') as logs:
+            res = self.client.post('/api/v1/trade/', {'portfolio': self.p1.id, 'security': 'TCS', 'count': 10,
+                                                      'trade_type': 'B', 'trade_price': 100})
+        self.assertEqual(201, res.status_code)
+        timings = dict(part.strip().split(';', 1) for part in res['Server-Timing'].split(','))
+        self.assertEqual({'db', 'serializer', 'view'}, set(timings))
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual('trade-list', line['view'])
+        self.assertEqual(201, line['status'])
+        self.assertIn(f'desc="{line["queries"]} queries"', timings['db'])
+        self.assertGreater(line['queries'], 3)
+        self.assertGreater(line['serializer_ms'], 0)
+        self.assertLessEqual(line['db_ms'], line['view_ms'])
+
+    def test_trade_updates_count_as_serializer_time(self):
+        self.client.post('/api/v1/trade/', {'portfolio': self.p1.id, 'security': 'TCS', 'count': 10,
+                                            'trade_type': 'B', 'trade_price': 100})
+        trade = Trade.objects.get()
+        run = StreamReplay.run
+
+        def slow_run(replay, *args):
+            time.sleep(0.2)
+            return run(replay, *args)
+        with mock.patch.object(StreamReplay, 'run', slow_run), \
+                self.assertLogs('portfoliotrackerapp.metrics', 'INFO') as logs:
+            res = self.client.patch(f'/api/v1/trade/{trade.id}/', {'count': 20}, content_type='application/json')
+        self.assertEqual(200, res.status_code)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertGreaterEqual(line['serializer_ms'], 200)
+        self.assertLessEqual(line['serializer_ms'], line['view_ms'])
+
+    def test_async_views_recorded(self):
+        # Queries of the async views run on the pool threads
+        with self.assertLogs('portfoliotrackerapp.metrics', 'INFO') as logs:
+            self.assertEqual(200, self.client.get('/api/v1/async/trade/').status_code)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual('async-trade-list', line['view'])
+        self.assertGreaterEqual(line['queries'], 1)
+
+    def test_metrics_endpoint_admin_only(self):
+        with self.assertLogs('portfoliotrackerapp.metrics', 'INFO'):
+            self.client.get(f'/api/v1/portfolio/{self.p1.id}/')
+            self.client.get(f'/api/v1/portfolio/{self.p1.id}/')
+            self.assertEqual(403, self.client.get('/api/v1/metrics/').status_code)
+            User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+            self.client.login(username='admin', password='secret')
+            res = self.client.get('/api/v1/metrics/')
+        self.assertEqual(200, res.status_code)
+        self.assertTrue(res['Content-Type'].startswith('text/plain'))
+        body = res.content.decode()
+        self.assertIn('# TYPE portfoliotracker_request_view_seconds histogram', body)
+        self.assertIn('portfoliotracker_request_queries_count{view="portfolio-detail",method="GET"} 2', body)
+        self.assertIn('portfoliotracker_request_view_seconds_bucket{view="portfolio-detail",method="GET",le="+Inf"} 2',
+                      body)
+
+
+class TestQueryPlans(TestCase):
+    def test_hot_queries_use_indexes(self):
+        p1 = Portfolio.objects.create(name='First Portfolio')
+        for trade_type in ('B', 'S'):
+            self.client.post('/api/v1/trade/', {'portfolio': p1.id, 'security': 'TCS', 'count': 5,
+                                                'trade_type': trade_type, 'trade_price': 100})
+        out = io.StringIO()
+        call_command('explain_queries', '--check', stdout=out)
+        self.assertIn('== stream replay trades', out.getvalue())
+        if connection.vendor == 'sqlite':
+            self.assertIn('trade_stream_idx', out.getvalue())
+            self.assertIn('trade_portfolio_time_idx', out.getvalue())
+
+
+class TestTradeLedger(TestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+
+    def add_trade(self, security, count, trade_type, trade_price):
+        res = self.client.post('/api/v1/trade/', {'portfolio': self.p1.id, 'security': security, 'count': count,
+                                                  'trade_type': trade_type, 'trade_price': trade_price})
+        self.assertEqual(201, res.status_code)
+        return res.data['id']
+
+    def positions(self):
+        return {p.security: (p.count, p.average_price) for p in Position.objects.filter(portfolio=self.p1)}
+
+    def assert_projection_matches(self):
+        for checkpoint in (None, latest_checkpoint(self.p1.id)):
+            state, _ = project_positions(self.p1.id, checkpoint)
+            self.assertEqual({}, position_drift(self.p1.id, state))
+
+    def test_events_appended_for_every_change(self):
+        first = self.add_trade('TCS', 10, 'B', 100)
+        self.client.post('/api/v1/trade/bulk/', [{'portfolio': self.p1.id, 'security': 'INFY', 'count': 5,
+                                                  'trade_type': 'B', 'trade_price': 50}], content_type='application/json')
+        self.client.patch(f'/api/v1/trade/{first}/', {'count': 20}, content_type='application/json')
+        self.client.delete(f'/api/v1/trade/{first}/')
+        self.assertEqual(['C', 'C', 'A', 'X'], list(TradeEvent.objects.order_by('id').values_list('event_type',
+                                                                                                   flat=True)))
+        self.assertEqual([10, 5, 20, 20], list(TradeEvent.objects.order_by('id').values_list('count', flat=True)))
+        self.assert_projection_matches()
+
+    def test_projection_from_checkpoint(self):
+        first = self.add_trade('TCS', 10, 'B', 100)
+        self.add_trade('TCS', 10, 'B', 200)
+        moved = self.add_trade('INFY', 10, 'B', 50)
+        self.assertIsNotNone(checkpoint_portfolio(self.p1.id))
+        self.assertIsNone(checkpoint_portfolio(self.p1.id))
+
+        self.add_trade('TCS', 5, 'S', 300)
+        self.add_trade('WIPRO', 3, 'B', 10)
+        self.assert_projection_matches()
+
+        # Amendments and cancellations of trades before the checkpoint rewrite their streams
+        self.client.patch(f'/api/v1/trade/{first}/', {'trade_price': 150}, content_type='application/json')
+        self.client.patch(f'/api/v1/trade/{moved}/', {'security': 'TCS'}, content_type='application/json')
+        self.assert_projection_matches()
+        checkpoint_portfolio(self.p1.id)
+        self.client.delete(f'/api/v1/trade/{first}/')
+        self.assert_projection_matches()
+        state, last = project_positions(self.p1.id, latest_checkpoint(self.p1.id))
+        self.assertEqual(TradeEvent.objects.latest('id').id, last)
+        self.assertEqual((15, 125.0), state['TCS'])
+        self.assertEqual((0, 0), state.get('INFY', (0, 0)))
+
+    def test_rebuild_drifted_positions(self):
+        self.add_trade('TCS', 10, 'B', 100)
+        self.add_trade('TCS', 10, 'B', 200)
+        Position.objects.filter(portfolio=self.p1, security='TCS').update(count=7, average_price=1)
+
+        with self.assertRaises(CommandError):
+            call_command('project_ledger', stdout=io.StringIO())
+        out = io.StringIO()
+        call_command('project_ledger', '--rebuild', '--checkpoint', '--portfolio', str(self.p1.id), stdout=out)
+        self.assertIn('rebuilt TCS', out.getvalue())
+        self.assertEqual({'TCS': (20, 150.0)}, self.positions())
+        self.assertEqual(3000, PortfolioSummary.objects.get(portfolio=self.p1).total_cost_basis)
+        self.assertEqual({'TCS': [20, 150.0]}, latest_checkpoint(self.p1.id).positions)
+        call_command('project_ledger', stdout=io.StringIO())
+
+
+class TestReconcilePositions(TransactionTestCase):
+    def setUp(self) -> None:
+        self.portfolios = [Portfolio.objects.create(name=f'Portfolio {index}') for index in range(3)]
+        for portfolio in self.portfolios:
+            for security, count, trade_type, price in (('TCS', 10, 'B', 100), ('TCS', 10, 'B', 200),
+                                                       ('INFY', 5, 'B', 50), ('TCS', 5, 'S', 300)):
+                self.client.post('/api/v1/trade/', {'portfolio': portfolio.id, 'security': security, 'count': count,
+                                                    'trade_type': trade_type, 'trade_price': price})
+
+    def reconcile(self, *args):
+        out = io.StringIO()
+        call_command('reconcile_positions', *args, stdout=out)
+        return out.getvalue()
+
+    def test_consistent_book(self):
+        for workers in ('0', '2'):
+            out = self.reconcile('--workers', workers, '--chunk-size', '2')
+            self.assertIn('Reconciled 6 streams (12 trades) of 3 portfolios', out)
+
+    def test_report_and_fix(self):
+        broken = self.portfolios[1]
+        Position.objects.filter(portfolio=broken, security='TCS').update(count=3)
+        Position.objects.filter(portfolio=broken, security='INFY').delete()
+        with self.assertRaises(CommandError):
+            self.reconcile('--workers', '0', '--dry-run')
+
+        out = self.reconcile('--workers', '2', '--fix', '--portfolios', str(broken.id))
+        self.assertIn(f'Portfolio {broken.id} INFY: stored None, replayed (5, 50.0), fixed', out)
+        self.assertIn(f'Portfolio {broken.id} TCS: stored (3, 150.0), replayed (15, 150.0), fixed', out)
+        self.assertEqual({'TCS': (15, 150.0), 'INFY': (5, 50.0)},
+                         {p.security: (p.count, p.average_price) for p in Position.objects.filter(portfolio=broken)})
+        self.assertEqual(2, PortfolioSummary.objects.get(portfolio=broken).position_count)
+        self.assertIn('0 positions differ', self.reconcile('--workers', '0'))
+
+
+class TestLots(TestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+
+    def add_trade(self, count, trade_type, trade_price, security='TCS'):
+        res = self.client.post('/api/v1/trade/', {'portfolio': self.p1.id, 'security': security, 'count': count,
+                                                  'trade_type': trade_type, 'trade_price': trade_price})
+        self.assertEqual(201, res.status_code)
+        return res.data['id']
+
+    def lots(self):
+        return self.client.get(f'/api/v1/portfolio/{self.p1.id}/lots/').data
+
+    def test_lot_methods(self):
+        self.add_trade(10, 'B', 100)
+        self.add_trade(10, 'B', 300)
+        self.add_trade(10, 'B', 200)
+        self.add_trade(15, 'S', 250)
+
+        data = self.lots()
+        self.assertEqual('FIFO', data['lot_method'])
+        self.assertEqual([(10, 100.0, 1500.0), (5, 300.0, -250.0)],
+                         [(c['count'], c['cost_price'], c['realized_pnl']) for c in data['closed']])
+        self.assertEqual([(300.0, 5), (200.0, 10)], [(lot['price'], lot['remaining']) for lot in data['open']])
+        self.assertEqual(1250, data['realized_pnl'])
+
+        expected = {'LIFO': (250.0, [(100.0, 10), (300.0, 5)]), 'HIFO': (-250.0, [(100.0, 10), (200.0, 5)])}
+        for method, (realized_pnl, open_lots) in expected.items():
+            res = self.client.patch(f'/api/v1/portfolio/{self.p1.id}/', {'lot_method': method},
+                                    content_type='application/json')
+            self.assertEqual(200, res.status_code)
+            data = self.lots()
+            self.assertEqual(realized_pnl, data['realized_pnl'])
+            self.assertEqual(open_lots, [(lot['price'], lot['remaining']) for lot in data['open']])
+
+    def test_lots_follow_trade_changes(self):
+        first = self.add_trade(10, 'B', 100)
+        self.add_trade(10, 'B', 200)
+        sell = self.add_trade(5, 'S', 300)
+        self.client.post('/api/v1/trade/bulk/', [{'portfolio': self.p1.id, 'security': 'TCS', 'count': 10,
+                                                  'trade_type': 'S', 'trade_price': 300}],
+                         content_type='application/json')
+        self.assertEqual([(200.0, 5)], [(lot['price'], lot['remaining']) for lot in self.lots()['open']])
+
+        self.client.patch(f'/api/v1/trade/{first}/', {'trade_price': 150}, content_type='application/json')
+        self.client.delete(f'/api/v1/trade/{sell}/')
+        data = self.lots()
+        self.assertEqual([(200.0, 10)], [(lot['price'], lot['remaining']) for lot in data['open']])
+        self.assertEqual([(10, 150.0)], [(c['count'], c['cost_price']) for c in data['closed']])
+        self.assertEqual(1500, data['realized_pnl'])
+
+        Lot.objects.all().delete()
+        call_command('rebuild_lots', stdout=io.StringIO())
+        self.assertEqual(data, self.lots())
+
+    def test_trade_changes_rewind_lots_like_a_rebuild(self):
+        rng = random.Random(7)
+        for method in ('FIFO', 'LIFO', 'HIFO'):
+            Portfolio.objects.filter(pk=self.p1.pk).update(lot_method=method)
+            Trade.objects.all().delete()
+            buys = [self.add_trade(rng.randint(5, 20), 'B', rng.randint(50, 150), security)
+                    for security in ('TCS', 'INFY') for _ in range(6)]
+            sells = [self.add_trade(rng.randint(1, 10), 'S', rng.randint(50, 150), security)
+                     for security in ('TCS', 'INFY') for _ in range(4)]
+            buys += [self.add_trade(rng.randint(5, 20), 'B', rng.randint(50, 150), 'TCS') for _ in range(3)]
+            sells += [self.add_trade(rng.randint(1, 5), 'S', rng.randint(50, 150), 'TCS') for _ in range(3)]
+
+            changes = [('delete', sells[1], {}), ('patch', buys[2], {'trade_price': 75}),
+                       ('patch', sells[5], {'trade_type': 'B'}), ('patch', buys[8], {'security': 'TCS'}),
+                       ('delete', buys[0], {})]
+            for verb, pk, data in changes:
+                res = getattr(self.client, verb)(f'/api/v1/trade/{pk}/', data, content_type='application/json')
+                self.assertIn(res.status_code, (200, 204))
+                data = self.lots()
+                call_command('rebuild_lots', stdout=io.StringIO())
+                self.assertEqual(data, self.lots())
+
+
+@override_settings(TRADE_QUEUE={'ENABLED': True})
+class TestTradeQueue(TestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+
+    def queue_trade(self, count, trade_type, trade_price=100, security='TCS'):
+        res = self.client.post('/api/v1/trade/', {'portfolio': self.p1.id, 'security': security, 'count': count,
+                                                  'trade_type': trade_type, 'trade_price': trade_price})
+        self.assertEqual(202, res.status_code)
+        self.assertEqual('P', res.data['status'])
+        self.assertTrue(res['Location'].endswith(f'/api/v1/trade-queue/{res.data["id"]}/'))
+        return res.data['id']
+
+    def test_queued_trades_are_applied_in_batches(self):
+        ids = [self.queue_trade(10, 'B', 100), self.queue_trade(10, 'B', 200), self.queue_trade(30, 'S'),
+               self.queue_trade(5, 'S', security='INFY'), self.queue_trade(5, 'S', 300)]
+        self.assertEqual(0, Trade.objects.count())
+        self.assertEqual(0, Position.objects.count())
+
+        out = io.StringIO()
+        call_command('run_trade_applier', '--once', '--batch-size', '2', stdout=out)
+        self.assertIn('Applied 3 trades, rejected 2', out.getvalue())
+
+        statuses = [self.client.get(f'/api/v1/trade-queue/{pk}/').data for pk in ids]
+        self.assertEqual(['A', 'A', 'R', 'R', 'A'], [data['status'] for data in statuses])
+        self.assertEqual(['This trade results in invalid position'], statuses[2]['errors']['non_field_errors'])
+        self.assertEqual(list(Trade.objects.order_by('id').values_list('id', flat=True)),
+                         [data['trade'] for data in statuses if data['trade']])
+        position = Position.objects.get(portfolio=self.p1, security='TCS')
+        self.assertEqual((15, 150.0), (position.count, position.average_price))
+
+        # Draining an empty queue is a no-op
+        call_command('run_trade_applier', '--once', stdout=out)
+        self.assertEqual(3, Trade.objects.count())
+
+    def test_queue_validation(self):
+        res = self.client.post('/api/v1/trade/', {'portfolio': 999, 'security': 'TCS', 'count': 1,
+                                                  'trade_type': 'B', 'trade_price': 1})
+        self.assertEqual(400, res.status_code)
+        self.assertEqual(0, QueuedTrade.objects.count())
+        self.assertEqual(404, self.client.get('/api/v1/trade-queue/999/').status_code)
+
+        with override_settings(TRADE_QUEUE={'ENABLED': False}):
+            res = self.client.post('/api/v1/trade/', {'portfolio': self.p1.id, 'security': 'TCS', 'count': 1,
+                                                      'trade_type': 'B', 'trade_price': 1})
+        self.assertEqual(201, res.status_code)
+
+    def test_applier_refuses_a_process_local_cache(self):
+        with self.assertRaisesMessage(SystemCheckError, 'portfoliotrackerapp.E001'):
+            call_command('run_trade_applier', '--once', skip_checks=False, stdout=io.StringIO())
+
+        shared = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': tempfile.mkdtemp()}
+        self.addCleanup(shutil.rmtree, shared['LOCATION'])
+        with override_settings(CACHES={**settings.CACHES, 'shared': shared}, PORTFOLIO_CACHE={'ALIAS': 'shared'}):
+            call_command('run_trade_applier', '--once', skip_checks=False, stdout=io.StringIO())
+
+
+class TestSQLiteTuning(TransactionTestCase):
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_pragmas_run_on_new_connections(self):
+        default = self.pragma('cache_size')
+        with override_settings(SQLITE_PRAGMAS={'synchronous': 'NORMAL', 'cache_size': -4000}):
+            connection.close()
+            self.assertEqual(1, self.pragma('synchronous'))
+            self.assertEqual(-4000, self.pragma('cache_size'))
+        connection.close()
+        self.assertEqual(default, self.pragma('cache_size'))
+
+        with override_settings(SQLITE_PRAGMAS={'cache_size; DROP TABLE x': 1}):
+            connection.close()
+            with self.assertRaises(ValueError):
+                connection.ensure_connection()
+        connection.close()
+
+    def test_writes_wait_for_the_lock_then_answer_503(self):
+        portfolio = Portfolio.objects.create(name='First Portfolio')
+        data = {'portfolio': portfolio.id, 'security': 'TCS', 'count': 1, 'trade_type': 'B', 'trade_price': 10}
+        connection.ensure_connection()
+        connection.connection.execute('PRAGMA busy_timeout = 50')
+        self.addCleanup(connection.close)
+        other = sqlite3.connect(connection.settings_dict['NAME'])
+        self.addCleanup(other.close)
+        other.execute('BEGIN IMMEDIATE')
+        res = self.client.post('/api/v1/trade/', data)
+        self.assertEqual(503, res.status_code)
+        self.assertEqual('1', res['Retry-After'])
+        self.assertFalse(Trade.objects.exists())
+
+        other.rollback()
+        self.assertEqual(201, self.client.post('/api/v1/trade/', data).status_code)
+
+    def test_concurrent_write_bench(self):
+        out = io.StringIO()
+        call_command('bench', '--current-db', '--portfolios', '2', '--securities', '3', '--trades', '20',
+                     '--requests', '9', '--warmup', '1', '--concurrency', '3', '--endpoint', 'trade_create', stdout=out)
+        report = json.loads(out.getvalue())
+        result = report['results']['trade_create']
+        self.assertEqual(3, report['config']['concurrency'])
+        self.assertEqual(0, result['errors'])
+        self.assertEqual(9, result['requests'])
+        self.assertEqual(20 + 1 + 9, Trade.objects.count())
+
+
+@skipUnless('replica' in settings.DATABASES, 'Needs a replica database, run with '
+                                             '--settings=portfoliotrackerproject.settings_replica')
+@override_settings(DATABASE_ROUTERS=['portfoliotrackerapp.replicas.ReadReplicaRouter'],
+                   READ_REPLICA={'ALIAS': 'replica', 'MAX_LAG': 5})
+class TestReadReplicas(TestCase):
+    # The test runner sets up every database a test class names, skipped or not
+    databases = {'default', 'replica'} if 'replica' in settings.DATABASES else {'default'}
+
+    def setUp(self) -> None:
+        # Nothing replicates between the two databases, so every response shows which one it was read from
+        self.p1 = Portfolio.objects.create(name='Primary')
+        Portfolio.objects.using('replica').create(name='Replica')
+
+    def later(self):
+        return mock.patch('portfoliotrackerapp.replicas.time.time', return_value=time.time() + 10)
+
+    def test_heavy_reads_go_to_the_replica(self):
+        self.assertEqual(['Replica'], [p['name'] for p in self.client.get('/api/v1/portfolio/').data])
+        self.assertEqual('Primary', self.client.get(f'/api/v1/portfolio/{self.p1.id}/').data['name'])
+        # Unsafe requests never go to the replica
+        res = self.client.patch(f'/api/v1/portfolio/{self.p1.id}/', {'name': 'Renamed'},
+                                content_type='application/json')
+        self.assertEqual('Renamed', res.data['name'])
+        self.assertEqual('Renamed', Portfolio.objects.using('default').get(pk=self.p1.id).name)
+
+    def test_writers_read_their_writes(self):
+        res = self.client.post('/api/v1/trade/', {'portfolio': self.p1.id, 'security': 'TCS', 'count': 10,
+                                                  'trade_type': 'B', 'trade_price': 100})
+        self.assertEqual(201, res.status_code)
+        self.assertIn('read_primary_until', res.cookies)
+        self.assertEqual(1, len(self.client.get('/api/v1/trade/').data['results']))
+
+        with self.later():
+            self.assertEqual(0, len(self.client.get('/api/v1/trade/').data['results']))
+            res = self.client.get('/api/v1/trade/export/?format=csv')
+            self.assertEqual(1, b''.join(res.streaming_content).count(b'\n'))
+        res = self.client.get('/api/v1/trade/export/?format=csv')
+        self.assertEqual(2, b''.join(res.streaming_content).count(b'\n'))
+
+    def test_writers_never_get_responses_cached_from_the_replica(self):
+        reader = Client()
+        etag = reader.get('/api/v1/portfolio/')['ETag']
+        self.client.patch(f'/api/v1/portfolio/{self.p1.id}/', {'name': 'Renamed'}, content_type='application/json')
+        # A lagging replica answers under the new version
+        self.assertEqual(['Replica'], [p['name'] for p in reader.get('/api/v1/portfolio/').data])
+        res = self.client.get('/api/v1/portfolio/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(['Renamed'], [p['name'] for p in res.data])
+        self.assertEqual(304, self.client.get('/api/v1/portfolio/', HTTP_IF_NONE_MATCH=res['ETag']).status_code)
+        self.assertEqual(200, reader.get('/api/v1/portfolio/', HTTP_IF_NONE_MATCH=res['ETag']).status_code)
+
+    def test_failed_replica_reads_reset_the_routing(self):
+        with mock.patch('portfoliotrackerapp.views.portfolio_analytics', side_effect=RuntimeError('Failed')):
+            with self.assertRaises(RuntimeError):
+                self.client.get(f'/api/v1/portfolio/{self.p1.id}/analytics/')
+        self.assertIsNone(current_read_alias.get())
+        self.assertEqual(['Primary'], list(Portfolio.objects.values_list('name', flat=True)))
+
+
+class TestPositionsAsOf(TestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+
+    def add_trade(self, day, security, count, trade_type, trade_price):
+        with mock.patch('django.utils.timezone.now',
+                        return_value=datetime.datetime(2021, 3, day, 10, tzinfo=datetime.timezone.utc)):
+            res = self.client.post('/api/v1/trade/', {'portfolio': self.p1.id, 'security': security, 'count': count,
+                                                      'trade_type': trade_type, 'trade_price': trade_price})
+        self.assertEqual(201, res.status_code)
+        return res.data['id']
+
+    def as_of(self, moment):
+        res = self.client.get(f'/api/v1/portfolio/{self.p1.id}/?as_of={moment}')
+        self.assertEqual(200, res.status_code)
+        return {stock['security']: (stock['count'], stock['average_price']) for stock in res.data['stocks']}
+
+    def test_positions_as_of(self):
+        self.add_trade(1, 'TCS', 10, 'B', 100)
+        buy = self.add_trade(2, 'TCS', 10, 'B', 200)
+        self.add_trade(2, 'INFY', 5, 'B', 50)
+        self.add_trade(3, 'TCS', 15, 'S', 300)
+
+        self.assertEqual({}, self.as_of('2021-02-28'))
+        self.assertEqual({'TCS': (10, 100.0)}, self.as_of('2021-03-01'))
+        self.assertEqual({'TCS': (20, 150.0), 'INFY': (5, 50.0)}, self.as_of('2021-03-02'))
+        self.assertEqual({'TCS': (5, 150.0), 'INFY': (5, 50.0)}, self.as_of('2021-03-03T10:00:00Z'))
+        self.assertEqual({'TCS': (20, 150.0), 'INFY': (5, 50.0)}, self.as_of('2021-03-03T09:59:59Z'))
+        self.assertEqual(1000, self.client.get(f'/api/v1/portfolio/{self.p1.id}/?as_of=2021-03-31')
+                         .data['total_cost_basis'])
+
+        # Amending history changes the answer. A lookup takes two queries however long the history is
+        self.client.patch(f'/api/v1/trade/{buy}/', {'trade_price': 300}, content_type='application/json')
+        with self.assertNumQueries(2):
+            self.assertEqual({'TCS': (20, 200.0), 'INFY': (5, 50.0)}, self.as_of('2021-03-02'))
+
+        self.assertEqual(400, self.client.get(f'/api/v1/portfolio/{self.p1.id}/?as_of=yesterday').status_code)
+        self.assertEqual(404, self.client.get('/api/v1/portfolio/999/?as_of=2021-03-02').status_code)
+
+
+class TestPortfolioStreams(TransactionTestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+        self.trade = {'portfolio': self.p1.id, 'security': 'TCS', 'count': 10, 'trade_type': 'B',
+                      'trade_price': 100}
+        self.client.post('/api/v1/trade/', self.trade)
+
+    def post_trade(self, trade):
+        Client().post('/api/v1/trade/', trade)
+        connection.close()
+
+    async def open_stream(self, application, path):
+        """Starts a request on the ASGI application, returns its sent messages, its disconnect and its task"""
+        sent, received = asyncio.Queue(), asyncio.Queue()
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': []}
+        task = asyncio.ensure_future(application(scope, received.get, sent.put))
+        return sent, lambda: received.put_nowait({'type': 'http.disconnect'}), task
+
+    @staticmethod
+    async def next_event(sent):
+        message = await asyncio.wait_for(sent.get(), 10)
+        lines = dict(line.split(': ', 1) for line in message['body'].decode().strip().split('\n'))
+        return lines['event'], json.loads(lines['data']), message['body']
+
+    @staticmethod
+    async def next_frame(sent):
+        async def skip_heartbeats():
+            while True:
+                message = await sent.get()
+                if message['body'] != b': heartbeat\n\n':
+                    return message
+        return await asyncio.wait_for(skip_heartbeats(), 10)
+
+    def test_deltas_are_broadcast_to_every_subscriber(self):
+        async def scenario():
+            application = stream_application(None)
+            path = f'/api/v1/async/portfolio/{self.p1.id}/stream/'
+            streams = [await self.open_stream(application, path) for _ in range(2)]
+            for sent, _, _ in streams:
+                self.assertEqual(200, (await asyncio.wait_for(sent.get(), 10))['status'])
+                name, data, _ = await self.next_event(sent)
+                self.assertEqual('snapshot', name)
+                self.assertEqual([{'security': 'TCS', 'count': 10, 'average_price': 100.0}], data['positions'])
+
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.post_trade, {**self.trade, 'security': 'INFY', 'trade_price': 50})
+            frames = []
+            for sent, _, _ in streams:
+                name, data, frame = await self.next_event(sent)
+                self.assertEqual('delta', name)
+                self.assertEqual([{'security': 'INFY', 'count': 10, 'average_price': 50.0}], data['positions'])
+                self.assertEqual(1500, data['summary']['total_cost_basis'])
+                frames.append(frame)
+            # Serialized once for all subscribers
+            self.assertIs(frames[0], frames[1])
+
+            for _, disconnect, task in streams:
+                disconnect()
+                await asyncio.wait_for(task, 10)
+
+            sent, _, task = await self.open_stream(application, '/api/v1/async/portfolio/999/stream/')
+            self.assertEqual(404, (await asyncio.wait_for(sent.get(), 10))['status'])
+            await task
+
+        asyncio.run(scenario())
+        self.assertEqual({}, broadcaster._channels)
+
+    @override_settings(ASYNC_API={'STREAM_HEARTBEAT': 0.1, 'STREAM_QUEUE_SIZE': 1})
+    def test_heartbeats_and_resyncs(self):
+        async def scenario():
+            sent, disconnect, task = await self.open_stream(stream_application(None),
+                                                            f'/api/v1/async/portfolio/{self.p1.id}/stream/')
+            await sent.get()
+            await self.next_event(sent)
+            self.assertEqual(b': heartbeat\n\n', (await asyncio.wait_for(sent.get(), 10))['body'])
+
+            # Changes made by another process are noticed by the heartbeat, through the portfolio's summary
+            await asyncio.get_running_loop().run_in_executor(None, change_elsewhere, {**self.trade, 'count': 5})
+            message = await self.next_frame(sent)
+            self.assertIn(b'"count":15', message['body'])
+
+            # A subscriber that falls behind its queue gets a new snapshot
+            queue = next(iter(broadcaster._channels[self.p1.id].subscribers))[1]
+            broadcaster._deliver(queue, b'')
+            broadcaster._deliver(queue, b'')
+            message = await self.next_frame(sent)
+            self.assertIn(b'event: snapshot', message['body'])
+            disconnect()
+            await asyncio.wait_for(task, 10)
+
+        asyncio.run(scenario())
+
+
+class TestImportTrades(TestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'contract_notes.csv')
+        with open(self.path, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Trade No', 'Symbol', 'Side', 'Quantity', 'Price', 'Remarks'])
+            writer.writerow(['T1', 'TCS', 'BUY', '1,000', '100', 'first\nfill'])
+            writer.writerow(['T2', 'TCS', 'SELL', '400', '120', ''])
+            writer.writerow(['T1', 'TCS', 'BUY', '1,000', '100', 'repeated'])
+            writer.writerow(['T3', 'INFY', 'SELL', '5', '50', 'nothing held'])
+            writer.writerow(['T4', 'INFY', 'B', '10', '50', ''])
+
+    def run_import(self, *args):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_trades', self.path, '--portfolio', str(self.p1.id), '--batch-size', '2', *args,
+                     stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_import(self):
+        out, err = self.run_import()
+        self.assertIn('Imported 3 of 5 rows', out)
+        self.assertIn('skipped 1 duplicates, rejected 1', out)
+        self.assertIn('Row 4 rejected', err)
+        self.assertEqual(['T1', 'T2', 'T4'],
+                         list(Trade.objects.order_by('id').values_list('broker_trade_id', flat=True)))
+        position = Position.objects.get(portfolio=self.p1, security='TCS')
+        self.assertEqual((600, 100.0), (position.count, position.average_price))
+
+        # Finished imports resume at the end, and importing again skips every trade already recorded
+        self.assertIn('Resuming after row 5', self.run_import()[0])
+        self.assertEqual(3, Trade.objects.count())
+        # Rejected rows are not duplicates, the sell now goes through against the position T4 opened
+        out, _ = self.run_import('--restart')
+        self.assertIn('Imported 1 of 5 rows', out)
+        self.assertIn('skipped 4 duplicates, rejected 0', out)
+
+    def test_short_rows_are_rejected(self):
+        with open(self.path, 'a', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['T5', 'TCS'])
+            writer.writerow(['T6', 'TCS', 'BUY', '10', '100', ''])
+        out, err = self.run_import()
+        self.assertIn('Imported 4 of 7 rows', out)
+        self.assertIn('Row 6 rejected', err)
+        self.assertEqual(610, Position.objects.get(portfolio=self.p1, security='TCS').count)
+
+    def test_resume_after_crash(self):
+        calls = []
+
+        def crash_on_second_batch(rows):
+            calls.append(rows)
+            if len(calls) == 2:
+                raise RuntimeError('Killed')
+            return ingest_trades(rows)
+
+        with mock.patch('portfoliotrackerapp.imports.ingest_trades', crash_on_second_batch):
+            with self.assertRaises(RuntimeError):
+                self.run_import()
+        self.assertEqual(2, Trade.objects.count())
+
+        out, _ = self.run_import()
+        self.assertIn('Resuming after row 2', out)
+        self.assertIn('Imported 3 of 5 rows', out)
+        self.assertEqual(3, Trade.objects.count())
+
+
+class TestPortfolioGroups(TestCase):
+    def setUp(self) -> None:
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+        self.p2 = Portfolio.objects.create(name='Second Portfolio')
+        self.add_trade(self.p1, 'TCS', 10, 100)
+        self.add_trade(self.p2, 'TCS', 30, 200)
+        self.add_trade(self.p2, 'INFY', 5, 50)
+        res = self.client.post('/api/v1/portfolio-group/',
+                               {'name': 'Household', 'portfolios': [self.p1.id, self.p2.id]},
+                               content_type='application/json')
+        self.assertEqual(201, res.status_code)
+        self.url = f'/api/v1/portfolio-group/{res.data["id"]}/'
+
+    def add_trade(self, portfolio, security, count, trade_price, trade_type='B'):
+        res = self.client.post('/api/v1/trade/', {'portfolio': portfolio.id, 'security': security, 'count': count,
+                                                  'trade_type': trade_type, 'trade_price': trade_price})
+        self.assertEqual(201, res.status_code)
+
+    def test_aggregates_member_positions(self):
+        with self.assertNumQueries(3):
+            res = self.client.get(self.url)
+        self.assertEqual([self.p1.id, self.p2.id], sorted(res.data['portfolios']))
+        self.assertEqual([
+            {'security': 'INFY', 'count': 5, 'average_price': 50.0, 'portfolio_count': 1},
+            {'security': 'TCS', 'count': 40, 'average_price': 175.0, 'portfolio_count': 2},
+        ], res.data['stocks'])
+        self.assertEqual(7250, res.data['total_cost_basis'])
+        self.assertAlmostEqual(res.data['market_value'] - 7250, res.data['returns'])
+
+        # The aggregation is one query however many portfolios the group has
+        for i in range(10):
+            portfolio = Portfolio.objects.create(name=f'Account {i}')
+            self.add_trade(portfolio, 'TCS', 1, 175)
+            self.client.patch(self.url, {'portfolios': [*res.data['portfolios'], portfolio.id]},
+                              content_type='application/json')
+            res = self.client.get(self.url)
+        self.assertEqual(12, len(res.data['portfolios']))
+        self.assertEqual(50, res.data['stocks'][1]['count'])
+        self.assertEqual(175, res.data['stocks'][1]['average_price'])
+        self.client.patch(self.url, {'name': 'Renamed'}, content_type='application/json')
+        with self.assertNumQueries(3):
+            self.client.get(self.url)
+
+    def test_cached_until_members_change(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.assertNumQueries(0):
+            self.assertEqual(304, self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        # Trades of other portfolios leave the group cached
+        self.add_trade(Portfolio.objects.create(name='Outsider'), 'TCS', 1, 100)
+        self.assertEqual(304, self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        self.add_trade(self.p1, 'TCS', 10, 100, trade_type='S')
+        res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(30, res.data['stocks'][1]['count'])
+        self.assertEqual(1, res.data['stocks'][1]['portfolio_count'])
+
+        etag = res['ETag']
+        self.p2.groups.clear()
+        res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual([], res.data['stocks'])
+        self.client.patch(self.url, {'portfolios': [self.p2.id]}, content_type='application/json')
+        self.assertEqual(2, len(self.client.get(self.url).data['stocks']))
+        self.client.delete(f'/api/v1/portfolio/{self.p2.id}/')
+        self.assertEqual([], self.client.get(self.url).data['stocks'])
+        self.client.delete(self.url)
+        self.assertEqual(404, self.client.get(self.url).status_code)
+
+
+@override_settings(POSITION_BOOK={'ENABLED': True})
+class TestPositionBook(TransactionTestCase):
+    def setUp(self) -> None:
+        book.clear()
+        book.warm()
+        self.p1 = Portfolio.objects.create(name='First Portfolio')
+
+    def add_trade(self, security, count, trade_type, trade_price):
+        return self.client.post('/api/v1/trade/', {'portfolio': self.p1.id, 'security': security, 'count': count,
+                                                   'trade_type': trade_type, 'trade_price': trade_price})
+
+    def position(self, security):
+        return Position.objects.values_list('count', 'average_price', 'version').get(portfolio=self.p1,
+                                                                                      security=security)
+
+    def test_trades_checked_against_book(self):
+        self.assertEqual(201, self.add_trade('TCS', 10, 'B', 100).status_code)
+        self.assertEqual(201, self.add_trade('TCS', 10, 'B', 200).status_code)
+        self.assertEqual((20, 150.0, 2), self.position('TCS'))
+        self.assertEqual((20, 150.0, 2), book.get(self.p1.id, 'TCS')[1:])
+
+        # Validation and the position write go without reading positions, unlike with the book disabled
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(201, self.add_trade('TCS', 5, 'S', 120).status_code)
+        with override_settings(POSITION_BOOK={'ENABLED': False}), CaptureQueriesContext(connection) as unbooked:
+            self.assertEqual(201, self.add_trade('TCS', 5, 'S', 120).status_code)
+        # Changing the setting cleared the book
+        book.warm()
+        self.assertFalse([query for query in captured if query['sql'].startswith('SELECT')
+                          and 'FROM "portfoliotrackerapp_position"' in query['sql']])
+        self.assertEqual(len(unbooked) - 4, len(captured))
+
+        self.assertEqual(400, self.add_trade('TCS', 11, 'S', 120).status_code)
+        self.assertEqual(400, self.add_trade('INFY', 1, 'S', 120).status_code)
+        self.assertEqual((10, 150.0, 4), self.position('TCS'))
+        self.assertEqual(4, Trade.objects.count())
+
+    def test_stale_entries_are_read_again(self):
+        self.add_trade('TCS', 10, 'B', 100)
+        # Other processes change the position behind the book's back
+        Position.objects.filter(portfolio=self.p1).update(count=F('count') + 5, version=F('version') + 1)
+        self.assertEqual(201, self.add_trade('TCS', 12, 'S', 100).status_code)
+        self.assertEqual((3, 100.0, 3), self.position('TCS'))
+        Position.objects.filter(portfolio=self.p1).update(count=1, version=F('version') + 1)
+        self.assertEqual(400, self.add_trade('TCS', 2, 'S', 100).status_code)
+        self.assertEqual((1, 100.0, 4), self.position('TCS'))
+
+        # Bulk writes of this process bump versions too
+        self.client.post('/api/v1/trade/bulk/', [{'portfolio': self.p1.id, 'security': 'TCS', 'count': 1,
+                                                  'trade_type': 'B', 'trade_price': 200}],
+                         content_type='application/json')
+        self.assertEqual(201, self.add_trade('TCS', 2, 'B', 100).status_code)
+        self.assertEqual((4, 125.0, 6), self.position('TCS'))
+        self.assertEqual((4, 125.0, 6), book.get(self.p1.id, 'TCS')[1:])
+
+    def test_requests_warm_the_book_in_the_background(self):
+        book.clear()
+        release = threading.Event()
+        warm = PositionBook.warm
+
+        def held_warm(position_book):
+            release.wait(10)
+            warm(position_book)
+
+        # Trades go through the database while the book loads, rather than waiting for it
+        with mock.patch.object(PositionBook, 'warm', held_warm):
+            self.assertEqual(201, self.add_trade('TCS', 10, 'B', 100).status_code)
+            self.assertEqual(201, self.add_trade('TCS', 5, 'S', 100).status_code)
+            self.assertFalse(book.is_warm)
+            warming = book.start_warming()
+            release.set()
+            warming.join()
+        self.assertTrue(book.is_warm)
+        self.assertEqual((5, 100.0, 2), book.get(self.p1.id, 'TCS')[1:])
+        self.assertEqual(400, self.add_trade('TCS', 6, 'S', 100).status_code)
+
+    def test_rolled_back_trade_leaves_book(self):
+        self.add_trade('TCS', 10, 'B', 100)
+        with mock.patch('portfoliotrackerapp.serializers.record_lots', side_effect=RuntimeError('Failed')):
+            with self.assertRaises(RuntimeError):
+                self.add_trade('TCS', 10, 'B', 200)
+        self.assertEqual((10, 100.0, 1), self.position('TCS'))
+        self.assertEqual((10, 100.0, 1), book.get(self.p1.id, 'TCS')[1:])
+
+    def test_warm_and_lookup(self):
+        p2 = Portfolio.objects.create(name='Second Portfolio')
+        securities = ['TCS', 'INFY', 'WIPRO', 'HDFC']
+        for portfolio in (p2, self.p1):
+            for index, security in enumerate(securities):
+                Position.objects.create(portfolio=portfolio, security=security, count=index + portfolio.pk,
+                                        average_price=10.0 * index, version=index)
+        book.clear()
+        with self.assertNumQueries(1):
+            book.warm()
+            book.warm()
+        self.assertEqual(8, len(book))
+        for portfolio in (self.p1, p2):
+            for index, security in enumerate(securities):
+                self.assertEqual((index + portfolio.pk, 10.0 * index, index), book.get(portfolio.pk, security)[1:])
+        self.assertIsNone(book.get(self.p1.id, 'NONE'))
+        self.add_trade('NONE', 1, 'B', 5)
+        self.assertEqual((1, 5.0, 1), book.get(self.p1.id, 'NONE')[1:])
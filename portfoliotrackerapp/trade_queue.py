@@ -0,0 +1,80 @@
+from django.conf import settings
+from django.core import checks
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connections, router, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .caching import get_cache, get_config as get_cache_config
+from .ingest import ingest_trades
+from .models import *
+
+"""
+Write-ahead trade queue. While it is enabled, POST /trade/ only appends the trade to the queue and answers 202, and
+run_trade_applier applies queued trades in batches, so bursts of orders don't queue on the position locks
+"""
+
+DEFAULT_TRADE_QUEUE = {
+    'ENABLED': False,
+    'BATCH_SIZE': 500,
+    'POLL_INTERVAL': 0.5,
+}
+
+
+def get_config():
+    return {**DEFAULT_TRADE_QUEUE, **getattr(settings, 'TRADE_QUEUE', {})}
+
+
+def claim_batch(batch_size):
+    """
+    The oldest pending trades, locked until the end of the current transaction, like lock_positions does for
+    positions. A second applier waits for the batch to be applied rather than applying it twice.
+    """
+    pending = QueuedTrade.objects.filter(status=QueuedTrade.PENDING).order_by('id')
+    if connections[router.db_for_write(QueuedTrade)].features.has_select_for_update:
+        return list(pending.select_for_update()[:batch_size])
+    QueuedTrade.objects.filter(pk__in=pending.values('pk')[:batch_size]).update(status=F('status'))
+    return list(pending[:batch_size])
+
+
+def apply_queued_trades(batch_size=None):
+    """
+    Applies a batch of queued trades in queue order, in one transaction. Trades that would make a position negative
+    are rejected with their errors. Returns the queued trades of the batch.
+    """
+    batch_size = batch_size or get_config()['BATCH_SIZE']
+    with transaction.atomic():
+        batch = claim_batch(batch_size)
+        if not batch:
+            return batch
+        trades, errors = ingest_trades([{'portfolio': queued.portfolio_id, 'security': queued.security,
+                                         'count': queued.count, 'trade_type': queued.trade_type,
+                                         'trade_price': queued.trade_price} for queued in batch])
+        # Trades are created in the order of the rows that were not rejected
+        errors = {error['row']: error['errors'] for error in errors}
+        created = iter(trades)
+        now = timezone.now()
+        for index, queued in enumerate(batch):
+            if index in errors:
+                queued.status, queued.errors = QueuedTrade.REJECTED, errors[index]
+            else:
+                queued.status, queued.trade = QueuedTrade.APPLIED, next(created)
+            queued.applied_at = now
+        QueuedTrade.objects.bulk_update(batch, ['status', 'trade', 'errors', 'applied_at'], batch_size=batch_size)
+    return batch
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    run_trade_applier writes every position in a process of its own, so the web processes only see it invalidate
+    their cached portfolio responses through a cache they share with it
+    """
+    if not get_config()['ENABLED'] or not isinstance(get_cache(), LocMemCache):
+        return []
+    return [checks.Error(
+        f"TRADE_QUEUE is enabled but PORTFOLIO_CACHE uses the process-local cache '{get_cache_config()['ALIAS']}'.",
+        hint='Point PORTFOLIO_CACHE at a cache shared by the web processes and run_trade_applier, such as Redis '
+             'or Memcached, otherwise they keep serving portfolios as they were before queued trades applied.',
+        id='portfoliotrackerapp.E001',
+    )]
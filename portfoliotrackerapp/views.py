@@ -1,72 +1,308 @@
-from rest_framework import viewsets
+import datetime
+
+from django.db import transaction
+from django.db.models import Prefetch
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework import mixins, status, viewsets
+from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from rest_framework.views import APIView
+from .analytics import FREQUENCIES, portfolio_analytics
+from .caching import LIST_SCOPE, cached_response, group_scope
+from .database import retry_when_locked
+from .exports import POSITION_COLUMNS, TRADE_COLUMNS, stream_export
+from .metrics import registry
+from .ingest import ingest_trades
+from .ledger import record_events, trade_event
+from .lots import rebuild_lots, rewind_lots
+from .pagination import TradeCursorPagination
+from .parsers import NDJSONParser
+from .positions import StreamReplay, group_positions, lock_positions, snapshots_as_of
+from .prices import get_prices
+from .replicas import ReplicaReadMixin
+from .renderers import CSVRenderer, NDJSONRenderer, PrometheusRenderer
+from .summaries import position_value, refresh_last_trade_time
+from .trade_queue import get_config as get_trade_queue_config
 from .serializers import *
 
 
-class TradeViewset(viewsets.ModelViewSet):
+class TradeViewset(ReplicaReadMixin, viewsets.ModelViewSet):
     """
         API for Trade list, create, update, delete and retrieve.
         POST to /trade/ - Add a trade.
-        GET to /trade/ - List all trades.
+        GET to /trade/ - List trades by trade time, a page at a time. Follow `next` for the following page.
+            Filters: ?portfolio=1&security=TCS&from=2021-04-01&to=2021-04-30
+            Slim payloads: ?fields=id,security,count. Page size: ?page_size=500 (at most 1000)
         GET to /trade/1/ - Retrieve trade 1.
         POST to /trade/1/ to update trade 1
         DELETE to /trade/1/ to remove trade 1
+        POST to /trade/bulk/ - Add a batch of trades, as a JSON array or NDJSON (application/x-ndjson).
+            Rows are applied in order. Invalid rows are skipped and reported, or fail the whole batch
+            with ?atomic=true
+        GET to /trade/export/?format=csv - Stream all trades as CSV, or NDJSON with ?format=ndjson.
+            Takes the same filters as the trade list
 
-        This API returns 400 for trade manipulations resulting negative positions
+        This API returns 400 for trade manipulations resulting negative positions.
+        While the trade queue is enabled (TRADE_QUEUE setting), POST to /trade/ queues the trade and returns 202 with
+        the queued trade. Poll /trade-queue/<id>/ until it is applied or rejected.
     """
     queryset = Trade.objects.all()
     serializer_class = TradeSerializer
+    pagination_class = TradeCursorPagination
+    replica_actions = ('list', 'export')
+
+    def filter_queryset(self, queryset):
+        params = self.request.query_params
+        if params.get('portfolio'):
+            if not params['portfolio'].isdigit():
+                raise ValidationError({'portfolio': 'Expected a portfolio id'})
+            queryset = queryset.filter(portfolio=params['portfolio'])
+        if params.get('security'):
+            queryset = queryset.filter(security=params['security'])
+        for param, lookup in (('from', 'trade_time__gte'), ('to', 'trade_time__lte')):
+            if params.get(param):
+                queryset = queryset.filter(**{lookup: parse_moment(param, params[param], end_of_day=param == 'to')})
+        if params.get('fields'):
+            # Only load the columns that are serialized, plus what the cursor needs
+            columns = {field.name for field in Trade._meta.concrete_fields} & set(params['fields'].split(','))
+            queryset = queryset.only('id', 'trade_time', *columns)
+        return queryset
+
+    def create(self, request, *args, **kwargs):
+        if not get_trade_queue_config()['ENABLED']:
+            return super().create(request, *args, **kwargs)
+        serializer = QueuedTradeSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        location = reverse('queuedtrade-detail', args=[serializer.instance.pk], request=request)
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED, headers={'Location': location})
+
+    @action(detail=False, methods=['get'], renderer_classes=[CSVRenderer, NDJSONRenderer])
+    def export(self, request):
+        trades = self.filter_queryset(self.get_queryset()).order_by('trade_time', 'id')
+        columns = TRADE_COLUMNS
+        if request.query_params.get('fields'):
+            columns = [column for column in TRADE_COLUMNS if column in request.query_params['fields'].split(',')]
+        return stream_export(trades, columns, request.accepted_renderer.format, 'trades')
+
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request):
+        if not isinstance(request.data, list):
+            raise ValidationError('Expected a list of trades')
+        atomic = request.query_params.get('atomic', '').lower() in ('1', 'true', 'yes')
+        trades, errors = ingest_trades(request.data, atomic=atomic)
+        data = {'created': len(trades), 'ids': [trade.pk for trade in trades], 'errors': errors}
+        if errors and not trades:
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+        return Response(data, status=status.HTTP_201_CREATED)
 
     def perform_destroy(self, trade):
-        trades_on_security = Trade.objects.filter(portfolio=trade.portfolio,
-                                                  security=trade.security) \
-            .order_by('trade_time')
-
-        count = 0
-        average_price = 0
-        for t in trades_on_security:
-            if t == trade:
-                continue
-
-            if t.trade_type == Trade.BUY:
-                count += t.count
-                average_price += t.trade_price * t.count
-            else:
-                count -= t.count
-                average_price -= t.trade_price * t.count
-            if count < 0:
-                raise ValidationError('Position becomes negative on deletion of this trade')
-
-        if count != 0:
-            average_price /= count
-        else:
-            average_price = 0
-
-        positions_on_security = Position.objects.filter(portfolio=trade.portfolio, security=trade.security)
-        # Todo - Make positions time series and snapshot position at each time there's a change so only trades post
-        # trade to be deleted need to be checked
-        if len(positions_on_security) > 0:
-            position = positions_on_security[0]
-            position.count = count
-            position.average_price = average_price
-            position.save()
-
-        trade.delete()
-
-
-class PortfolioViewset(viewsets.ModelViewSet):
+        # Only trades after the one being deleted need to be replayed, starting from the snapshot just before it
+        def write():
+            with transaction.atomic():
+                lock_positions(portfolio=trade.portfolio, security=trade.security)
+                StreamReplay(trade.portfolio, trade.security, trade) \
+                    .run('Position becomes negative on deletion of this trade') \
+                    .save()
+                record_events([trade_event(trade, TradeEvent.CANCEL)])
+                # Lots are rewound while the trade still has its closures, which give back the shares it relieved
+                rewind_lots(trade.portfolio_id, [trade.security], trade, exclude=trade)
+                trade.delete()
+                refresh_last_trade_time(trade.portfolio_id)
+
+        retry_when_locked(write)
+
+
+def parse_moment(param, value, end_of_day=False):
+    """Parses a query parameter given as a datetime, or as a date meaning its start (or end) of day"""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValidationError({param: 'Expected a date or datetime in ISO 8601 format'})
+        moment = datetime.datetime.combine(day, datetime.time.max if end_of_day else datetime.time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class PortfolioViewset(ReplicaReadMixin, viewsets.ModelViewSet):
     """
     API for Portfolio list, create, delete and retrieve.
     A list of all portfolios can be fetched as well as a single portfolio detail
     can be accessed by giving it's ID like /portfolio/1/
 
     The response includes the stock holding as well as Returns from the portfolio
+
+    Responses are cached until a trade changes the portfolio, and carry an ETag. Clients polling with
+    If-None-Match get a 304 while the portfolio is unchanged.
+
+    GET to /portfolio/1/?as_of=2021-03-31 - Holdings and cost basis of portfolio 1 right after its last trade at or
+        before the given datetime, or the end of the given date.
+    GET to /portfolio/1/positions/ - Positions of portfolio 1.
+    GET to /portfolio/1/lots/?security=TCS - Open lots and closed lots with their realized P&L, by the lot method
+        (FIFO, LIFO or HIFO) of the portfolio. Changing the lot_method of a portfolio rebuilds its lots.
+    GET to /portfolio/1/analytics/?from=2021-01-01&to=2021-12-31&freq=D - Equity curve, time-weighted return and
+    realized / unrealized P&L of portfolio 1. Dates are optional, freq is one of D, W or M.
     """
-    queryset = Portfolio.objects.all()
+    # Positions of every portfolio in a response are fetched in one query, used for both stocks and returns
+    queryset = Portfolio.objects.select_related('summary') \
+        .prefetch_related(Prefetch('position_set', queryset=Position.objects.order_by('id')))
     serializer_class = PortfolioSerializer
+    replica_actions = ('list', 'analytics')
+
+    def list(self, request, *args, **kwargs):
+        return cached_response(request, LIST_SCOPE,
+                               lambda: super(PortfolioViewset, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        if request.query_params.get('as_of'):
+            moment = parse_moment('as_of', request.query_params['as_of'], end_of_day=True)
+            return cached_response(request, kwargs['pk'], lambda: self.as_of(kwargs['pk'], moment))
+        return cached_response(request, kwargs['pk'],
+                               lambda: super(PortfolioViewset, self).retrieve(request, *args, **kwargs))
+
+    def as_of(self, pk, moment):
+        portfolio = get_object_or_404(Portfolio, pk=pk)
+        snapshots = sorted(snapshots_as_of(portfolio.pk, moment), key=lambda snapshot: snapshot.security)
+        return Response({
+            'id': portfolio.pk,
+            'name': portfolio.name,
+            'as_of': moment,
+            'stocks': PositionSerializer(snapshots, many=True).data,
+            'total_cost_basis': sum(snapshot.count * snapshot.average_price for snapshot in snapshots),
+        })
+
+    def perform_update(self, serializer):
+        lot_method = serializer.instance.lot_method
+        with transaction.atomic():
+            portfolio = serializer.save()
+            if portfolio.lot_method != lot_method:
+                rebuild_lots(portfolio.pk)
+
+    @action(detail=True, methods=['get'])
+    def lots(self, request, pk=None):
+        portfolio = get_object_or_404(Portfolio, pk=pk)
+        lots = Lot.objects.filter(portfolio=portfolio)
+        closures = LotClosure.objects.filter(lot__portfolio=portfolio)
+        if request.query_params.get('security'):
+            lots = lots.filter(security=request.query_params['security'])
+            closures = closures.filter(lot__security=request.query_params['security'])
+        closures = list(closures.select_related('lot').order_by('closed_at', 'sell_trade', 'lot__acquired_at'))
+        return Response({
+            'lot_method': portfolio.lot_method,
+            'realized_pnl': sum(closure.realized_pnl for closure in closures),
+            'open': LotSerializer(lots.filter(remaining__gt=0).order_by('security', 'acquired_at', 'trade'),
+                                  many=True).data,
+            'closed': LotClosureSerializer(closures, many=True).data,
+        })
+
+    @action(detail=True, methods=['get'])
+    def positions(self, request, pk=None):
+        portfolio = get_object_or_404(Portfolio, pk=pk)
+        positions = Position.objects.filter(portfolio=portfolio).order_by('security')
+        return Response(PositionSerializer(positions, many=True).data)
+
+    @action(detail=True, methods=['get'])
+    def analytics(self, request, pk=None):
+        portfolio = get_object_or_404(Portfolio, pk=pk)
+        params = request.query_params
+        freq = params.get('freq', 'D').upper()
+        if freq not in FREQUENCIES:
+            raise ValidationError({'freq': f'Must be one of {", ".join(FREQUENCIES)}'})
+        dates = {}
+        for param in ('from', 'to'):
+            dates[param] = parse_date(params[param]) if params.get(param) else None
+            if params.get(param) and dates[param] is None:
+                raise ValidationError({param: 'Expected a date as YYYY-MM-DD'})
+        if dates['from'] and dates['to'] and dates['from'] > dates['to']:
+            raise ValidationError('from must not be after to')
 
+        prices = None
+        if dates['to'] is None:
+            prices = get_prices(set(Trade.objects.filter(portfolio=portfolio).values_list('security', flat=True)))
+        return Response(portfolio_analytics(portfolio, dates['from'], dates['to'], freq, prices=prices))
 
-class PositionViewset(viewsets.ModelViewSet):
-    """Returns the position data"""
+
+class PortfolioGroupViewset(viewsets.ModelViewSet):
+    """
+    API for groups of portfolios reported together, such as the accounts of a household.
+    POST to /portfolio-group/ - Add a group, with the ids of its `portfolios`.
+    GET to /portfolio-group/1/ - Group 1 with the positions of its portfolios summed per security, at their weighted
+        average price, and the totals of the group marked at current prices. Computed with one query whatever the
+        number of portfolios, and cached like portfolio responses until a trade changes one of them.
+    """
+    queryset = PortfolioGroup.objects.prefetch_related('portfolios')
+    serializer_class = PortfolioGroupSerializer
+
+    def retrieve(self, request, *args, **kwargs):
+        return cached_response(request, group_scope(kwargs['pk']), lambda: self.holdings(kwargs['pk']))
+
+    def holdings(self, pk):
+        group = get_object_or_404(self.get_queryset(), pk=pk)
+        positions = list(group_positions(group.pk))
+        prices = get_prices({position['security'] for position in positions})
+        stocks = [{
+            'security': position['security'],
+            'count': position['total_count'],
+            'average_price': position['cost_basis'] / position['total_count'],
+            'portfolio_count': position['portfolio_count'],
+        } for position in positions]
+        total_cost_basis = sum(position['cost_basis'] for position in positions)
+        market_value = sum(position_value(stock['count'], stock['average_price'], prices.get(stock['security']))
+                           for stock in stocks)
+        return Response({
+            **self.get_serializer(group).data,
+            'stocks': stocks,
+            'total_cost_basis': total_cost_basis,
+            'market_value': market_value,
+            'returns': market_value - total_cost_basis,
+        })
+
+
+class QueuedTradeViewset(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """
+    Application state of trades queued while the trade queue is enabled.
+    GET to /trade-queue/1/ - Queued trade 1. `status` is P (pending), A (applied, with the id of the created `trade`)
+        or R (rejected, with its `errors`)
+    """
+    queryset = QueuedTrade.objects.all()
+    serializer_class = QueuedTradeSerializer
+
+
+class PositionViewset(ReplicaReadMixin, viewsets.GenericViewSet):
+    """
+    API for position data.
+    GET to /position/export/?format=csv - Stream all positions as CSV, or NDJSON with ?format=ndjson.
+        Filter with ?portfolio=1
+    """
     queryset = Position.objects.all()
     serializer_class = PositionSerializer
+    replica_actions = ('export',)
+
+    @action(detail=False, methods=['get'], renderer_classes=[CSVRenderer, NDJSONRenderer])
+    def export(self, request):
+        positions = self.get_queryset().order_by('portfolio', 'security')
+        if request.query_params.get('portfolio'):
+            if not request.query_params['portfolio'].isdigit():
+                raise ValidationError({'portfolio': 'Expected a portfolio id'})
+            positions = positions.filter(portfolio=request.query_params['portfolio'])
+        return stream_export(positions, POSITION_COLUMNS, request.accepted_renderer.format, 'positions')
+
+
+class MetricsView(APIView):
+    """
+    Request metrics of this process in the Prometheus text format, for admin users.
+    Recorded while RequestMetricsMiddleware is enabled.
+    """
+    permission_classes = [IsAdminUser]
+    renderer_classes = [PrometheusRenderer]
+
+    def get(self, request):
+        return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
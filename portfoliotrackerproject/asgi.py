@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'portfoliotrackerproject.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up by get_asgi_application()
+from portfoliotrackerapp.streams import stream_application  # noqa: E402
+
+application = stream_application(django_application)
@@ -52,6 +52,26 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Per request query count, database, serializer and view time, reported in Server-Timing headers, log lines of the
+# portfoliotrackerapp.metrics logger and /api/v1/metrics/. Enabled with PORTFOLIO_TRACKER_METRICS=1
+if os.environ.get('PORTFOLIO_TRACKER_METRICS'):
+    MIDDLEWARE.insert(0, 'portfoliotrackerapp.metrics.RequestMetricsMiddleware')
+REQUEST_METRICS = {
+    'SERVER_TIMING': True,
+    'LOG': True,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'portfoliotrackerapp.metrics': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
 ROOT_URLCONF = 'portfoliotrackerproject.urls'
 
 TEMPLATES = [
@@ -78,12 +98,65 @@ WSGI_APPLICATION = 'portfoliotrackerproject.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # Django's SQLite backend, with transactions that take the write lock as they begin
+        'ENGINE': 'portfoliotrackerapp.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Seconds a writer waits for the write lock before failing with "database is locked"
+        'OPTIONS': {'timeout': 20},
+        # Tests run on a file so concurrent connections lock the database like production does,
+        # rather than failing fast on the table locks of a shared in-memory database
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Portfolio responses are cached in this cache alias until a trade changes the portfolio, at most TIMEOUT seconds
+PORTFOLIO_CACHE = {
+    'ALIAS': 'default',
+    'TIMEOUT': 300,
+}
+
+# Async read endpoints under /api/v1/async/ run queries on a pool of DB_WORKERS threads, which also bounds the
+# database connections they hold. Long-polls wait at most LONG_POLL_TIMEOUT seconds. Portfolio streams send a
+# heartbeat every STREAM_HEARTBEAT seconds and resync subscribers more than STREAM_QUEUE_SIZE events behind
+ASYNC_API = {
+    'DB_WORKERS': 16,
+    'LONG_POLL_TIMEOUT': 60,
+    'LONG_POLL_INTERVAL': 5,
+    'STREAM_HEARTBEAT': 15,
+    'STREAM_QUEUE_SIZE': 100,
+}
+
+# With the trade queue enabled, POST /api/v1/trade/ queues trades, which `manage.py run_trade_applier` applies
+# BATCH_SIZE at a time, checking for new ones every POLL_INTERVAL seconds while idle
+TRADE_QUEUE = {
+    'ENABLED': bool(os.environ.get('PORTFOLIO_TRACKER_TRADE_QUEUE')),
+    'BATCH_SIZE': 500,
+    'POLL_INTERVAL': 0.5,
+}
+
+# With the position book enabled, every process keeps a copy of all positions in memory, about 40 bytes each, and
+# checks new trades against it instead of reading positions from the database. It loads in the background after the
+# first request of the process.
+POSITION_BOOK = {
+    'ENABLED': bool(os.environ.get('PORTFOLIO_TRACKER_POSITION_BOOK')),
+}
+
+# Requests that still find the database locked after retries are answered with a 503
+REST_FRAMEWORK = {
+    'EXCEPTION_HANDLER': 'portfoliotrackerapp.database.exception_handler',
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -122,3 +195,13 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+
+
+# Market prices used to value portfolios. BACKEND is a portfoliotrackerapp.prices.PriceProvider, wrapped in an
+# in-process TTL + LRU cache unless CACHE_TTL is 0. The CSV file holds `security,price` rows.
+PRICE_PROVIDER = {
+    'BACKEND': 'portfoliotrackerapp.prices.CSVPriceProvider',
+    'OPTIONS': {'path': os.environ.get('PORTFOLIO_TRACKER_PRICES', BASE_DIR / 'prices.csv')},
+    'CACHE_TTL': 60,
+    'CACHE_MAX_ENTRIES': 10000,
+}
@@ -0,0 +1,24 @@
+"""
+Production profile for a single SQLite database file, run with
+DJANGO_SETTINGS_MODULE=portfoliotrackerproject.settings_production
+
+https://www.sqlite.org/wal.html
+https://www.sqlite.org/pragma.html
+"""
+from .settings import *  # noqa: F401,F403
+
+DATABASES['default'].update({
+    # Connections are kept open across requests instead of being reopened by each one
+    'CONN_MAX_AGE': 600,
+})
+
+# Run on every new connection by portfoliotrackerapp.database. In WAL mode readers no longer block on writers,
+# and with synchronous=NORMAL commits don't wait for an fsync, at the risk of losing the last commits (not of
+# corruption) if the machine loses power
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'temp_store': 'MEMORY',
+}
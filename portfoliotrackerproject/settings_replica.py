@@ -0,0 +1,24 @@
+"""
+Local read replica setup on two SQLite databases, to exercise replica routing. Nothing copies the primary to the
+replica, so reads routed there only see what was written to it directly. Run the tests with
+python manage.py test --settings=portfoliotrackerproject.settings_replica
+
+On PostgreSQL, point the replica alias at a streaming replica and add the same router and READ_REPLICA settings.
+"""
+from .settings import *  # noqa: F401,F403
+
+DATABASES['replica'] = {
+    'ENGINE': 'portfoliotrackerapp.backends.sqlite3',
+    'OPTIONS': {'timeout': 20},
+    'NAME': BASE_DIR / 'db_replica.sqlite3',
+    'TEST': {'NAME': BASE_DIR / 'test_db_replica.sqlite3'},
+}
+
+DATABASE_ROUTERS = ['portfoliotrackerapp.replicas.ReadReplicaRouter']
+
+# Safe requests to the heavy read endpoints go to the replica, except from clients that wrote in the last MAX_LAG
+# seconds, see portfoliotrackerapp.replicas
+READ_REPLICA = {
+    'ALIAS': 'replica',
+    'MAX_LAG': 5,
+}
@@ -17,9 +17,10 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
-from portfoliotrackerapp.api import router
+from portfoliotrackerapp.api import async_urlpatterns, urlpatterns as api_urlpatterns
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('api/v1/', include(router.urls)),
+    path('api/v1/async/', include(async_urlpatterns)),
+    path('api/v1/', include(api_urlpatterns)),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)